@@ -8,49 +8,10 @@ from argparse import ArgumentParser
 import logging
 import os
 import pandas as pd
-from data_helpers import execute_queries_all_instances
+from data_helpers import execute_queries_all_instances, ESInstanceManager, QueryResultCache, generate_chunk_queries
 from functools import reduce
-from math import ceil
 import re
 
-def generate_chunk_txt_queries(txt_vals, txt_var='text', lang='es', max_chunk_size=100):
-    """
-    Generate chunk queries to match text values and specified language.
-    
-    """
-    chunk_count = int(ceil(len(txt_vals) / max_chunk_size))
-    queries = []
-    for i in range(chunk_count):
-        txt_val_chunk = txt_vals[(i*max_chunk_size):((i+1)*max_chunk_size)]
-        txt_val_chunk_str = '|'.join(txt_val_chunk)
-        query = {
-            'query' : {
-                'bool' : {
-                    'must' : [
-                        {
-                            'match' : {
-                                txt_var : txt_val_chunk_str
-                            }
-                        },
-                        {
-                            'match' : {
-                                'lang' : lang
-                            }
-                        }
-                    ]
-                }
-            }
-        }
-        
-#             {
-#                 'match' : {
-#                     txt_var : txt_val_chunk_str
-#                 }
-#             }
-#         }
-        queries.append(query)
-    return queries
-
 def generate_begin_mid_end(txt):
     begin = f'^{txt} '
     mid = f' {txt} '
@@ -63,6 +24,10 @@ def main():
     parser.add_argument('--loanword_integrated_data', default='../../data/loanword_resources/wiktionary_twitter_reddit_loanword_verbs_integrated_verbs_query_phrases.tsv')
     parser.add_argument('--loanword_phrase_data', default='../../data/loanword_resources/wiktionary_twitter_reddit_loanword_verbs_light_verbs_query_phrases.tsv')
     parser.add_argument('--out_dir', default='../../data/mined_tweets/')
+    parser.add_argument('--es_max_instances', type=int, default=4) # ES instances running at once (separate ports)
+    parser.add_argument('--keep_es_alive', action='store_true') # leave ES instances running for later scripts
+    parser.add_argument('--es_query_workers', type=int, default=4) # queries running at once per ES instance
+    parser.add_argument('--query_cache_dir', default=None) # cache query results across reruns, e.g. ../../data/es_query_cache/
     args = vars(parser.parse_args())
     es_cluster_name = args['es_cluster_name']
     logging_file = f'../../output/collect_loanword_authors_{es_cluster_name}.txt'
@@ -117,10 +82,10 @@ def main():
         id_var = 'id'
         date_var = 'date'
         author_descriptive_data_fields = []    
-    max_chunk_size = 100
     lang = 'es'
-    integrated_verb_queries = generate_chunk_txt_queries(loanword_integrated_verbs, txt_var=txt_var, lang=lang, max_chunk_size=max_chunk_size)
-    light_verb_noun_queries = generate_chunk_txt_queries(loanword_light_verb_phrase_nouns_flat, txt_var=txt_var, lang=lang, max_chunk_size=max_chunk_size)
+    # non-scoring term filters; chunk size based on term count, at least one query per query worker
+    integrated_verb_queries = generate_chunk_queries(loanword_integrated_verbs, extra_query_params={'lang' : lang}, search_var=txt_var, min_chunks=args['es_query_workers'])
+    light_verb_noun_queries = generate_chunk_queries(loanword_light_verb_phrase_nouns_flat, extra_query_params={'lang' : lang}, search_var=txt_var, min_chunks=args['es_query_workers'])
     
     ## query for author counts
     ## AND author info! bio/location/description
@@ -137,7 +102,12 @@ def main():
 #     es_year_month_pairs = [(2017, 7, 9)]
     es_year_month_pairs = [(2017, 1, 3), (2017, 4, 6), (2017, 7, 9), (2017, 10, 12), (2018, 1, 3), (2018, 4, 6), (2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6), (2019, 7, 9), (2019, 10, 12)]
 #     es_year_month_pairs = [(2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6)]
-    integrated_verb_query_results = execute_queries_all_instances(integrated_verb_queries, es_year_month_pairs=es_year_month_pairs, es_cluster_name=es_cluster_name, verbose=False)
+    query_cache = None
+    if(args['query_cache_dir'] is not None):
+        query_cache = QueryResultCache(args['query_cache_dir'])
+    # shared ES instances for integrated + light verb queries
+    es_manager = ESInstanceManager(es_cluster_name=es_cluster_name, max_instances=args['es_max_instances'], keep_alive=args['keep_es_alive'])
+    integrated_verb_query_results = execute_queries_all_instances(integrated_verb_queries, es_year_month_pairs=es_year_month_pairs, keys_to_include=result_author_data_fields, es_cluster_name=es_cluster_name, verbose=False, es_manager=es_manager, query_workers=args['es_query_workers'], query_cache=query_cache)
     # collect counts
     integrated_verb_author_data = []
     verb_type = 'integrated_loanword'
@@ -171,7 +141,8 @@ def main():
     ## light verbs
     es_year_month_pairs = [(2017, 7, 9), (2017, 10, 12), (2018, 1, 3), (2018, 4, 6), (2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6)]
 #     es_year_month_pairs = [(2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6)]
-    light_verb_noun_query_results = execute_queries_all_instances(light_verb_noun_queries, es_year_month_pairs=es_year_month_pairs, es_cluster_name=es_cluster_name)
+    light_verb_noun_query_results = execute_queries_all_instances(light_verb_noun_queries, es_year_month_pairs=es_year_month_pairs, keys_to_include=result_author_data_fields, es_cluster_name=es_cluster_name, es_manager=es_manager, query_workers=args['es_query_workers'], query_cache=query_cache)
+    es_manager.close()
     light_verb_author_data = []
     verb_type = 'light_verb_loanword'
     for light_verb_noun_query_result, es_year_month_pair in zip(light_verb_noun_query_results, es_year_month_pairs):
@@ -45,8 +45,6 @@ def main():
         post_iter = get_file_iter(args['post_file'])
         post_ctr = 0
         for lines in post_iter:
-            if(type(lines) is not list):
-                lines = [lines]
             for l in lines:
                 try:
                     l_data = json.loads(l)
@@ -3,8 +3,8 @@ Collect tweets from loanword authors via Elasticsearch.
 """
 from argparse import ArgumentParser
 import logging
-from data_helpers import generate_chunk_queries
-from data_helpers import execute_queries_all_instances
+from data_helpers import generate_chunk_queries, generate_chunk_queries_by_cost
+from data_helpers import execute_queries_all_instances, ESInstanceManager, QueryResultWriter, QueryResultCache
 import os
 import pandas as pd
 import re
@@ -14,6 +14,12 @@ def main():
     parser.add_argument('author_data') # ../../data/mined_tweets/loanword_verb_posts_CLUSTER=twitter_posts_STARTDATE=2017_7_9_ENDDATE=2019_4_6.tsv
     parser.add_argument('--es_cluster_name', default='twitter_posts')
     parser.add_argument('--out_dir', default='../../data/mined_tweets/loanword_author_tweets_elasticsearch/')
+    parser.add_argument('--es_max_instances', type=int, default=4) # ES instances running at once (separate ports)
+    parser.add_argument('--keep_es_alive', action='store_true') # leave ES instances running for later scripts
+    parser.add_argument('--es_query_workers', type=int, default=4) # queries running at once per ES instance
+    parser.add_argument('--query_cache_dir', default=None) # cache query results across reruns, e.g. ../../data/es_query_cache/
+    parser.add_argument('--es_slices', type=int, default=1) # parallel scroll slices per query (needs ES >= 5.0, else one slice)
+    parser.add_argument('--max_query_hits', type=int, default=None) # split author chunks by hit counts in latest index
     args = vars(parser.parse_args())
     logging_file = '../../output/collect_tweets_from_loanword_authors_in_elasticsearch.txt'
     if(os.path.exists(logging_file)):
@@ -30,27 +36,46 @@ def main():
     
     ## generate queries
     es_cluster_name = args['es_cluster_name']
+    # fields stored in index (see index_ES_posts.py)
     if(es_cluster_name == 'twitter_posts'):
         txt_var = 'text'
         author_var = 'user_screen_name'
+        result_fields = ['text', 'id', 'created_at', 'user_id', 'user_description', 'user_screen_name', 'user_location', 'lang', 'lang_score']
     else:
         txt_var = 'body'
         author_var = 'author'
+        result_fields = ['body', 'subreddit', 'id', 'author', 'author_flair_text', 'created_utc', 'parent_id', 'score', 'lang', 'lang_score']
     extra_query_params = {'lang' : 'es'}
-    author_queries = generate_chunk_queries(author_list, extra_query_params=extra_query_params, MAX_QUERY_CHUNK_SIZE=50, search_var=author_var)
-    logging.info(f'generated author queries {author_queries}')
+    # chunk size based on author count, at least one query per query worker
+    author_queries = generate_chunk_queries(author_list, extra_query_params=extra_query_params, search_var=author_var, min_chunks=args['es_query_workers'])
     
     ## mine that shit
     # tmp debugging
 #     es_year_month_pairs = [(2017, 7, 9),]
     es_year_month_pairs = [(2017, 7, 9), (2017, 10, 12), (2018, 1, 3), (2018, 4, 6), (2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6)]
-    author_results = execute_queries_all_instances(author_queries, es_year_month_pairs=es_year_month_pairs, es_cluster_name=es_cluster_name, verbose=False)
+    query_cache = None
+    if(args['query_cache_dir'] is not None):
+        query_cache = QueryResultCache(args['query_cache_dir'])
+    # reuses ES instances left running by earlier scripts (--keep_es_alive)
+    # stream results to file rather than holding them in memory
+    out_dir = args['out_dir']
+    author_result_file = os.path.join(out_dir, 'author_tweets_raw.tsv.gz')
+    with ESInstanceManager(es_cluster_name=es_cluster_name, max_instances=args['es_max_instances'], keep_alive=args['keep_es_alive']) as es_manager, QueryResultWriter(author_result_file, fields=result_fields) as result_writer:
+        if(args['max_query_hits'] is not None):
+            es, es_instance_name = es_manager.get_client(*es_year_month_pairs[-1])
+            author_queries, author_query_hits = generate_chunk_queries_by_cost(es, es_instance_name, author_list, extra_query_params=extra_query_params, search_var=author_var, max_query_hits=args['max_query_hits'], min_chunks=args['es_query_workers'])
+        logging.info(f'generated author queries {author_queries}')
+        execute_queries_all_instances(author_queries, es_year_month_pairs=es_year_month_pairs, es_cluster_name=es_cluster_name, verbose=False, es_manager=es_manager, keys_to_include=result_fields, query_workers=args['es_query_workers'], query_cache=query_cache, max_slices=args['es_slices'], result_writer=result_writer)
+    logging.info('collected %d author tweets'%(result_writer.row_count))
+    if(result_writer.row_count == 0):
+        logging.warning('no author tweets found, nothing to write')
+        return
 #     author_result_data = []
 #     for query_results in author_results:
 #         for query_result_list in query_results:
 #             author_result_data += list(map(pd.Series, query_result_list))
 #     author_results = pd.concat(author_result_data, axis=1).transpose()
-    author_result_data = pd.DataFrame(author_results[0][0])
+    author_results = pd.read_csv(author_result_file, sep='\t')
     author_results.fillna('', inplace=True)
     # simplify
     ## clean text vars!
@@ -65,7 +90,6 @@ def main():
 
     ## save to file
     # different file per author to match current setup ;_;
-    out_dir = args['out_dir']
     for author_i, data_i in author_results.groupby(author_var):
         logging.info(f'writing data for author={author_i}')
         out_file_i = os.path.join(out_dir, f'{author_i}_tweets.gz')
@@ -2,4 +2,6 @@ AUTHOR_DATA=../../data/mined_tweets/loanword_verb_posts_CLUSTER=twitter_posts_ST
 ES_CLUSTER_NAME=twitter_posts
 OUT_DIR=../../data/mined_tweets/loanword_author_tweets_elasticsearch/
 
-python collect_tweets_from_loanword_authors_in_elasticsearch.py $AUTHOR_DATA --es_cluster_name $ES_CLUSTER_NAME --out_dir $OUT_DIR
\ No newline at end of file
+python collect_tweets_from_loanword_authors_in_elasticsearch.py $AUTHOR_DATA --es_cluster_name $ES_CLUSTER_NAME --out_dir $OUT_DIR
+# stop ES instances left running with --keep_es_alive
+# python -c "from data_helpers import ESInstanceManager; ESInstanceManager(es_cluster_name='$ES_CLUSTER_NAME').stop_all()"
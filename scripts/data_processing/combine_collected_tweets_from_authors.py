@@ -8,6 +8,7 @@ import os
 import re
 import numpy as np
 import pandas as pd
+from data_helpers import write_lang_id_store, get_lang_id_store_dir, build_author_timeline_store
 
 def get_all_files(data_dir, file_matcher):
     data_files = list(map(lambda x: os.path.join(data_dir, x), os.listdir(data_dir)))
@@ -83,6 +84,7 @@ def main():
     parser.add_argument('--original_author_data', default='../../data/mined_tweets/loanword_verb_posts_CLUSTER=twitter_posts_STARTDATE=2017_7_9_ENDDATE=2019_4_6.tsv')
     parser.add_argument('--out_dir', default='../../data/mined_tweets/loanword_author_tweets_all_archives/')
     parser.add_argument('--file_matcher', default='.*_tweets.gz')
+    parser.add_argument('--timeline_store_dir', default=None) # ../../data/mined_tweets/loanword_author_tweets_all_archives_timelines/
     args = vars(parser.parse_args())
     logging_file = '../../output/combine_collected_tweets_from_authors.txt'
     if(os.path.exists(logging_file)):
@@ -108,6 +110,15 @@ def main():
     lang_id_data.drop_duplicates('id', inplace=True)
     lang_id_data_file = os.path.join(out_dir, 'lang_id.gz')
     lang_id_data.to_csv(lang_id_data_file, sep='\t', compression='gzip', index=False)
+    # binary store for fast ID lookup; langid probabilities => percent scores
+    lang_id_store_dir = get_lang_id_store_dir(lang_id_data_file)
+    write_lang_id_store(lang_id_store_dir, lang_id_data.loc[:, 'id'].values, lang_id_data.loc[:, 'lang'].values, lang_id_data.loc[:, 'lang_score'].values, score_scale=100)
+    logging.info('wrote lang ID store %s'%(lang_id_store_dir))
+    # optional: columnar timeline store for fast loading
+    if(args.get('timeline_store_dir') is not None):
+        combined_files = get_all_files(out_dir, file_matcher)
+        post_ctr = build_author_timeline_store(combined_files, args['timeline_store_dir'], lang_id_data=lang_id_data)
+        logging.info('wrote %d posts to timeline store %s'%(post_ctr, args['timeline_store_dir']))
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -11,20 +11,35 @@ import os
 import gzip
 from bz2 import BZ2File
 import lzma
-from zstd import ZSTD_uncompress
-# old
-# from zstd import ZstdDecompressor
+from zstd import ZSTD_uncompress, ZSTD_compress
+# optional: streaming zst decompression without zstd command
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import subprocess
+import shutil
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+import json
 from math import ceil, floor
-from functools import reduce
-from itertools import product
+from functools import reduce, partial
+from collections import deque, OrderedDict
+import hashlib
+import zlib
+import sqlite3
+from array import array
+from itertools import product, islice
 import scipy
 import scipy.sparse
 from scipy.stats import wilcoxon
 from pattern.es import conjugate, INFINITIVE, PRESENT, PRETERITE, FUTURE, SINGULAR, PLURAL, FIRST, SECOND, THIRD
 from emoji import UNICODE_EMOJI
 from elasticsearch import Elasticsearch
-from time import sleep
+from time import sleep, time
 import numpy as np
 import pandas as pd
 import twitter
@@ -37,6 +52,18 @@ from datetime import datetime, timedelta
 import calendar
 from pandarallel import pandarallel
 import langid
+# optional: faster lang ID
+try:
+    import cld2
+except ImportError:
+    cld2 = None
+# optional: parquet output
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None
 
 class StanfordTaggerWrapper:
     """
@@ -125,6 +152,202 @@ def clean_txt_emojis(txt):
     txt = EMOJI_MATCHER.sub(' ', txt)
     return txt
 
+## phrase matching
+class PhraseMatcher:
+    """
+    Match many literal phrases in text with a single
+    Aho-Corasick automaton, instead of one giant regex
+    alternation (which re tries phrase-by-phrase at every position).
+    Matches must start and end at a token boundary, i.e.
+    next to one of boundary_chars or at the start/end of text.
+
+    Overlapping candidates are resolved like a regex alternation:
+    scan left to right, at each position keep the first phrase
+    in list order, and resume the scan after the match.
+    Like the lookahead alternation in mine_tweets, phrases followed
+    by a boundary char win over phrases that end the text.
+    """
+    def __init__(self, phrases, boundary_chars=',.! #', match_start=True, match_end=True):
+        """
+        :param phrases: literal phrases to match (first listed = highest priority)
+        :param boundary_chars: characters that separate tokens
+        :param match_start: allow matches at start of text
+        :param match_end: allow matches at end of text
+        """
+        # drop duplicate/empty phrases, keep priority order
+        self.phrases = []
+        phrase_idx_lookup = {}
+        for phrase in phrases:
+            if(phrase != '' and phrase not in phrase_idx_lookup):
+                phrase_idx_lookup[phrase] = len(self.phrases)
+                self.phrases.append(phrase)
+        self.boundary_chars = set(boundary_chars)
+        self.match_start = match_start
+        self.match_end = match_end
+        self.build_automaton()
+
+    def build_automaton(self):
+        """
+        Build trie over phrases, then add failure links
+        and merged outputs with breadth-first search.
+        """
+        # node = index into goto/fail/outputs
+        # outputs = list of (phrase length, phrase index)
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for phrase_idx, phrase in enumerate(self.phrases):
+            node = 0
+            for c in phrase:
+                next_node = self.goto[node].get(c)
+                if(next_node is None):
+                    next_node = len(self.goto)
+                    self.goto[node][c] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append((len(phrase), phrase_idx))
+        queue = deque(self.goto[0].values())
+        while(len(queue) > 0):
+            node = queue.popleft()
+            for c, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail_node = self.fail[node]
+                while(fail_node > 0 and c not in self.goto[fail_node]):
+                    fail_node = self.fail[fail_node]
+                self.fail[next_node] = self.goto[fail_node].get(c, 0)
+                self.outputs[next_node] = self.outputs[next_node] + self.outputs[self.fail[next_node]]
+
+    def find_candidates(self, txt):
+        """
+        Find all phrase occurrences in text that start and end
+        at a token boundary.
+
+        :param txt: text
+        :returns candidates:: list of (start, end, priority, phrase index)
+        """
+        candidates = []
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        boundary_chars = self.boundary_chars
+        txt_len = len(txt)
+        node = 0
+        for i, c in enumerate(txt):
+            while(node > 0 and c not in goto[node]):
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if(len(outputs[node]) > 0):
+                end = i + 1
+                if(end == txt_len):
+                    if(not self.match_end):
+                        continue
+                    end_priority = 1
+                elif(txt[end] in boundary_chars):
+                    end_priority = 0
+                else:
+                    continue
+                for phrase_len, phrase_idx in outputs[node]:
+                    start = end - phrase_len
+                    if(start == 0):
+                        valid_start = self.match_start
+                    else:
+                        valid_start = txt[start-1] in boundary_chars
+                    if(valid_start):
+                        candidates.append((start, end, end_priority, phrase_idx))
+        return candidates
+
+    def finditer(self, txt, overlap=False):
+        """
+        Iterate over phrase matches in text.
+
+        :param txt: text
+        :param overlap: return all overlapping matches, rather than the non-overlapping regex-style matches
+        :returns match:: (start, end, phrase) for each match
+        """
+        candidates = self.find_candidates(txt)
+        if(overlap):
+            candidates.sort(key=lambda x: (x[0], x[2], x[3]))
+            for start, end, end_priority, phrase_idx in candidates:
+                yield (start, end, self.phrases[phrase_idx])
+        else:
+            # best candidate per start position
+            start_candidates = {}
+            for candidate in candidates:
+                start = candidate[0]
+                if(start not in start_candidates or candidate[2:] < start_candidates[start][2:]):
+                    start_candidates[start] = candidate
+            prev_end = 0
+            for start in sorted(start_candidates):
+                if(start >= prev_end):
+                    start, end, end_priority, phrase_idx = start_candidates[start]
+                    prev_end = end
+                    yield (start, end, self.phrases[phrase_idx])
+
+    def findall(self, txt, overlap=False):
+        """
+        Find all matching phrases in text.
+        """
+        phrase_matches = [phrase for start, end, phrase in self.finditer(txt, overlap=overlap)]
+        return phrase_matches
+
+    def search(self, txt):
+        """
+        Return first matching phrase in text, or None.
+        """
+        phrase_match = next(self.finditer(txt), None)
+        if(phrase_match is not None):
+            phrase_match = phrase_match[2]
+        return phrase_match
+
+def expand_phrase_pattern(phrase_pattern):
+    """
+    Expand simple phrase pattern into all literal phrases
+    for PhraseMatcher, e.g. "(hago|hice) (un )?tweet" =>
+    ["hago un tweet", "hago tweet", "hice un tweet", "hice tweet"].
+    Supports groups with alternatives "(a|b)" and
+    optional groups/characters "?", as written by generate_loanword_phrases.
+
+    :param phrase_pattern: phrase pattern
+    :returns phrases:: literal phrases
+    """
+    def expand_alternatives(i):
+        # returns (phrases, next index) for alternatives up to ")" or end
+        alternatives = []
+        phrases = ['']
+        while(i < len(phrase_pattern) and phrase_pattern[i] != ')'):
+            c = phrase_pattern[i]
+            if(c == '|'):
+                alternatives += phrases
+                phrases = ['']
+                i += 1
+                continue
+            if(c == '('):
+                item_phrases, i = expand_alternatives(i+1)
+                # skip ")"
+                i += 1
+            elif(c == '\\' and i+1 < len(phrase_pattern)):
+                item_phrases = [phrase_pattern[i+1]]
+                i += 2
+            else:
+                item_phrases = [c]
+                i += 1
+            if(i < len(phrase_pattern) and phrase_pattern[i] == '?'):
+                item_phrases = item_phrases + ['']
+                i += 1
+            phrases = [x+y for x in phrases for y in item_phrases]
+        alternatives += phrases
+        return alternatives, i
+    phrases, i = expand_alternatives(0)
+    # collapse extra spaces from optional items
+    space_matcher = re.compile('\s{2,}')
+    phrases = list(map(lambda x: space_matcher.sub(' ', x).strip(), phrases))
+    phrases = list(filter(lambda x: x != '', phrases))
+    # deduplicate, keep order
+    phrases = list(dict.fromkeys(phrases))
+    return phrases
+
 class BasicCounter:
     def __init__(self):
         self.counter = 0
@@ -251,34 +474,37 @@ def tag_sents_tweet_NLP(sents, tag_type='serial', tag_file_suffix=''):
         tagged_sents = tag_sents_tweet_NLP_raw(sents)
     return tagged_sents
 
-class ZstdWrapper(object):
-    
-    def __init__(self, f_name):
-        # TODO: update to ZSTD_uncompress
-        self.decomp = ZstdDecompressor()
-        self.f_iter = self.decomp.stream_reader(open(f_name, 'rb'))
-        self.prev_line = ""
-        self.CHUNK_SIZE = 65536 # may have to increase to 2**24 to avoid messing up giant comments
-    
-    def __iter__(self):
-        return self
+## reading compressed files
+# command-line (de)compression tools, fastest first
+# parallel tools use multiple threads for decompression/IO
+DECOMPRESS_COMMANDS = {
+    'gz' : [['pigz', '-dc', '-p', '{threads}'], ['gzip', '-dc']],
+    'bz2' : [['lbzip2', '-dc', '-n', '{threads}'], ['pbzip2', '-dc', '-p{threads}'], ['bzip2', '-dc']],
+    'xz' : [['xz', '-dc', '-T', '{threads}']],
+    # Reddit dumps are compressed with long windows
+    'zst' : [['pzstd', '-dc', '-p', '{threads}'], ['zstd', '-dc', '--long=31']],
+}
+def open_decompressed_stream(file_name, use_external=True, threads=4):
+    """
+    Open binary stream of decompressed data from gz, bz2, xz, zst file.
+    Use (parallel) command-line decompression if available,
+    otherwise Python decompression.
     
-    def __next__(self):
-        chunk = self.f_iter.read(self.CHUNK_SIZE)
-        if(not chunk):
-            raise StopIteration
-        else:
-            str_data = chunk.decode('utf-8')
-            lines = str_data.split('\n')
-            lines_clean = [self.prev_line + lines[0]] + lines[1:-1]
-            self.prev_line = lines[-1]
-            return lines_clean
-        
-def get_file_iter(file_name):
-    """
-    Get file iterator for different types: gz, bz2, xz, zst.
+    :param file_name: compressed file name
+    :param use_external: try command-line decompression tools first
+    :param threads: threads for parallel decompression tools
+    :returns file_input:: binary file object
+    :returns process:: decompression process (None for Python decompression)
     """
     file_name_ext = os.path.splitext(file_name)[-1][1:]
+    if(file_name_ext not in DECOMPRESS_COMMANDS):
+        raise Exception('unsupported file compression %s'%(file_name))
+    if(use_external):
+        for command in DECOMPRESS_COMMANDS[file_name_ext]:
+            if(shutil.which(command[0]) is not None):
+                command = list(map(lambda x: x.format(threads=threads), command)) + [file_name]
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=2**20)
+                return process.stdout, process
     if(file_name_ext == 'gz'):
         file_input = gzip.open(file_name)
     elif(file_name_ext == 'bz2'):
@@ -286,9 +512,376 @@ def get_file_iter(file_name):
     elif(file_name_ext == 'xz'):
         file_input = lzma.open(file_name)
     elif(file_name_ext == 'zst'):
-        file_input = ZstdWrapper(file_name) # WARNING returns list of lines to process
+        if(zstandard is None):
+            raise Exception('need zstd command or zstandard module to read %s'%(file_name))
+        decomp = zstandard.ZstdDecompressor(max_window_size=2**31)
+        file_input = decomp.stream_reader(open(file_name, 'rb'), closefd=True)
+    return file_input, None
+
+class FileLineReader:
+    """
+    Read compressed file as batches of complete lines (bytes).
+    We read large chunks of decompressed bytes and split on newlines,
+    carrying the partial last line over to the next chunk, so lines
+    (and multibyte characters) are never split between batches.
+    offset = decompressed bytes up to the end of the last line returned.
+    """
+    def __init__(self, file_name, buffer_size=2**24, use_external=True, threads=4):
+        """
+        :param file_name: compressed file name (gz, bz2, xz, zst)
+        :param buffer_size: bytes to read per batch
+        :param use_external: try command-line decompression tools first
+        :param threads: threads for parallel decompression tools
+        """
+        self.file_name = file_name
+        self.buffer_size = buffer_size
+        self.file_input, self.process = open_decompressed_stream(file_name, use_external=use_external, threads=threads)
+        self.prev_line = b''
+        self.bytes_read = 0
+    
+    @property
+    def offset(self):
+        return self.bytes_read - len(self.prev_line)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        while(True):
+            chunk = self.file_input.read(self.buffer_size)
+            if(not chunk):
+                self.check_process()
+                if(self.prev_line != b''):
+                    lines = [self.prev_line]
+                    self.prev_line = b''
+                    return lines
+                raise StopIteration
+            self.bytes_read += len(chunk)
+            lines = chunk.split(b'\n')
+            lines[0] = self.prev_line + lines[0]
+            self.prev_line = lines.pop()
+            # keep reading if chunk had no complete line
+            if(len(lines) > 0):
+                return lines
+    
+    def check_process(self):
+        """
+        Warn if decompression process failed, e.g. corrupt file.
+        """
+        if(self.process is not None and self.process.wait() != 0):
+            logging.warning('decompression of %s exited with code %d'%(self.file_name, self.process.returncode))
+    
+    def close(self):
+        self.file_input.close()
+        if(self.process is not None and self.process.poll() is None):
+            self.process.terminate()
+            self.process.wait()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def get_file_iter(file_name, buffer_size=2**24, use_external=True, threads=4):
+    """
+    Get file iterator for different types: gz, bz2, xz, zst.
+    Iterator yields batches (lists) of complete lines (bytes).
+    
+    :param file_name: compressed file name
+    :param buffer_size: bytes to read per batch
+    :param use_external: use (parallel) command-line decompression if available
+    :param threads: threads for parallel decompression tools
+    """
+    file_input = FileLineReader(file_name, buffer_size=buffer_size, use_external=use_external, threads=threads)
     return file_input
 
+class CompressedFileWriter:
+    """
+    Stream text lines into gz or zst file.
+    Lines are buffered and compressed in bounded batches,
+    so memory stays flat no matter how much we write.
+    zst batches are written as separate frames, and appending
+    to gz files adds a new member: both still read as one stream.
+    """
+    DEFAULT_COMPRESS_LEVELS = {'gz' : 6, 'zst' : 3}
+
+    def __init__(self, file_name, compress_level=None, batch_size=2**22, append=False):
+        """
+        :param file_name: output file name (.gz or .zst)
+        :param compress_level: compression level (default: 6 for gz, 3 for zst)
+        :param batch_size: max buffered bytes before compressing and writing
+        :param append: append to existing file instead of overwriting
+        """
+        self.file_name = file_name
+        self.file_ext = os.path.splitext(file_name)[-1][1:]
+        if(self.file_ext not in self.DEFAULT_COMPRESS_LEVELS):
+            raise Exception('unsupported output compression %s'%(file_name))
+        if(compress_level is None):
+            compress_level = self.DEFAULT_COMPRESS_LEVELS[self.file_ext]
+        self.compress_level = compress_level
+        self.batch_size = batch_size
+        file_mode = 'ab' if append else 'wb'
+        if(self.file_ext == 'gz'):
+            self.file_output = gzip.open(file_name, file_mode, compresslevel=compress_level)
+        else:
+            self.file_output = open(file_name, file_mode)
+        self.batch = []
+        self.batch_bytes = 0
+
+    def write(self, txt):
+        txt_bytes = txt.encode('utf-8')
+        self.batch.append(txt_bytes)
+        self.batch_bytes += len(txt_bytes)
+        if(self.batch_bytes >= self.batch_size):
+            self.flush()
+
+    def flush(self):
+        if(self.batch_bytes > 0):
+            batch_data = b''.join(self.batch)
+            if(self.file_ext == 'zst'):
+                batch_data = ZSTD_compress(batch_data, self.compress_level)
+            self.file_output.write(batch_data)
+        self.batch = []
+        self.batch_bytes = 0
+
+    def checkpoint(self):
+        """
+        Write everything buffered as complete gz members/zst frames,
+        and return file size. Truncating the file to this size
+        later (e.g. when resuming a job) leaves only complete records.
+        """
+        self.flush()
+        if(self.file_ext == 'gz'):
+            # end the current member; the next write starts a new one
+            self.file_output.close()
+            file_size = os.path.getsize(self.file_name)
+            self.file_output = gzip.open(self.file_name, 'ab', compresslevel=self.compress_level)
+        else:
+            self.file_output.flush()
+            file_size = os.path.getsize(self.file_name)
+        return file_size
+
+    def close(self):
+        self.flush()
+        self.file_output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+## progress journal
+def get_out_file_sizes(out_files):
+    return {out_file : os.path.getsize(out_file) for out_file in out_files if os.path.exists(out_file)}
+
+def truncate_out_files(out_files, out_file_sizes):
+    """
+    Roll back output files to sizes from a checkpoint:
+    files without a recorded size are removed.
+    """
+    for out_file in out_files:
+        if(out_file in out_file_sizes):
+            if(os.path.exists(out_file)):
+                with open(out_file, 'r+b') as file_output:
+                    file_output.truncate(out_file_sizes[out_file])
+        elif(os.path.exists(out_file)):
+            os.remove(out_file)
+
+class ProgressJournal:
+    """
+    Append-only JSON-lines journal of per-input-file progress:
+    completed status, or records processed + compressed offset
+    + output file sizes at the last checkpoint.
+    The latest line for each input file wins. Lines are short,
+    so several worker processes can append to the same journal.
+    """
+    
+    def __init__(self, journal_file, config=None):
+        """
+        :param journal_file: journal file name
+        :param config: run configuration (JSON-serializable); a journal
+        written with a different configuration is discarded
+        """
+        self.journal_file = journal_file
+        self.config_hash = hashlib.md5(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        self.progress = {}
+        if(os.path.exists(journal_file)):
+            journal_config_hash = None
+            with open(journal_file, 'r') as journal_input:
+                for l in journal_input:
+                    try:
+                        entry = json.loads(l)
+                    except ValueError:
+                        # partially-written last line
+                        continue
+                    if('config_hash' in entry):
+                        journal_config_hash = entry['config_hash']
+                    else:
+                        self.progress[entry['input_file']] = entry
+            if(journal_config_hash != self.config_hash):
+                logging.debug('journal %s has different configuration; starting over'%(journal_file))
+                self.reset()
+        else:
+            self.reset()
+    
+    def reset(self):
+        self.progress = {}
+        with open(self.journal_file, 'w') as journal_output:
+            journal_output.write('%s\n'%(json.dumps({'config_hash' : self.config_hash})))
+    
+    def get(self, input_file):
+        return self.progress.get(input_file)
+    
+    def is_complete(self, input_file):
+        entry = self.progress.get(input_file)
+        return entry is not None and entry['status'] == 'completed'
+    
+    def record(self, input_file, status, records=0, offset=None, out_file_sizes=None):
+        """
+        Record progress for input file.
+        
+        :param input_file: input file
+        :param status: partial or completed
+        :param records: input records processed
+        :param offset: compressed input offset
+        :param out_file_sizes: output file => size at checkpoint
+        """
+        entry = {'input_file' : input_file, 'status' : status, 'records' : records, 'offset' : offset, 'out_file_sizes' : out_file_sizes or {}}
+        self.progress[input_file] = entry
+        with open(self.journal_file, 'a') as journal_output:
+            journal_output.write('%s\n'%(json.dumps(entry)))
+            journal_output.flush()
+            os.fsync(journal_output.fileno())
+
+## JSON decoding
+# optional faster JSON backends
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+# records that we never mine (deleted/withheld tweets)
+SKIP_RECORD_PREFIXES = (b'{"delete"', b'{"status_withheld"', b'{"user_withheld"')
+SKIP_RECORD_KEYS = ['delete', 'status_withheld', 'user_withheld']
+class JSONLineDecoder:
+    """
+    Decode JSON lines from archive files.
+    1. Skip deleted/withheld records with a byte-prefix check before parsing.
+    2. Parse with faster backend if installed (orjson, simdjson), else stdlib json.
+    3. With lazy parser (simdjson), only convert the fields that we need
+    to Python objects, e.g. fields=['text', 'user.location'] returns
+    {'text' : ..., 'user' : {'location' : ...}}.
+    """
+    def __init__(self, backend='json', fields=None, skip_prefixes=SKIP_RECORD_PREFIXES):
+        """
+        :param backend: JSON backend {"json", "orjson", "simdjson", "auto"}
+        :param fields: fields to extract (nested fields separated by "."); None = all
+        :param skip_prefixes: byte prefixes of records to skip without parsing
+        """
+        if(backend == 'auto'):
+            if(simdjson is not None):
+                backend = 'simdjson'
+            elif(orjson is not None):
+                backend = 'orjson'
+            else:
+                backend = 'json'
+        if((backend == 'simdjson' and simdjson is None) or (backend == 'orjson' and orjson is None)):
+            logging.warning('JSON backend %s not installed; falling back to json'%(backend))
+            backend = 'json'
+        self.backend = backend
+        self.lazy = (backend == 'simdjson' and fields is not None)
+        if(fields is not None):
+            self.field_tuples = list(map(lambda x: tuple(x.split('.')), fields))
+        self.skip_prefixes = tuple(skip_prefixes)
+        self.skip_prefixes_str = tuple(map(lambda x: x.decode('utf-8'), self.skip_prefixes))
+        if(backend == 'simdjson'):
+            self.parser = simdjson.Parser()
+
+    def skip_line(self, line):
+        """
+        Cheap check for records to skip, before parsing.
+        """
+        if(type(line) is bytes):
+            skip = line.lstrip().startswith(self.skip_prefixes)
+        else:
+            skip = line.lstrip().startswith(self.skip_prefixes_str)
+        return skip
+
+    def parse(self, line):
+        if(self.backend == 'orjson'):
+            data = orjson.loads(line)
+        elif(self.backend == 'simdjson'):
+            if(type(line) is str):
+                line = line.encode('utf-8')
+            data = self.parser.parse(line)
+        else:
+            data = json.loads(line)
+        return data
+
+    def convert(self, val):
+        """
+        Convert lazy simdjson values to Python objects.
+        """
+        if(isinstance(val, simdjson.Object)):
+            val = val.as_dict()
+        elif(isinstance(val, simdjson.Array)):
+            val = val.as_list()
+        return val
+
+    def extract_fields(self, data):
+        """
+        Extract requested fields into a (nested) dict.
+        Missing fields are left out, like they are in the full record.
+        """
+        data_fields = {}
+        missing = object()
+        for field_tuple in self.field_tuples:
+            parent = data
+            for key in field_tuple[:-1]:
+                parent = parent.get(key, missing)
+                if(parent is missing or parent is None or not hasattr(parent, 'get')):
+                    parent = missing
+                    break
+            if(parent is not missing):
+                data_fields_i = data_fields
+                for key in field_tuple[:-1]:
+                    data_fields_i = data_fields_i.setdefault(key, {})
+                val = parent.get(field_tuple[-1], missing)
+                if(val is not missing):
+                    data_fields_i[field_tuple[-1]] = self.convert(val)
+        return data_fields
+
+    def decode(self, line):
+        """
+        Decode line.
+
+        :param line: JSON line (bytes or str)
+        :returns data:: decoded data, or None if record should be skipped
+        """
+        if(self.skip_line(line)):
+            return None
+        data = self.parse(line)
+        # in case record does not start with the skip key
+        if(any(data.get(skip_key) is not None for skip_key in SKIP_RECORD_KEYS)):
+            return None
+        if(self.lazy):
+            data = self.extract_fields(data)
+        return data
+
+    def decode_full(self, line):
+        """
+        Decode full record, e.g. to write it to file after matching.
+        """
+        data = self.parse(line)
+        if(self.backend == 'simdjson'):
+            data = data.as_dict()
+        return data
+
 ## sparse matrix
 def save_sparse_matrix_rows_cols(data, out_file_name, row_idx_lookup, col_idx_lookup):
     """
@@ -407,9 +1000,325 @@ def remove_ambiguous_verb_forms(verb_forms):
 #     light_verb_forms = list(map(lambda x: ' '.join([x, non_verb_str]), verb_forms))
 #     return light_verb_forms
   
-def start_es_instance(es_year, es_start_month, es_end_month, es_cluster_name, es_base_dir='/hg190/elastic_search/'):
+## ES instance management
+## one ES process per year-month index; poll health instead of sleeping,
+## keep instances alive on separate ports and reuse them across queries/scripts
+ES_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'june', 'july', 'aug', 'sep', 'oct', 'nov', 'dec']
+ES_INSTANCE_REGISTRY = os.path.expanduser('~/.es_instances.json')
+def get_es_instance_name(es_year, es_start_month, es_end_month, es_cluster_name):
+    return '%s_%d_m_%d_%d'%(es_cluster_name, es_year, es_start_month, es_end_month)
+
+def get_es_instance_dir(es_year, es_start_month, es_end_month, es_dir):
+    """
+    Get ES bin directory for year-month index,
+    e.g. es_dir/2018/jul-sep-2018/elasticsearch-2.1.1/bin
     """
-    Start running ES instance in the background.
+    es_start_month_str = ES_MONTHS[es_start_month-1]
+    es_end_month_str = ES_MONTHS[es_end_month-1]
+    return os.path.join(es_dir, str(es_year), '%s-%s-%d'%(es_start_month_str, es_end_month_str, es_year), 'elasticsearch-2.1.1/bin')
+
+def get_es_health(es_port, es_instance_name=None, wait_sec=10):
+    """
+    Get cluster (or index) health status from ES on port:
+    "green", "yellow", "red", or None if ES is not up.
+    """
+    es_health_url = 'http://localhost:%d/_cluster/health'%(es_port)
+    if(es_instance_name is not None):
+        es_health_url = '%s/%s'%(es_health_url, es_instance_name)
+    try:
+        es_health = requests.get(es_health_url, params={'wait_for_status' : 'yellow', 'timeout' : '%ds'%(wait_sec)}, timeout=wait_sec+5).json()
+        return es_health.get('status')
+    except Exception as e:
+        return None
+
+def is_port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as port_socket:
+        return port_socket.connect_ex(('localhost', port)) != 0
+
+def is_process_running(pid):
+    # reap our own exited child, otherwise it looks alive
+    try:
+        if(os.waitpid(pid, os.WNOHANG)[0] == pid):
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+class ESInstance:
+    """
+    ES process serving one year-month index on its own HTTP port.
+    Transport port is separate and nodes only ping themselves,
+    so instances with the same cluster name don't join each other.
+    """
+    def __init__(self, es_instance_name, es_instance_dir, es_cluster_name, es_port, process=None, pid=None):
+        self.es_instance_name = es_instance_name
+        self.es_instance_dir = es_instance_dir
+        self.es_cluster_name = es_cluster_name
+        self.es_port = es_port
+        self.process = process
+        self.pid = pid if process is None else process.pid
+    
+    def start(self):
+        es_transport_port = self.es_port + 100
+        es_command = './elasticsearch -Des.http.port=%d -Des.transport.tcp.port=%d -Des.discovery.zen.ping.unicast.hosts=localhost:%d --cluster.name %s --node.name %s'%(self.es_port, es_transport_port, es_transport_port, self.es_cluster_name, self.es_instance_name)
+        self.process = subprocess.Popen(es_command.split(' '), cwd=self.es_instance_dir, stdout=subprocess.DEVNULL)
+        self.pid = self.process.pid
+    
+    def is_running(self):
+        if(self.process is not None):
+            return self.process.poll() is None
+        return self.pid is not None and is_process_running(self.pid)
+    
+    def wait_until_ready(self, timeout=600, poll_interval=2):
+        """
+        Poll health until index is available (yellow/green):
+        open index when cluster is up (index may have been closed).
+        """
+        start_time = time()
+        index_opened = False
+        while(time() - start_time < timeout):
+            if(not self.is_running()):
+                raise Exception('ES instance %s exited during startup'%(self.es_instance_name))
+            if(not index_opened):
+                if(get_es_health(self.es_port, wait_sec=poll_interval) is not None):
+                    try:
+                        requests.post('http://localhost:%d/%s/_open'%(self.es_port, self.es_instance_name), timeout=60)
+                    except Exception as e:
+                        logging.debug('error opening index %s = %s'%(self.es_instance_name, e))
+                    index_opened = True
+                else:
+                    sleep(poll_interval)
+                continue
+            if(get_es_health(self.es_port, es_instance_name=self.es_instance_name, wait_sec=poll_interval) in {'yellow', 'green'}):
+                logging.debug('ES instance %s ready on port %d after %.1f sec'%(self.es_instance_name, self.es_port, time() - start_time))
+                return
+        raise Exception('ES instance %s not ready after %d sec'%(self.es_instance_name, timeout))
+    
+    def is_ready(self):
+        return self.is_running() and get_es_health(self.es_port, es_instance_name=self.es_instance_name, wait_sec=1) in {'yellow', 'green'}
+    
+    def get_client(self, timeout=100, maxsize=10):
+        return Elasticsearch([{'host' : 'localhost', 'port' : self.es_port}], timeout=timeout, maxsize=maxsize)
+    
+    def stop(self, timeout=120):
+        """
+        Stop ES process: SIGTERM (clean shutdown), then SIGKILL after timeout.
+        """
+        if(not self.is_running()):
+            return
+        if(self.process is not None):
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        else:
+            os.kill(self.pid, signal.SIGTERM)
+            start_time = time()
+            while(is_process_running(self.pid) and time() - start_time < timeout):
+                sleep(1)
+            if(is_process_running(self.pid)):
+                os.kill(self.pid, signal.SIGKILL)
+        logging.debug('stopped ES instance %s on port %d'%(self.es_instance_name, self.es_port))
+
+class ESInstanceManager:
+    """
+    Start ES instances on demand, keep up to max_instances alive
+    on separate ports (least recently used are stopped first),
+    and reuse them across queries. With keep_alive=True,
+    instances stay up after close() and are listed in a registry file,
+    so later scripts in the same session attach to them instead of starting over.
+    Thread-safe: different indices start up in parallel, and
+    pinned instances (pin=True, until checkin) are never stopped to make room.
+    """
+    def __init__(self, es_cluster_name='reddit_comments', es_base_dir='/hg190/elastic_search/', es_dir=None, base_port=9200, max_instances=4, keep_alive=False, registry_file=ES_INSTANCE_REGISTRY, startup_timeout=600):
+        """
+        :param es_cluster_name: ES cluster name ("reddit_comments" or "twitter_posts")
+        :param es_base_dir: ES base directory
+        :param es_dir: ES instance directory (default es_base_dir/es_instances_for_<cluster name>)
+        :param base_port: first HTTP port to use
+        :param max_instances: max instances running at once
+        :param keep_alive: leave instances running after close()
+        :param registry_file: registry of running instances, shared across scripts
+        :param startup_timeout: max seconds to wait for instance
+        """
+        self.es_cluster_name = es_cluster_name
+        if(es_dir is None):
+            es_dir = os.path.join(es_base_dir, 'es_instances_for_%s'%(es_cluster_name))
+        self.es_dir = es_dir
+        self.base_port = base_port
+        self.max_instances = max_instances
+        self.keep_alive = keep_alive
+        self.registry_file = registry_file
+        self.startup_timeout = startup_timeout
+        # running instances, least recently used first
+        self.instances = OrderedDict()
+        self.started_instances = set()
+        # pinned instance counts; lock guards instances/registry,
+        # per-index locks make sure only one thread starts each index
+        self.in_use = {}
+        self.lock = threading.Condition(threading.RLock())
+        self.index_locks = {}
+    
+    def load_registry(self):
+        if(self.registry_file is None or not os.path.exists(self.registry_file)):
+            return {}
+        try:
+            with open(self.registry_file, 'r') as registry_input:
+                return json.load(registry_input)
+        except ValueError:
+            return {}
+    
+    def save_registry(self, registry):
+        if(self.registry_file is None):
+            return
+        with open(self.registry_file, 'w') as registry_output:
+            json.dump(registry, registry_output)
+    
+    def update_registry(self):
+        # drop stopped instances, add ours
+        registry = {k : v for k, v in self.load_registry().items() if is_process_running(v['pid'])}
+        for es_instance_name, es_instance in self.instances.items():
+            registry[es_instance_name] = {'port' : es_instance.es_port, 'pid' : es_instance.pid, 'cluster_name' : es_instance.es_cluster_name}
+        self.save_registry(registry)
+    
+    def release(self, es_instance_name):
+        # only stop instances that we started
+        es_instance = self.instances.pop(es_instance_name)
+        if(es_instance_name in self.started_instances):
+            es_instance.stop()
+            self.started_instances.remove(es_instance_name)
+    
+    def get_free_port(self):
+        used_ports = set([v['port'] for v in self.load_registry().values()]) | set([x.es_port for x in self.instances.values()])
+        es_port = self.base_port
+        while(es_port in used_ports or not is_port_free(es_port) or not is_port_free(es_port + 100)):
+            es_port += 1
+        return es_port
+    
+    def pin(self, es_instance_name):
+        self.in_use[es_instance_name] = self.in_use.get(es_instance_name, 0) + 1
+    
+    def checkin(self, es_instance_name):
+        """
+        Unpin instance returned by get_instance(..., pin=True).
+        """
+        with self.lock:
+            self.in_use[es_instance_name] -= 1
+            if(self.in_use[es_instance_name] == 0):
+                self.in_use.pop(es_instance_name)
+            self.lock.notify_all()
+    
+    def make_room(self):
+        # stop least recently used unpinned instance, or wait for checkin
+        while(len(self.instances) >= self.max_instances):
+            idle_instance_names = [x for x in self.instances.keys() if x not in self.in_use]
+            if(len(idle_instance_names) > 0):
+                self.release(idle_instance_names[0])
+            else:
+                self.lock.wait()
+    
+    def get_instance(self, es_year, es_start_month, es_end_month, pin=False):
+        """
+        Get running instance for year-month index: reuse ours
+        or one registered by another script, else start new one.
+        
+        :param pin: keep instance from being stopped until checkin()
+        """
+        es_instance_name = get_es_instance_name(es_year, es_start_month, es_end_month, self.es_cluster_name)
+        es_instance_dir = get_es_instance_dir(es_year, es_start_month, es_end_month, self.es_dir)
+        with self.lock:
+            index_lock = self.index_locks.setdefault(es_instance_name, threading.Lock())
+        with index_lock:
+            with self.lock:
+                if(es_instance_name in self.instances):
+                    es_instance = self.instances[es_instance_name]
+                    if(es_instance.is_running()):
+                        self.instances.move_to_end(es_instance_name)
+                        if(pin):
+                            self.pin(es_instance_name)
+                        return es_instance
+                    self.instances.pop(es_instance_name)
+                    self.started_instances.discard(es_instance_name)
+                registry = self.load_registry()
+            if(es_instance_name in registry):
+                registry_info = registry[es_instance_name]
+                es_instance = ESInstance(es_instance_name, es_instance_dir, self.es_cluster_name, registry_info['port'], pid=registry_info['pid'])
+                if(es_instance.is_ready()):
+                    logging.debug('reusing ES instance %s on port %d'%(es_instance_name, es_instance.es_port))
+                    with self.lock:
+                        self.instances[es_instance_name] = es_instance
+                        if(pin):
+                            self.pin(es_instance_name)
+                    return es_instance
+            with self.lock:
+                self.make_room()
+                es_instance = ESInstance(es_instance_name, es_instance_dir, self.es_cluster_name, self.get_free_port())
+                logging.debug('starting ES instance %s on port %d'%(es_instance_name, es_instance.es_port))
+                es_instance.start()
+                # claim slot + ports while waiting outside lock
+                self.instances[es_instance_name] = es_instance
+                self.started_instances.add(es_instance_name)
+                self.pin(es_instance_name)
+            try:
+                es_instance.wait_until_ready(timeout=self.startup_timeout)
+            except Exception as e:
+                with self.lock:
+                    self.instances.pop(es_instance_name, None)
+                    self.started_instances.discard(es_instance_name)
+                    self.checkin(es_instance_name)
+                es_instance.stop()
+                raise e
+            with self.lock:
+                self.update_registry()
+                if(not pin):
+                    self.checkin(es_instance_name)
+            return es_instance
+    
+    def get_client(self, es_year, es_start_month, es_end_month, timeout=100, maxsize=10, pin=False):
+        """
+        :returns es, es_instance_name:: ES client, index name
+        """
+        es_instance = self.get_instance(es_year, es_start_month, es_end_month, pin=pin)
+        return es_instance.get_client(timeout=timeout, maxsize=maxsize), es_instance.es_instance_name
+    
+    def stop_all(self):
+        """
+        Stop our instances and all registered instances for this cluster.
+        """
+        with self.lock:
+            for es_instance_name, registry_info in self.load_registry().items():
+                if(es_instance_name not in self.instances and registry_info['cluster_name'] == self.es_cluster_name):
+                    self.instances[es_instance_name] = ESInstance(es_instance_name, None, self.es_cluster_name, registry_info['port'], pid=registry_info['pid'])
+            for es_instance in self.instances.values():
+                es_instance.stop()
+            self.instances.clear()
+            self.started_instances.clear()
+            self.in_use.clear()
+            self.update_registry()
+    
+    def close(self):
+        with self.lock:
+            if(not self.keep_alive):
+                for es_instance_name in list(self.instances.keys()):
+                    self.release(es_instance_name)
+            self.update_registry()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def start_es_instance(es_year, es_start_month, es_end_month, es_cluster_name, es_base_dir='/hg190/elastic_search/', es_port=9200, timeout=600):
+    """
+    Start running ES instance in the background
+    and wait until index is available.
     Note: process must be terminated if program breaks!
     
     :param es_year: ES year
@@ -417,115 +1326,430 @@ def start_es_instance(es_year, es_start_month, es_end_month, es_cluster_name, es
     :param es_end_month: ES end month
     :param es_cluster_name: ES cluster name ("reddit_comments" or "twitter_posts")
     :param es_base_dir: ES base directory 
+    :param es_port: HTTP port
+    :param timeout: max seconds to wait for index
     """
-    months = ['jan', 'feb', 'mar', 'apr', 'may', 'june', 'july', 'aug', 'sep', 'oct', 'nov', 'dec']
-    ES_INITIALIZE_TIMEOUT = 300
     es_dir = os.path.join(es_base_dir, 'es_instances_for_%s'%(es_cluster_name))
-    es_instance_name = '%s_%d_m_%d_%d'%(es_cluster_name, es_year, es_start_month, es_end_month)
-    es_start_month_str = months[es_start_month-1]
-    es_end_month_str = months[es_end_month-1]
-    es_dir_full = os.path.join(es_dir, str(es_year), '%s-%s-%d'%(es_start_month_str, es_end_month_str, es_year), 'elasticsearch-2.1.1/bin')
-    es_command = './elasticsearch --cluster.name %s --node.name %s'%(es_cluster_name, es_instance_name)
-    process = subprocess.Popen(es_command.split(' '), cwd=es_dir_full)
+    es_instance_name = get_es_instance_name(es_year, es_start_month, es_end_month, es_cluster_name)
+    es_instance = ESInstance(es_instance_name, get_es_instance_dir(es_year, es_start_month, es_end_month, es_dir), es_cluster_name, es_port)
+    es_instance.start()
+    es_instance.wait_until_ready(timeout=timeout)
+    return es_instance.process
+
+def iter_scroll_pages(es, es_instance_name, es_query, MAX_SCROLL_SIZE=1000, keys_to_include=[], slice_id=None, max_slices=None, scroll='2m'):
+    """
+    Iterate over query result pages using Elasticsearch scroll,
+    one page in memory at a time. The scroll context is cleared
+    when iteration finishes or stops early.
+    
+    :param es_query: ES query
+    :param keys_to_include: only return these _source fields (filtered by ES)
+    :param slice_id: scroll slice ID (sliced scroll)
+    :param max_slices: total scroll slices
+    :param scroll: time to keep scroll context alive between pages
+    :returns: result hits per page
+    """
+    es_query = dict(es_query)
+    if(len(keys_to_include) > 0):
+        es_query['_source'] = keys_to_include
+    # cheapest order for scrolling
+    if('sort' not in es_query):
+        es_query['sort'] = ['_doc']
+    if(max_slices is not None and max_slices > 1):
+        es_query['slice'] = {'id' : slice_id, 'max' : max_slices}
+    scroll_id = None
     try:
-        sleep(ES_INITIALIZE_TIMEOUT)
+        res = es.search(index=es_instance_name, body=es_query, size=MAX_SCROLL_SIZE, scroll=scroll)
+        scroll_id = res.get('_scroll_id')
+        res_hits = res['hits']['hits']
+        while(len(res_hits) > 0):
+            yield res_hits
+            res = es.scroll(scroll_id=scroll_id, scroll=scroll)
+            scroll_id = res.get('_scroll_id')
+            res_hits = res['hits']['hits']
+    finally:
+        if(scroll_id is not None):
+            try:
+                es.clear_scroll(scroll_id=scroll_id)
+            except Exception as e:
+                logging.debug('could not clear scroll %s: %s'%(scroll_id, e))
+
+ES_SLICED_SCROLL_MIN_VERSION = 5
+def supports_sliced_scroll(es):
+    """
+    Check if ES server supports sliced scroll (ES >= 5.0).
+    """
+    try:
+        es_version = es.info()['version']['number']
+        return int(es_version.split('.')[0]) >= ES_SLICED_SCROLL_MIN_VERSION
     except Exception as e:
-        pass
-    return process
+        logging.warning('could not get ES version: %s'%(e))
+        return False
 
-def collect_scroll_results(es, es_instance_name, es_query, MAX_SCROLL_SIZE=1000, keys_to_include=[]):
+def iter_scroll_results(es, es_instance_name, es_query, MAX_SCROLL_SIZE=1000, keys_to_include=[], max_slices=1, queue_size=8, max_results=None):
+    """
+    Iterate over query results using Elasticsearch scroll.
+    With max_slices > 1, slices are scrolled in parallel threads
+    and results are returned as pages arrive (not in slice order).
+    Sliced scroll needs ES >= 5.0; older servers (e.g. our 2.1.1
+    instances) fall back to one scroll.
+    
+    :param es_query: ES query
+    :param keys_to_include: only return these _source fields (filtered by ES)
+    :param max_slices: scroll slices to run in parallel
+    :param queue_size: max pages waiting to be consumed
+    :param max_results: stop after this many results
+    :returns: result hits
+    """
+    if(max_results is not None):
+        results = iter_scroll_results(es, es_instance_name, es_query, MAX_SCROLL_SIZE=min(MAX_SCROLL_SIZE, max_results), keys_to_include=keys_to_include, max_slices=max_slices, queue_size=queue_size)
+        try:
+            for res_hit in islice(results, max_results):
+                yield res_hit
+        finally:
+            results.close()
+        return
+    if(max_slices > 1 and not supports_sliced_scroll(es)):
+        logging.warning('ES instance %s does not support sliced scroll, using one slice'%(es_instance_name))
+        max_slices = 1
+    if(max_slices <= 1):
+        for res_hits in iter_scroll_pages(es, es_instance_name, es_query, MAX_SCROLL_SIZE=MAX_SCROLL_SIZE, keys_to_include=keys_to_include):
+            for res_hit in res_hits:
+                yield res_hit
+        return
+    page_queue = Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    def put_page(page):
+        # give up when consumer stops early
+        while(not stop_event.is_set()):
+            try:
+                page_queue.put(page, timeout=1)
+                return True
+            except Full:
+                pass
+        return False
+    def scroll_slice(slice_id):
+        pages = iter_scroll_pages(es, es_instance_name, es_query, MAX_SCROLL_SIZE=MAX_SCROLL_SIZE, keys_to_include=keys_to_include, slice_id=slice_id, max_slices=max_slices)
+        try:
+            for res_hits in pages:
+                if(not put_page(res_hits)):
+                    break
+        except Exception as e:
+            put_page(e)
+        finally:
+            pages.close()
+            put_page(None)
+    slice_threads = [threading.Thread(target=scroll_slice, args=(i,), daemon=True) for i in range(max_slices)]
+    for slice_thread in slice_threads:
+        slice_thread.start()
+    finished_slices = 0
+    try:
+        while(finished_slices < max_slices):
+            res_hits = page_queue.get()
+            if(res_hits is None):
+                finished_slices += 1
+            elif(isinstance(res_hits, Exception)):
+                raise res_hits
+            else:
+                for res_hit in res_hits:
+                    yield res_hit
+    finally:
+        stop_event.set()
+
+def collect_scroll_results(es, es_instance_name, es_query, MAX_SCROLL_SIZE=1000, keys_to_include=[], max_slices=1):
     """
     Collect full query results using Elasticsearch scroll.
+    Note: holds all results in memory, use iter_scroll_results
+    or QueryResultWriter for large queries.
     """
-    res = es.search(index=es_instance_name, body=es_query, size=MAX_SCROLL_SIZE, scroll='2m')
-    scroll_id = res['_scroll_id']
-    scroll_size = len(res['hits']['hits'])
-    full_results = []
-    filter_keys = len(keys_to_include) > 0
-    while(scroll_size > 0):
-#         for i, res_i in enumerate(res['hits']['hits']):
-#             full_results.append(res_i)
-        res_hits = res['hits']['hits']
-        if(filter_keys):
-            res_hits_filtered = list(map(lambda x: {'_source' : {y : x['_source'][y] for y in keys_to_include}}, res_hits))
-#             res_hits_filtered = {x : res_hits['_source'][x] for x in keys_to_include}
-            res_hits = res_hits_filtered
-        full_results += res_hits
-        res = es.scroll(scroll_id=scroll_id, scroll='2m')
-        scroll_id = res['_scroll_id']
-        scroll_size = len(res_hits)
-        # TODO: memory error??
-#         break
-    return full_results
+    return list(iter_scroll_results(es, es_instance_name, es_query, MAX_SCROLL_SIZE=MAX_SCROLL_SIZE, keys_to_include=keys_to_include, max_slices=max_slices))
 
-def execute_queries_all_instances(es_queries, keys_to_include=[], 
-                                  es_year_month_pairs=[(2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6)], 
-                                  es_cluster_name='reddit_comments', es_base_dir='/hg190/elastic_search/', 
-                                  es_port=9200, verbose=True):
+class QueryResultWriter:
     """
-    Execute ES queries on all available ES instances
-    and combine results.
+    Stream query results (_source dicts) to TSV or Parquet file
+    in chunks, so that results never have to fit in memory.
+    Thread-safe: can be shared by concurrent queries
+    (rows from different queries may be interleaved).
+    Columns are fixed when writing starts, so pass fields when
+    results may have different keys; keys outside fields are dropped
+    (with a warning). With fields, an empty result still writes the header.
+    """
+    def __init__(self, out_file, fields=None, out_format=None, chunk_size=10000):
+        """
+        :param out_file: output file (.tsv, .tsv.gz or .parquet)
+        :param fields: output columns (default keys of first result)
+        :param out_format: "tsv" or "parquet" (default based on out_file extension)
+        :param chunk_size: rows per write
+        """
+        if(out_format is None):
+            out_format = 'parquet' if out_file.endswith('.parquet') else 'tsv'
+        if(out_format == 'parquet' and pyarrow is None):
+            raise ImportError('parquet output requires pyarrow')
+        self.out_file = out_file
+        self.fields = fields
+        self.out_format = out_format
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.out_stream = None
+        self.schema = None
+        self.row_count = 0
+        self.dropped_fields = set()
     
-    :param es_queries: ES queries
-    :returns combined_results:: combined query results (hits)
+    def write_chunk(self, rows):
+        with self.lock:
+            self.write_chunk_unlocked(rows)
+    
+    def write_chunk_unlocked(self, rows):
+        if(self.fields is None):
+            self.fields = list(rows[0].keys())
+        field_set = set(self.fields)
+        for row in rows:
+            if(not field_set.issuperset(row.keys())):
+                self.dropped_fields.update(set(row.keys()) - field_set)
+        chunk = pd.DataFrame([[row.get(field) for field in self.fields] for row in rows], columns=self.fields)
+        if(self.out_format == 'parquet'):
+            chunk_table = pyarrow.Table.from_pandas(chunk, schema=self.schema, preserve_index=False)
+            if(self.out_stream is None):
+                self.schema = chunk_table.schema
+                self.out_stream = pyarrow.parquet.ParquetWriter(self.out_file, self.schema)
+            self.out_stream.write_table(chunk_table)
+        else:
+            write_header = self.out_stream is None
+            if(write_header):
+                self.out_stream = gzip.open(self.out_file, 'wt') if self.out_file.endswith('.gz') else open(self.out_file, 'w')
+            chunk.to_csv(self.out_stream, sep='\t', index=False, header=write_header)
+        self.row_count += len(rows)
+    
+    def write(self, results):
+        """
+        Write results.
+        
+        :param results: iterable of result dicts
+        :returns result_count:: results written
+        """
+        result_count = 0
+        rows = []
+        for result in results:
+            rows.append(result)
+            if(len(rows) >= self.chunk_size):
+                self.write_chunk(rows)
+                result_count += len(rows)
+                rows = []
+        if(len(rows) > 0):
+            self.write_chunk(rows)
+            result_count += len(rows)
+        return result_count
+    
+    def close(self):
+        with self.lock:
+            # no results: still write header
+            if(self.out_stream is None and self.fields is not None):
+                self.write_chunk_unlocked([])
+            if(self.out_stream is not None):
+                self.out_stream.close()
+                self.out_stream = None
+            if(len(self.dropped_fields) > 0):
+                logging.warning('dropped result fields not in output columns of %s: %s'%(self.out_file, sorted(self.dropped_fields)))
+                self.dropped_fields = set()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+## ES query result cache
+def get_query_cache_key(es_query, keys_to_include=[], max_results=None):
     """
-    months = ['jan', 'feb', 'mar', 'apr', 'may', 'june', 'july', 'aug', 'sep', 'oct', 'nov', 'dec']
-    es_dir = os.path.join(es_base_dir, 'es_instances_for_%s'%(es_cluster_name))
-    ES_INITIALIZE_TIMEOUT = 150
-    MAX_SIZE = 1000
-    ## collect all results
-    combined_results = []
-    for es_year, es_start_month, es_end_month in es_year_month_pairs:
-        es_year_month_results = []
-        es_instance_name = '%s_%d_m_%d_%d'%(es_cluster_name, es_year, es_start_month, es_end_month)
-        es_start_month_str = months[es_start_month-1]
-        es_end_month_str = months[es_end_month-1]
-        es_dir_full = os.path.join(es_dir, str(es_year), '%s-%s-%d'%(es_start_month_str, es_end_month_str, es_year), 'elasticsearch-2.1.1/bin')
+    Hash of canonical query, so that key order
+    and whitespace don't change the key.
+    """
+    canonical_query = json.dumps({'query' : es_query, 'keys' : sorted(keys_to_include), 'max_results' : max_results}, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(canonical_query.encode('utf-8')).hexdigest()
+
+class QueryResultCache:
+    """
+    On-disk cache of ES query results (hits), keyed by index name
+    and canonical query. Each query's hits are stored as compressed
+    batches of JSON lines in cache_dir/<index>/<query hash>.gz.
+    Hits are written to a temp file and renamed once the query
+    finishes, so interrupted queries are never cached.
+    Cached results don't change with the index: call
+    invalidate(index) when the index is rebuilt or updated.
+    """
+    def __init__(self, cache_dir, batch_size=2**22):
+        """
+        :param cache_dir: cache directory
+        :param batch_size: max bytes per compressed batch
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.hit_ctr = 0
+        self.miss_ctr = 0
+    
+    def get_cache_file(self, es_instance_name, es_query, keys_to_include=[], max_results=None):
+        return os.path.join(self.cache_dir, es_instance_name, '%s.gz'%(get_query_cache_key(es_query, keys_to_include=keys_to_include, max_results=max_results)))
+    
+    def contains(self, es_instance_name, es_query, keys_to_include=[], max_results=None):
+        return os.path.exists(self.get_cache_file(es_instance_name, es_query, keys_to_include=keys_to_include, max_results=max_results))
+    
+    def iter_results(self, cache_file):
+        with FileLineReader(cache_file, use_external=False) as cache_reader:
+            for lines in cache_reader:
+                for line in lines:
+                    yield json.loads(line)
+    
+    def cache_results(self, cache_file, results):
+        """
+        Pass results through while writing them to cache file;
+        the cache entry is only kept if all results are consumed.
+        """
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_cache_file = cache_file.replace('.gz', '.%d_%d.tmp.gz'%(os.getpid(), threading.get_ident()))
+        complete = False
+        try:
+            with CompressedFileWriter(tmp_cache_file, batch_size=self.batch_size) as cache_writer:
+                for result in results:
+                    cache_writer.write('%s\n'%(json.dumps(result)))
+                    yield result
+            os.replace(tmp_cache_file, cache_file)
+            complete = True
+        finally:
+            if(not complete and os.path.exists(tmp_cache_file)):
+                os.remove(tmp_cache_file)
+    
+    def get_results(self, es_instance_name, es_query, fetch_results, keys_to_include=[], max_results=None):
+        """
+        Get query results from cache, or fetch and cache them.
+        
+        :param es_instance_name: ES index name
+        :param es_query: ES query
+        :param fetch_results: function to fetch results (hits) on cache miss
+        :param keys_to_include: _source fields included in results
+        :param max_results: max results included in results
+        :returns: result hits
+        """
+        cache_file = self.get_cache_file(es_instance_name, es_query, keys_to_include=keys_to_include, max_results=max_results)
+        if(os.path.exists(cache_file)):
+            self.hit_ctr += 1
+            return self.iter_results(cache_file)
+        self.miss_ctr += 1
+        return self.cache_results(cache_file, fetch_results())
+    
+    def invalidate(self, es_instance_name=None):
+        """
+        Remove cached results for index (default: all indices).
+        """
+        if(es_instance_name is None):
+            invalid_dir = self.cache_dir
+        else:
+            invalid_dir = os.path.join(self.cache_dir, es_instance_name)
+        if(os.path.exists(invalid_dir)):
+            shutil.rmtree(invalid_dir)
+            logging.info('removed cached query results in %s'%(invalid_dir))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+def execute_queries_instance(es_queries, es_year, es_start_month, es_end_month, es_manager, keys_to_include=[], query_workers=4, max_slices=1, result_writer=None, query_cache=None, verbose=True):
+    """
+    Execute ES queries on one year-month instance,
+    with up to query_workers queries running at once.
+    
+    :param es_queries: ES queries
+    :param es_manager: ESInstanceManager
+    :param query_workers: max queries running at once
+    :param max_slices: scroll slices per query
+    :param result_writer: QueryResultWriter to stream results to, instead of returning them
+    :param query_cache: QueryResultCache for query results
+    :returns es_year_month_results:: query results (hits) in query order
+    (result counts if result_writer is used); failed queries raise the query error
+    """
+    es_year_month_results = []
+    es_instance_name = get_es_instance_name(es_year, es_start_month, es_end_month, es_manager.es_cluster_name)
+    # no need to start ES if all results are cached
+    es = None
+    all_cached = query_cache is not None and all(query_cache.contains(es_instance_name, es_query, keys_to_include=keys_to_include) for es_query in es_queries)
+    if(not all_cached):
         if(verbose):
             print('starting index %s'%(es_instance_name))
-        # start up ES
-#         es_command = './elasticsearch --cluster.name %s --node.name %s'%(es_cluster_name, es_instance_name)
-        # specify custom port
-        es_command = f'./elasticsearch -Des.http.port={es_port} --cluster.name {es_cluster_name} --node.name {es_instance_name}'
-        process = subprocess.Popen(es_command.split(' '), cwd=es_dir_full)
         try:
-            try:
-                if(verbose):
-                    print('sleeping for %d sec to wait for ES to initialize'%(ES_INITIALIZE_TIMEOUT))
-                sleep(ES_INITIALIZE_TIMEOUT)
-            except Exception as e:
-                pass
-            # TODO: attempt to open index??
-            # may need to do this to have multiple indices open at once
-            es_open_command_url = f"http://localhost:{es_port}/{es_instance_name}/_open"
-            try:
-                es_open_request_result = requests.post(es_open_command_url)
-                if(verbose):
-                    es_open_request_result_txt = es_open_request_result.text
-                    print(f'opened ES instance {es_instance_name} with result\n{es_open_request_result_txt}')
-#                 es_open_process = subprocess.Popen(es_open_command.split(' '), cwd='.')
-                sleep(ES_INITIALIZE_TIMEOUT)
-            except Exception as e:
-                if(verbose):
-                    print(f'error in opening ES = {e}')
-            es_params = [{'host' : 'localhost', 'port' : es_port}]
-            es = Elasticsearch(es_params, timeout=100)
-            # execute queries
-            for es_query in es_queries:
-                if(verbose):
-                    print(f'processing query {es_query}')
-                results = []
-                res = collect_scroll_results(es, es_instance_name, es_query, keys_to_include=keys_to_include)
-                for i, res_i in enumerate(res):
-                    results.append(res_i['_source'])
-                if(verbose):
-                    print('collected %d results'%(len(results)))
-                es_year_month_results.append(results)
+            # start up ES, or reuse running instance; keep it running until queries finish
+            es, es_instance_name = es_manager.get_client(es_year, es_start_month, es_end_month, maxsize=query_workers*max_slices, pin=True)
         except Exception as e:
+            logging.warning('skipping index %s because ES failed to start: %s'%(es_instance_name, e))
             if(verbose):
                 print('process ending early because error %s'%(e))
-        process.terminate()
-        combined_results.append(es_year_month_results)
+            return es_year_month_results
+    def execute_query(es_query):
+        if(verbose):
+            print(f'processing query {es_query}')
+        fetch_results = lambda: iter_scroll_results(es, es_instance_name, es_query, keys_to_include=keys_to_include, max_slices=max_slices)
+        if(query_cache is not None):
+            res = query_cache.get_results(es_instance_name, es_query, fetch_results, keys_to_include=keys_to_include)
+        else:
+            res = fetch_results()
+        if(result_writer is not None):
+            result_count = result_writer.write(map(lambda x: x['_source'], res))
+            if(verbose):
+                print('wrote %d results'%(result_count))
+            return result_count
+        results = [res_i['_source'] for res_i in res]
+        if(verbose):
+            print('collected %d results'%(len(results)))
+        return results
+    try:
+        with ThreadPoolExecutor(max_workers=query_workers) as query_pool:
+            query_futures = [query_pool.submit(execute_query, es_query) for es_query in es_queries]
+            try:
+                for query_future in query_futures:
+                    es_year_month_results.append(query_future.result())
+            except Exception as e:
+                for query_future in query_futures:
+                    query_future.cancel()
+                logging.warning('query failed on index %s: %s'%(es_instance_name, e))
+                raise
+    finally:
+        if(es is not None):
+            es_manager.checkin(es_instance_name)
+    return es_year_month_results
+
+def execute_queries_all_instances(es_queries, keys_to_include=[], 
+                                  es_year_month_pairs=[(2018, 7, 9), (2018, 10, 12), (2019, 1, 3), (2019, 4, 6)], 
+                                  es_cluster_name='reddit_comments', es_base_dir='/hg190/elastic_search/', 
+                                  es_port=9200, verbose=True, es_manager=None, instance_workers=None, query_workers=4, max_slices=1, result_writer=None, query_cache=None):
+    """
+    Execute ES queries on all available ES instances
+    and combine results. Instances are queried concurrently
+    (up to instance_workers at once, each with up to query_workers queries),
+    and results are combined in (year-month, query) order.
+    For large result sets, stream results to file with result_writer.
+    
+    :param es_queries: ES queries
+    :param keys_to_include: only return these _source fields
+    :param es_manager: ESInstanceManager to reuse running instances
+    (default: start instances here and stop them when done)
+    :param instance_workers: max instances queried at once (default es_manager.max_instances)
+    :param query_workers: max queries per instance at once
+    :param max_slices: scroll slices per query
+    :param result_writer: QueryResultWriter to stream results to
+    :param query_cache: QueryResultCache for query results (skip ES for repeated queries)
+    :returns combined_results:: combined query results (hits), or result counts if result_writer is used
+    """
+    close_manager = es_manager is None
+    if(es_manager is None):
+        es_manager = ESInstanceManager(es_cluster_name=es_cluster_name, es_base_dir=es_base_dir, base_port=es_port, max_instances=1)
+    if(instance_workers is None):
+        instance_workers = es_manager.max_instances
+    # more workers than instances would wait for a free slot
+    instance_workers = max(1, min(instance_workers, es_manager.max_instances, len(es_year_month_pairs)))
+    execute_queries = lambda x: execute_queries_instance(es_queries, x[0], x[1], x[2], es_manager, keys_to_include=keys_to_include, query_workers=query_workers, max_slices=max_slices, result_writer=result_writer, query_cache=query_cache, verbose=verbose)
+    ## collect all results
+    try:
+        with ThreadPoolExecutor(max_workers=instance_workers) as instance_pool:
+            combined_results = list(instance_pool.map(execute_queries, es_year_month_pairs))
+    finally:
+        if(close_manager):
+            es_manager.close()
     return combined_results
 
 ## API auth methods
@@ -622,38 +1846,195 @@ def match_location_region(location_txt, us_state_matcher, country_matcher, count
 
 # chunk query
 
-def generate_chunk_queries(terms, extra_query_params={}, MAX_QUERY_CHUNK_SIZE=50, search_var='body'):
+## chunk queries
+# ES default for indices.query.bool.max_clause_count
+ES_MAX_CLAUSE_COUNT = 1024
+TERM_TOKEN_MATCHER = re.compile('\\w+')
+def get_chunk_size(term_count, max_clause_count=ES_MAX_CLAUSE_COUNT, min_chunks=1):
+    """
+    Get chunk size for the fewest chunks that stay
+    under the clause limit, split evenly (e.g. 1100 terms => 2 x 550
+    instead of 1024 + 76).
+    
+    :param term_count: number of terms
+    :param max_clause_count: max clauses per query
+    :param min_chunks: min number of chunks (e.g. to run in parallel)
+    :returns chunk_size:: max terms per chunk
+    """
+    chunk_count = max(min_chunks, int(ceil(term_count / max_clause_count)), 1)
+    chunk_size = max(int(ceil(term_count / chunk_count)), 1)
+    return chunk_size
+
+def build_chunk_query(terms, extra_query_params={}, search_var='body', lowercase=True):
+    """
+    Build non-scoring query to match any of terms:
+    one-token terms => terms query on (analyzed) search field,
+    multi-token terms (e.g. "vape-ing") => match_phrase.
+    Extra params are exact-match term filters.
+    
+    :param terms: query terms
+    :param extra_query_params: extra exact-match params (e.g. lang)
+    :param search_var: search field
+    :param lowercase: lowercase terms to match analyzed field
+    :returns es_query:: query, or None if no valid terms
+    """
+    tokens = []
+    phrases = []
+    for term in terms:
+        if(lowercase):
+            term = term.lower()
+        term_tokens = TERM_TOKEN_MATCHER.findall(term)
+        if(len(term_tokens) == 1):
+            tokens.append(term_tokens[0])
+        elif(len(term_tokens) > 1):
+            phrases.append(term)
+    query_clauses = []
+    if(len(tokens) > 0):
+        query_clauses.append({'terms' : {search_var : tokens}})
+    for phrase in phrases:
+        query_clauses.append({'match_phrase' : {search_var : phrase}})
+    if(len(query_clauses) == 0):
+        return None
+    query_filters = [{'bool' : {'should' : query_clauses}}]
+    for k, v in extra_query_params.items():
+        query_filters.append({'term' : {k : v}})
+    es_query = {
+        'query' : {
+            'bool' : {
+                'filter' : query_filters
+            }
+        }
+    }
+    return es_query
+
+def generate_chunk_queries(terms, extra_query_params={}, MAX_QUERY_CHUNK_SIZE=None, search_var='body', max_clause_count=ES_MAX_CLAUSE_COUNT, min_chunks=1, lowercase=True):
     """
-    Generate match queries in chunks, e.g. with 50 terms at once.
+    Generate queries in chunks of terms, e.g. with 500 terms at once.
+    Queries run in filter context (no scoring => cacheable).
+    
+    :param terms: query terms
+    :param extra_query_params: extra exact-match params (e.g. lang)
+    :param MAX_QUERY_CHUNK_SIZE: max terms per query (default: based on term count and max_clause_count)
+    :param search_var: search field
+    :param max_clause_count: max clauses per query
+    :param min_chunks: min number of queries (e.g. to run in parallel)
+    :param lowercase: lowercase terms to match analyzed field
+    :returns es_queries:: queries
+    """
+    if(MAX_QUERY_CHUNK_SIZE is None):
+        MAX_QUERY_CHUNK_SIZE = get_chunk_size(len(terms), max_clause_count=max_clause_count, min_chunks=min_chunks)
+    es_queries = []
+    for i in range(0, len(terms), MAX_QUERY_CHUNK_SIZE):
+        es_query = build_chunk_query(terms[i:i+MAX_QUERY_CHUNK_SIZE], extra_query_params=extra_query_params, search_var=search_var, lowercase=lowercase)
+        if(es_query is not None):
+            es_queries.append(es_query)
+    return es_queries
+
+def generate_chunk_queries_by_cost(es, es_instance_name, terms, extra_query_params={}, search_var='body', max_query_hits=10**6, max_clause_count=ES_MAX_CLAUSE_COUNT, min_chunks=1, lowercase=True):
     """
-    term_chunk_count = int(ceil(len(terms) / MAX_QUERY_CHUNK_SIZE))
-    search_term_chunks = list(map(lambda i: terms[(i*MAX_QUERY_CHUNK_SIZE):((i+1)*MAX_QUERY_CHUNK_SIZE)], range(term_chunk_count)))
+    Generate chunk queries, using count queries to estimate cost:
+    drop chunks without hits and split chunks with more than
+    max_query_hits hits in half, so that query costs are bounded and balanced.
+    Counts come from one index, so use a representative index.
+    
+    :param es: ES client
+    :param es_instance_name: index to count hits in
+    :param terms: query terms
+    :param max_query_hits: max estimated hits per query
+    :returns es_queries:: queries in term order
+    :returns query_hits:: estimated hits per query
+    """
+    chunk_size = get_chunk_size(len(terms), max_clause_count=max_clause_count, min_chunks=min_chunks)
+    # check chunks in term order
+    term_chunks = deque([terms[i:i+chunk_size] for i in range(0, len(terms), chunk_size)])
     es_queries = []
-    for search_term_chunk in search_term_chunks:
+    query_hits = []
+    while(len(term_chunks) > 0):
+        term_chunk = term_chunks.popleft()
+        es_query = build_chunk_query(term_chunk, extra_query_params=extra_query_params, search_var=search_var, lowercase=lowercase)
+        if(es_query is None):
+            continue
+        hit_count = es.count(index=es_instance_name, body=es_query)['count']
+        if(hit_count > max_query_hits and len(term_chunk) > 1):
+            split_idx = len(term_chunk) // 2
+            term_chunks.extendleft([term_chunk[split_idx:], term_chunk[:split_idx]])
+        elif(hit_count > 0):
+            es_queries.append(es_query)
+            query_hits.append(hit_count)
+    logging.info('generated %d queries for %d terms, estimated hits = %d'%(len(es_queries), len(terms), sum(query_hits)))
+    return es_queries, query_hits
+
+## phrase queries
+## shingle subfield (e.g. body.shingles) indexes 2..N-word phrases as single terms,
+## so phrases up to N words are exact term lookups instead of position matching
+SHINGLE_SUBFIELD = 'shingles'
+def build_phrase_query_clauses(phrases, search_var='body', shingle_field=None, max_shingle_size=3):
+    """
+    Build exact-match query clauses for phrases:
+    one word => term query on text field,
+    2..max_shingle_size words => term query on shingle field,
+    longer phrases (or no shingle field) => match_phrase.
+    Phrases are tokenized like the index analyzer (classic tokenizer,
+    lowercase), i.e. split on whitespace and punctuation (same rule as build_chunk_query).
+    
+    :param phrases: query phrases
+    :param search_var: text field
+    :param shingle_field: shingle subfield name (e.g. "shingles" => "body.shingles")
+    :param max_shingle_size: max words per shingle
+    :returns query_clauses:: query clauses (any should match)
+    """
+    words = []
+    shingles = []
+    long_phrases = []
+    for phrase in phrases:
+        phrase_tokens = TERM_TOKEN_MATCHER.findall(phrase.lower())
+        if(len(phrase_tokens) == 0):
+            continue
+        elif(len(phrase_tokens) == 1):
+            words.append(phrase_tokens[0])
+        elif(shingle_field is not None and len(phrase_tokens) <= max_shingle_size):
+            shingles.append(' '.join(phrase_tokens))
+        elif(len(phrase_tokens) > 1):
+            long_phrases.append(' '.join(phrase_tokens))
+    query_clauses = []
+    if(len(words) > 0):
+        query_clauses.append({'terms' : {search_var : words}})
+    if(len(shingles) > 0):
+        query_clauses.append({'terms' : {'%s.%s'%(search_var, shingle_field) : shingles}})
+    for long_phrase in long_phrases:
+        query_clauses.append({'match_phrase' : {search_var : long_phrase}})
+    return query_clauses
+
+def generate_phrase_queries(phrases, extra_query_params={}, MAX_QUERY_CHUNK_SIZE=50, search_var='body', shingle_field=SHINGLE_SUBFIELD, max_shingle_size=3):
+    """
+    Generate exact phrase queries in chunks, e.g. with 50 phrases at once.
+    Unlike generate_chunk_queries, multi-word phrases can use shingle field.
+    Queries run in filter context (no scoring => cacheable).
+    
+    :param phrases: query phrases (e.g. "hacer un tweet")
+    :param extra_query_params: extra exact-match params (e.g. lang)
+    :param MAX_QUERY_CHUNK_SIZE: max phrases per query
+    :param search_var: text field
+    :param shingle_field: shingle subfield name (None => match_phrase on text field)
+    :param max_shingle_size: max words per shingle
+    :returns es_queries:: queries
+    """
+    es_queries = []
+    for i in range(0, len(phrases), MAX_QUERY_CHUNK_SIZE):
+        phrase_chunk = phrases[i:i+MAX_QUERY_CHUNK_SIZE]
+        query_clauses = build_phrase_query_clauses(phrase_chunk, search_var=search_var, shingle_field=shingle_field, max_shingle_size=max_shingle_size)
+        if(len(query_clauses) == 0):
+            continue
+        query_filters = [{'bool' : {'should' : query_clauses}}]
+        for k, v in extra_query_params.items():
+            query_filters.append({'term' : {k : v}})
         es_query = {
             'query' : {
-                'match' : {
-                    search_var : '|'.join(search_term_chunk)
+                'bool' : {
+                    'filter' : query_filters
                 }
             }
         }
-        # extra params (e.g. lang) => different structure
-        if(len(extra_query_params) > 0):
-            es_query = {
-                'query' : {
-                    'bool' : {
-                        'must' : [
-                            {
-                                'match' : {
-                                    search_var : '|'.join(search_term_chunk)
-                                }
-                            },
-                        ]
-                    }
-                }
-            }
-            for k, v in extra_query_params.items():
-                es_query['query']['bool']['must'].append({'match' : {k : v}})
         es_queries.append(es_query)
     return es_queries
 
@@ -788,6 +2169,166 @@ def load_data_manual(data_file, sep='\t', max_cols=None, verbose=False, pad_val=
     data = pd.DataFrame(data, columns=data_cols)
     return data
 
+## geo filtering
+def get_tweet_point(tweet, use_place=False):
+    """
+    Get (lon, lat) point for tweet.
+    Tweet coordinates are GeoJSON ([lon, lat]); the deprecated
+    geo field is [lat, lon]. Optionally fall back to the
+    center of the place bounding box.
+    
+    :param tweet: tweet data
+    :param use_place: use place bounding box center if no point
+    :returns point:: (lon, lat) or None (no point or malformed geo data)
+    """
+    try:
+        coord = tweet.get('coordinates')
+        if(coord is not None and coord.get('type') == 'Point'):
+            lon, lat = coord['coordinates'][:2]
+            return float(lon), float(lat)
+        geo = tweet.get('geo')
+        if(geo is not None and geo.get('type') == 'Point'):
+            lat, lon = geo['coordinates'][:2]
+            return float(lon), float(lat)
+        if(use_place):
+            place = tweet.get('place')
+            if(place is not None and place.get('bounding_box') is not None):
+                lon, lat = np.array(place['bounding_box']['coordinates'][0], dtype=float).reshape(-1, 2).mean(axis=0)
+                return lon, lat
+    except Exception as e:
+        logging.debug('bad tweet geo data %s'%(e))
+    return None
+
+def points_in_polygon(points, polygon):
+    """
+    Even-odd rule point-in-polygon test over all points at once.
+    
+    :param points: N x 2 array of (lon, lat) (NaN => no point)
+    :param polygon: V x 2 array of (lon, lat) vertices
+    :returns inside:: N bool array
+    """
+    inside = np.zeros(len(points), dtype=bool)
+    # only test points in polygon bounding box
+    lon_min, lat_min = polygon.min(axis=0)
+    lon_max, lat_max = polygon.max(axis=0)
+    lon, lat = points[:, 0], points[:, 1]
+    candidate_idx = np.where((lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max))[0]
+    if(len(candidate_idx) == 0):
+        return inside
+    lon, lat = lon[candidate_idx], lat[candidate_idx]
+    candidate_inside = np.zeros(len(candidate_idx), dtype=bool)
+    next_polygon = np.roll(polygon, -1, axis=0)
+    for (lon_1, lat_1), (lon_2, lat_2) in zip(polygon, next_polygon):
+        crosses = (lat_1 > lat) != (lat_2 > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lon_cross = (lon_2 - lon_1) * (lat - lat_1) / (lat_2 - lat_1) + lon_1
+        candidate_inside ^= (crosses & (lon < lon_cross))
+    inside[candidate_idx] = candidate_inside
+    return inside
+
+def load_geo_regions(region_file):
+    """
+    Load named regions from JSON file, e.g.
+    {"paris" : {"box" : [2.22, 48.81, 2.47, 48.90]},
+     "france" : {"place" : {"country_code" : "FR"}},
+     "sf" : {"polygon" : [[-122.52, 37.70], [-122.35, 37.70], [-122.35, 37.83]]}}
+    Boxes are [lon_min, lat_min, lon_max, lat_max] and polygons are
+    lists of [lon, lat], following GeoJSON order.
+    """
+    with open(region_file, 'r') as region_input:
+        geo_regions = json.load(region_input)
+    return geo_regions
+
+class GeoRegionFilter:
+    """
+    Match tweets against many named regions (boxes, polygons,
+    place fields) at once. Points for a whole batch of tweets
+    are tested against all boxes with one NumPy broadcast.
+    A region with box/polygon and place must match both.
+    """
+    
+    def __init__(self, geo_regions, use_place=False):
+        """
+        :param geo_regions: region name => {'box' : [...]} or {'polygon' : [...]} or {'place' : {...}}
+        (box/polygon can be combined with place)
+        :param use_place: use place bounding box center for tweets without point
+        """
+        self.region_names = np.array(list(geo_regions.keys()), dtype=object)
+        self.use_place = use_place
+        self.box_idx, boxes = [], []
+        self.polygon_idx, self.polygons = [], []
+        self.place_idx, self.place_info = [], []
+        for i, (region_name, region) in enumerate(geo_regions.items()):
+            if('box' in region):
+                self.box_idx.append(i)
+                boxes.append(region['box'])
+            elif('polygon' in region):
+                self.polygon_idx.append(i)
+                self.polygons.append(np.array(region['polygon'], dtype=float))
+            if('place' in region):
+                self.place_idx.append(i)
+                self.place_info.append(region['place'])
+            if(not any(k in region for k in ['box', 'polygon', 'place'])):
+                raise ValueError('region %s needs box, polygon or place'%(region_name))
+        self.boxes = np.array(boxes, dtype=float).reshape(-1, 4)
+        self.use_points = len(self.box_idx) + len(self.polygon_idx) > 0
+    
+    def match_points(self, points):
+        """
+        Test points against all boxes and polygons.
+        
+        :param points: N x 2 array of (lon, lat) (NaN => no point)
+        :returns box_match, polygon_match:: N x boxes, N x polygons bool arrays
+        """
+        lon, lat = points[:, [0]], points[:, [1]]
+        # NaN comparisons are False => tweets without points never match
+        box_match = (lon >= self.boxes[:, 0]) & (lat >= self.boxes[:, 1]) & (lon <= self.boxes[:, 2]) & (lat <= self.boxes[:, 3])
+        polygon_match = np.zeros((len(points), len(self.polygons)), dtype=bool)
+        for i, polygon in enumerate(self.polygons):
+            polygon_match[:, i] = points_in_polygon(points, polygon)
+        return box_match, polygon_match
+    
+    def match_places(self, places):
+        """
+        Test place data against all place regions (all fields must match).
+        
+        :param places: place data per tweet (None or malformed => no place)
+        :returns place_match:: N x place regions bool array
+        """
+        place_match = np.zeros((len(places), len(self.place_info)), dtype=bool)
+        for j, place_info in enumerate(self.place_info):
+            place_match[:, j] = [isinstance(place, dict) and all(place.get(k) == v for k, v in place_info.items()) for place in places]
+        return place_match
+    
+    def match_batch(self, tweets):
+        """
+        Match batch of tweets against all regions.
+        
+        :param tweets: tweet data
+        :returns tweet_regions:: matching region names per tweet
+        """
+        region_match = np.zeros((len(tweets), len(self.region_names)), dtype=bool)
+        if(self.use_points):
+            points = np.full((len(tweets), 2), np.nan)
+            for i, tweet in enumerate(tweets):
+                point = get_tweet_point(tweet, use_place=self.use_place)
+                if(point is not None):
+                    points[i] = point
+            box_match, polygon_match = self.match_points(points)
+            region_match[:, self.box_idx] = box_match
+            region_match[:, self.polygon_idx] = polygon_match
+        if(len(self.place_idx) > 0):
+            # place-only regions: place decides; box/polygon + place regions: both must match
+            place_match = self.match_places([tweet.get('place') for tweet in tweets])
+            point_region_idx = set(self.box_idx) | set(self.polygon_idx)
+            for j, region_idx in enumerate(self.place_idx):
+                if(region_idx in point_region_idx):
+                    region_match[:, region_idx] &= place_match[:, j]
+                else:
+                    region_match[:, region_idx] = place_match[:, j]
+        tweet_regions = [list(self.region_names[region_match_i]) for region_match_i in region_match]
+        return tweet_regions
+
 ## handle access tokens
 
 class AccessTokenHandler:
@@ -959,6 +2500,62 @@ def parse_date_all_formats(date_str, date_fmts):
         print(f'bad date=<{date_str}>')
     return date_parsed
 
+def parse_dates(dates, date_formats, date_matchers=None, clean_date_txt=None, round_to_day=True, chunk_size=100000, format_sample_size=100):
+    """
+    Parse text dates in batch. Each unique date string is parsed once:
+    per chunk of unique dates, detect the best format on a sample,
+    parse the chunk with that format (vectorized), and
+    try the remaining formats only on the dates that failed.
+    Dates with timezone are converted to UTC; dates that
+    fail all formats are NaT.
+    
+    :param dates: text dates
+    :param date_formats: all possible date formats
+    :param date_matchers: optional date matching expressions (one per format) to extract date text before parsing
+    :param clean_date_txt: optional function to clean unique date text (Series => Series)
+    :param round_to_day: round dates down to day
+    :param chunk_size: unique dates per chunk
+    :param format_sample_size: dates per chunk sample used to detect format
+    :returns parsed_dates:: parsed dates (datetime64, same index as dates)
+    """
+    dates = pd.Series(dates)
+    date_codes, unique_dates = pd.factorize(dates.fillna('').astype(str).str.strip())
+    unique_dates = pd.Series(unique_dates, dtype=object)
+    if(clean_date_txt is not None):
+        unique_dates = clean_date_txt(unique_dates)
+    if(date_matchers is None):
+        date_matchers = [None,]*len(date_formats)
+    date_parsers = list(zip(date_formats, date_matchers))
+    def parse_date_format(date_txt, date_format, date_matcher):
+        if(date_matcher is not None):
+            date_txt = date_txt.str.extract('(%s)'%(date_matcher.pattern), expand=False)
+        parsed_date_txt = pd.to_datetime(date_txt, format=date_format, errors='coerce', utc=True)
+        return parsed_date_txt.dt.tz_convert(None)
+    parsed_unique_dates = []
+    for i in range(0, len(unique_dates), chunk_size):
+        unique_dates_i = unique_dates.iloc[i:i+chunk_size]
+        # detect format: most sample dates parsed
+        unique_dates_sample_i = unique_dates_i.iloc[:format_sample_size]
+        date_parsers_i = sorted(date_parsers, key=lambda x: parse_date_format(unique_dates_sample_i, *x).notna().sum(), reverse=True)
+        parsed_unique_dates_i = parse_date_format(unique_dates_i, *date_parsers_i[0])
+        for date_parser in date_parsers_i[1:]:
+            failed_dates_i = parsed_unique_dates_i.isna() & (unique_dates_i != '')
+            if(not failed_dates_i.any()):
+                break
+            parsed_unique_dates_i = parsed_unique_dates_i.fillna(parse_date_format(unique_dates_i[failed_dates_i], *date_parser))
+        parsed_unique_dates.append(parsed_unique_dates_i)
+    if(len(parsed_unique_dates) > 0):
+        parsed_unique_dates = pd.concat(parsed_unique_dates, axis=0)
+    else:
+        parsed_unique_dates = pd.Series([], dtype='datetime64[ns]')
+    bad_dates = unique_dates[parsed_unique_dates.isna() & (unique_dates != '')]
+    if(len(bad_dates) > 0):
+        logging.warning('failed to parse %d unique dates, e.g. <%s>'%(len(bad_dates), bad_dates.iloc[0]))
+    if(round_to_day):
+        parsed_unique_dates = parsed_unique_dates.dt.floor('D')
+    parsed_dates = pd.Series(parsed_unique_dates.values[date_codes], index=dates.index)
+    return parsed_dates
+
 def clean_date_values(data):
     """
     Convert date variables to usable format.
@@ -973,17 +2570,15 @@ def clean_date_values(data):
     alternate_date_var = 'date'
     if(alternate_date_var in data.columns):
         data = data.assign(**{
-            date_var : data.apply(lambda x: x.loc[date_var] if x.loc[date_var]!='' else x.loc[alternate_date_var], axis=1)
+            date_var : data.loc[:, date_var].where(data.loc[:, date_var]!='', data.loc[:, alternate_date_var])
         })
     clean_date_var = 'clean_date'
     # TODO: why are some of the date formats failing to parse?
     mid_date_matcher = re.compile('(?<=[0-9])T(?=[0-9])') # remove weird T in middle of text
     final_punct_matcher = re.compile('(?<=[\+-][0-9]{2}):(?=00$)') # remove punct in final timezone text
+    clean_date_txt = lambda x: x.str.replace(final_punct_matcher, '', regex=True).str.replace(mid_date_matcher, ' ', regex=True)
     data = data.assign(**{
-        clean_date_var : data.loc[:, date_var].apply(lambda x: mid_date_matcher.sub(' ', final_punct_matcher.sub('', x)))
-    })
-    data = data.assign(**{
-        clean_date_var : data.loc[:, clean_date_var].apply(lambda x: parse_date_all_formats(x, date_fmts))
+        clean_date_var : parse_dates(data.loc[:, date_var], date_fmts, clean_date_txt=clean_date_txt, round_to_day=False)
     })
     return data
 
@@ -1118,6 +2713,814 @@ def load_lang_id_model():
     lang_id_model = langid.langid.LanguageIdentifier.from_modelstring(langid.langid.model, norm_probs=True)
     return lang_id_model
 
+## lang ID sidecar store
+## columnar copy of *_lang_id.tsv.gz: sorted int64 IDs, uint8 lang codes, uint8 scores
+## stored as .npy arrays so that mining jobs can memory-map them instead of building ID sets
+LANG_ID_STORE_META = 'meta.json'
+LANG_ID_STORE_ARRAYS = ['id', 'lang', 'score']
+def lang_id_key(post_id):
+    """
+    Convert post ID to int64 key for the lang ID store.
+    Integer IDs (tweets) are kept, string IDs (Reddit)
+    are read as base-36.
+    """
+    if(isinstance(post_id, str)):
+        return int(post_id, 36)
+    return int(post_id)
+
+def lang_id_keys(post_ids):
+    """
+    Convert post IDs to int64 key array.
+    """
+    post_ids = np.asarray(post_ids)
+    if(np.issubdtype(post_ids.dtype, np.integer)):
+        return post_ids.astype(np.int64)
+    return np.array([lang_id_key(x) for x in post_ids], dtype=np.int64)
+
+def get_lang_id_store_dir(lang_id_file):
+    """
+    Get sidecar store directory for lang ID file, e.g.
+    lang_id/tweets_lang_id.tsv.gz => lang_id/tweets_lang_id/
+    """
+    store_dir = lang_id_file
+    for ext in ['.gz', '.tsv']:
+        if(store_dir.endswith(ext)):
+            store_dir = store_dir[:-len(ext)]
+    return store_dir
+
+def sort_lang_id_arrays(ids, lang_codes, scores):
+    """
+    Sort lang ID arrays by ID and drop duplicate IDs (keep first).
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    sort_idx = np.argsort(ids, kind='stable')
+    ids = ids[sort_idx]
+    keep_idx = np.ones(len(ids), dtype=bool)
+    keep_idx[1:] = ids[1:] != ids[:-1]
+    sort_idx = sort_idx[keep_idx]
+    return ids[keep_idx], np.asarray(lang_codes, dtype=np.uint8)[sort_idx], np.asarray(scores, dtype=np.uint8)[sort_idx]
+
+def save_lang_id_arrays(store_dir, ids, lang_codes, scores, langs, score_scale=1.):
+    """
+    Sort lang ID arrays and write to store directory.
+    
+    :param store_dir: output directory
+    :param ids: int64 post IDs
+    :param lang_codes: uint8 indices into langs
+    :param scores: uint8 scores
+    :param langs: lang code list
+    :param score_scale: multiplier used to encode scores (stored in meta)
+    """
+    ids, lang_codes, scores = sort_lang_id_arrays(ids, lang_codes, scores)
+    # write to temp dir first so that readers never see partial store
+    tmp_dir = '%s.tmp'%(store_dir.rstrip('/'))
+    if(os.path.exists(tmp_dir)):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for array_name, array_vals in zip(LANG_ID_STORE_ARRAYS, [ids, lang_codes, scores]):
+        np.save(os.path.join(tmp_dir, '%s.npy'%(array_name)), array_vals)
+    with open(os.path.join(tmp_dir, LANG_ID_STORE_META), 'w') as meta_file:
+        json.dump({'langs' : list(langs), 'size' : len(ids), 'score_scale' : score_scale}, meta_file)
+    if(os.path.exists(store_dir)):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+def encode_lang_id_data(ids, langs, scores, score_scale=1.):
+    """
+    Encode raw lang ID columns as store arrays.
+    
+    :param ids: post IDs
+    :param langs: lang strings
+    :param scores: lang scores
+    :param score_scale: multiplier for scores, e.g. 100 for langid probabilities
+    :returns ids, lang_codes, scores, lang_list:: encoded arrays and lang list
+    """
+    lang_codes, lang_list = pd.factorize(pd.Series(langs).astype(str))
+    if(len(lang_list) > 256):
+        raise ValueError('too many languages (%d) for uint8 codes'%(len(lang_list)))
+    scores = np.clip(np.round(np.asarray(scores, dtype=float) * score_scale), 0, 255)
+    return lang_id_keys(ids), lang_codes.astype(np.uint8), scores.astype(np.uint8), list(lang_list)
+
+def write_lang_id_store(store_dir, ids, langs, scores, score_scale=1.):
+    """
+    Write lang ID store from raw columns, e.g. from a data frame.
+    """
+    ids, lang_codes, scores, lang_list = encode_lang_id_data(ids, langs, scores, score_scale=score_scale)
+    save_lang_id_arrays(store_dir, ids, lang_codes, scores, lang_list, score_scale=score_scale)
+
+class LangIDStoreWriter:
+    """
+    Accumulate lang ID results one post at a time
+    in compact arrays, then write sorted store on close.
+    """
+    
+    def __init__(self, store_dir, score_scale=1.):
+        self.store_dir = store_dir
+        self.score_scale = score_scale
+        self.ids = array('q')
+        self.lang_codes = array('B')
+        self.scores = array('B')
+        self.lang_lookup = {}
+    
+    def add(self, post_id, lang, score):
+        if(lang not in self.lang_lookup):
+            if(len(self.lang_lookup) == 256):
+                raise ValueError('too many languages for uint8 codes')
+            self.lang_lookup[lang] = len(self.lang_lookup)
+        self.ids.append(lang_id_key(post_id))
+        self.lang_codes.append(self.lang_lookup[lang])
+        self.scores.append(min(max(int(round(score * self.score_scale)), 0), 255))
+    
+    def close(self):
+        langs = sorted(self.lang_lookup, key=self.lang_lookup.get)
+        save_lang_id_arrays(self.store_dir, np.frombuffer(self.ids, dtype=np.int64), np.frombuffer(self.lang_codes, dtype=np.uint8), np.frombuffer(self.scores, dtype=np.uint8), langs, score_scale=self.score_scale)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # only write complete stores
+        if(exc_type is None):
+            self.close()
+
+class SortedIDSet:
+    """
+    Set-like membership over sorted int64 IDs, via binary search.
+    Supports `post_id in id_set` for drop-in use where
+    scripts used Python sets of IDs.
+    """
+    
+    def __init__(self, ids):
+        self.ids = ids
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def __contains__(self, post_id):
+        key = lang_id_key(post_id)
+        idx = np.searchsorted(self.ids, key)
+        return idx < len(self.ids) and self.ids[idx] == key
+    
+    def contains_batch(self, post_ids):
+        """
+        Vectorized membership for array of post IDs.
+        """
+        keys = lang_id_keys(post_ids)
+        if(len(self.ids) == 0):
+            return np.zeros(len(keys), dtype=bool)
+        idx = np.minimum(np.searchsorted(self.ids, keys), len(self.ids)-1)
+        return self.ids[idx] == keys
+
+class LangIDStore:
+    """
+    Lang ID store: sorted int64 IDs, uint8 lang codes, uint8 scores.
+    Scores are percents (raw score * score_scale).
+    Use LangIDStore.load to memory-map a store directory.
+    """
+    
+    def __init__(self, ids, lang_codes, scores, langs, score_scale=1.):
+        self.ids = ids
+        self.lang_codes = lang_codes
+        self.scores = scores
+        self.langs = list(langs)
+        self.score_scale = score_scale
+        self.lang_lookup = dict(zip(self.langs, range(len(self.langs))))
+    
+    @classmethod
+    def load(cls, store_dir, mmap=True):
+        with open(os.path.join(store_dir, LANG_ID_STORE_META), 'r') as meta_file:
+            meta = json.load(meta_file)
+        mmap_mode = 'r' if mmap else None
+        ids, lang_codes, scores = [np.load(os.path.join(store_dir, '%s.npy'%(array_name)), mmap_mode=mmap_mode) for array_name in LANG_ID_STORE_ARRAYS]
+        return cls(ids, lang_codes, scores, meta['langs'], score_scale=meta.get('score_scale', 1.))
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def valid_mask(self, lang=None, score_thresh=None):
+        """
+        Mask over store rows with lang and score > score_thresh.
+        """
+        mask = np.ones(len(self.ids), dtype=bool)
+        if(lang is not None):
+            if(lang not in self.lang_lookup):
+                return np.zeros(len(self.ids), dtype=bool)
+            mask &= (self.lang_codes == self.lang_lookup[lang])
+        if(score_thresh is not None):
+            mask &= (self.scores > score_thresh)
+        return mask
+    
+    def get_id_set(self, lang=None, score_thresh=None):
+        """
+        Get set-like object of all IDs with lang and score > score_thresh.
+        """
+        if(lang is None and score_thresh is None):
+            return SortedIDSet(self.ids)
+        # copy of filtered IDs stays sorted
+        return SortedIDSet(np.asarray(self.ids[self.valid_mask(lang=lang, score_thresh=score_thresh)]))
+    
+    def lookup_idx(self, post_ids):
+        """
+        Get store row for each post ID (-1 if missing).
+        """
+        keys = lang_id_keys(post_ids)
+        if(len(self.ids) == 0):
+            return np.full(len(keys), -1)
+        idx = np.minimum(np.searchsorted(self.ids, keys), len(self.ids)-1)
+        return np.where(self.ids[idx] == keys, idx, -1)
+    
+    def contains_batch(self, post_ids, lang=None, score_thresh=None):
+        """
+        Vectorized check whether posts have lang and score > score_thresh.
+        """
+        idx = self.lookup_idx(post_ids)
+        found = idx >= 0
+        valid = found.copy()
+        if(lang is not None):
+            lang_code = self.lang_lookup.get(lang, -1)
+            valid[found] &= (self.lang_codes[idx[found]] == lang_code)
+        if(score_thresh is not None):
+            valid[found] &= (self.scores[idx[found]] > score_thresh)
+        return valid
+    
+    def contains(self, post_id, lang=None, score_thresh=None):
+        return bool(self.contains_batch([post_id], lang=lang, score_thresh=score_thresh)[0])
+    
+    def lookup(self, post_id):
+        """
+        Get (lang, score) for post, or (None, None) if missing.
+        """
+        idx = self.lookup_idx([post_id])[0]
+        if(idx < 0):
+            return None, None
+        return self.langs[self.lang_codes[idx]], int(self.scores[idx])
+
+def get_lang_id_score_scale(scores):
+    """
+    Guess score scale for raw lang ID scores: probabilities
+    (langid, max <= 1) => 100, percents (cld2) => 1.
+    """
+    scores = np.asarray(scores, dtype=float)
+    if(len(scores) > 0 and np.nanmax(scores) <= 1.):
+        return LANG_ID_SCORE_SCALE['langid']
+    return LANG_ID_SCORE_SCALE['cld2']
+
+def load_lang_id_store(lang_id_file, write_store=True, score_scale=None):
+    """
+    Load lang ID sidecar store for *_lang_id.tsv.gz file
+    (ID, lang, score without header). If the store doesn't
+    exist yet, convert the TSV and (optionally) save the store
+    for the next job.
+    
+    :param lang_id_file: lang ID TSV file
+    :param write_store: write converted store to disk
+    :param score_scale: multiplier for TSV scores (None => 100 if scores are probabilities, else 1)
+    :returns lang_id_store:: LangIDStore
+    """
+    store_dir = get_lang_id_store_dir(lang_id_file)
+    if(os.path.exists(os.path.join(store_dir, LANG_ID_STORE_META))):
+        return LangIDStore.load(store_dir)
+    logging.debug('converting lang ID file %s to store'%(lang_id_file))
+    lang_id_data = pd.read_csv(lang_id_file, sep='\t', index_col=False, compression='gzip', header=None, names=['id', 'lang', 'score'])
+    if(score_scale is None):
+        score_scale = get_lang_id_score_scale(lang_id_data.loc[:, 'score'].values)
+    ids, lang_codes, scores, langs = encode_lang_id_data(lang_id_data.loc[:, 'id'].values, lang_id_data.loc[:, 'lang'].values, lang_id_data.loc[:, 'score'].values, score_scale=score_scale)
+    if(write_store):
+        try:
+            save_lang_id_arrays(store_dir, ids, lang_codes, scores, langs, score_scale=score_scale)
+            return LangIDStore.load(store_dir)
+        except OSError as e:
+            logging.debug('could not write lang ID store %s: %s'%(store_dir, e))
+    return LangIDStore(*sort_lang_id_arrays(ids, lang_codes, scores), langs, score_scale=score_scale)
+
+## batched lang ID
+## scores are backend-native: cld2 => percent, langid => normalized probability
+LANG_ID_SCORE_SCALE = {'cld2' : 1., 'langid' : 100.}
+# one model and cache per (worker) process
+LANG_ID_MODELS = {}
+LANG_ID_CACHES = {}
+def init_lang_id_model(backend='cld2', cache_file=None, normalize_txt=False):
+    """
+    Load lang ID model and text cache for backend once per process.
+    
+    :param backend: cld2 or langid
+    :param cache_file: on-disk cache file (None => in-memory only)
+    :param normalize_txt: detect language on normalized text (see LangIDCache)
+    """
+    if(backend == 'langid'):
+        LANG_ID_MODELS[backend] = load_lang_id_model()
+    elif(backend == 'cld2'):
+        if(cld2 is None):
+            raise ImportError('cld2 backend requires cld2-cffi')
+        LANG_ID_MODELS[backend] = cld2
+    else:
+        raise ValueError('unknown lang ID backend %s'%(backend))
+    LANG_ID_CACHES[backend] = LangIDCache(cache_file=cache_file, backend=backend, normalize_txt=normalize_txt)
+
+def detect_lang(txt, backend='cld2'):
+    """
+    Detect most likely language and its score.
+    
+    :param txt: text
+    :param backend: cld2 or langid
+    :returns lang, score:: language code, score
+    """
+    if(backend not in LANG_ID_MODELS):
+        init_lang_id_model(backend)
+    lang_id_model = LANG_ID_MODELS[backend]
+    if(backend == 'cld2'):
+        lang_details = lang_id_model.detect(txt).details[0]
+        return lang_details.language_code, lang_details.percent
+    return lang_id_model.classify(txt)
+
+## lang ID cache
+## retweets/duplicates/spam repeat the same text, so cache results
+## by hash of text (optionally normalized): in-memory LRU in front of a sqlite file
+## (sqlite handles concurrent worker processes)
+LANG_ID_TXT_MATCHERS = [(re.compile('^RT @\w+:'), ' '), (URL_MATCHER, ' '), (USER_MATCHER, ' '), (re.compile('\s+'), ' ')]
+def normalize_lang_id_txt(txt):
+    """
+    Normalize text for lang ID: remove retweet prefix,
+    URLs, @-mentions and extra whitespace.
+    """
+    for txt_matcher, txt_sub in LANG_ID_TXT_MATCHERS:
+        txt = txt_matcher.sub(txt_sub, txt)
+    return txt.strip()
+
+def hash_lang_id_txt(txt):
+    return hashlib.blake2b(txt.encode('utf-8'), digest_size=16).digest()
+
+class LangIDCache:
+    """
+    Content-addressed lang ID cache, keyed by hash of the text
+    the detector sees, so results are the same with or without a cache hit.
+    By default the detector sees raw text (same output as uncached detection).
+    With normalize_txt, it sees normalized text (no RT prefix, URLs, @-mentions),
+    which gives more cache hits but changes lang ID output.
+    """
+    
+    def __init__(self, cache_file=None, backend='cld2', max_memory_size=2**18, flush_size=10000, normalize_txt=False):
+        """
+        :param cache_file: sqlite cache file (None => in-memory only)
+        :param backend: cld2 or langid
+        :param max_memory_size: max entries in in-memory LRU
+        :param flush_size: max new entries before writing to disk
+        :param normalize_txt: detect language on normalized text
+        """
+        self.backend = backend
+        self.normalize_txt = normalize_txt
+        self.max_memory_size = max_memory_size
+        self.flush_size = flush_size
+        self.memory_cache = OrderedDict()
+        self.new_entries = []
+        self.hit_ctr = 0
+        self.miss_ctr = 0
+        # raw/normalized results don't mix in shared cache file
+        self.table = 'lang_id_%s%s'%(backend, '_normalized' if normalize_txt else '')
+        self.connection = None
+        if(cache_file is not None):
+            self.connection = sqlite3.connect(cache_file, timeout=600)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS %s (txt_hash BLOB PRIMARY KEY, lang TEXT, score REAL) WITHOUT ROWID'%(self.table))
+            self.connection.commit()
+    
+    def add_to_memory(self, txt_hash, lang_score):
+        self.memory_cache[txt_hash] = lang_score
+        if(len(self.memory_cache) > self.max_memory_size):
+            self.memory_cache.popitem(last=False)
+    
+    def get(self, txt_hash):
+        """
+        Get (lang, score) for text hash, or None if not cached.
+        """
+        lang_score = self.memory_cache.get(txt_hash)
+        if(lang_score is not None):
+            self.memory_cache.move_to_end(txt_hash)
+            return lang_score
+        if(self.connection is not None):
+            row = self.connection.execute('SELECT lang, score FROM %s WHERE txt_hash=?'%(self.table), (txt_hash,)).fetchone()
+            if(row is not None):
+                lang_score = tuple(row)
+                self.add_to_memory(txt_hash, lang_score)
+        return lang_score
+    
+    def put(self, txt_hash, lang_score):
+        self.add_to_memory(txt_hash, lang_score)
+        if(self.connection is not None):
+            self.new_entries.append((txt_hash, lang_score[0], lang_score[1]))
+            if(len(self.new_entries) >= self.flush_size):
+                self.flush()
+    
+    def detect(self, txt):
+        """
+        Detect most likely language and its score, using cache when possible.
+        """
+        if(self.normalize_txt):
+            txt = normalize_lang_id_txt(txt)
+        txt_hash = hash_lang_id_txt(txt)
+        lang_score = self.get(txt_hash)
+        if(lang_score is None):
+            self.miss_ctr += 1
+            lang_score = tuple(detect_lang(txt, backend=self.backend))
+            self.put(txt_hash, lang_score)
+        else:
+            self.hit_ctr += 1
+        return lang_score
+    
+    def flush(self):
+        if(self.connection is not None and len(self.new_entries) > 0):
+            with self.connection:
+                self.connection.executemany('INSERT OR IGNORE INTO %s VALUES (?, ?, ?)'%(self.table), self.new_entries)
+            self.new_entries = []
+    
+    def close(self):
+        self.flush()
+        if(self.connection is not None):
+            self.connection.close()
+            self.connection = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def get_lang_id_cache(backend='cld2'):
+    """
+    Get lang ID cache for this process.
+    """
+    if(backend not in LANG_ID_CACHES):
+        init_lang_id_model(backend)
+    return LANG_ID_CACHES[backend]
+
+def detect_lang_txt_batch(txts, backend='cld2'):
+    """
+    Detect language for batch of texts.
+    """
+    lang_id_cache = get_lang_id_cache(backend)
+    lang_score_vals = [lang_id_cache.detect(txt) for txt in txts]
+    lang_id_cache.flush()
+    return lang_score_vals
+
+def detect_lang_post_batch(lines, backend='cld2', txt_var='text', id_var='id', delete_val='[deleted]'):
+    """
+    Detect language for batch of JSON post lines,
+    skipping deleted posts and lines that fail to parse.
+    
+    :param lines: JSON lines
+    :param backend: cld2 or langid
+    :param txt_var: post text var
+    :param id_var: post ID var
+    :param delete_val: text value of deleted posts
+    :returns lang_id_results, error_ctr:: (post ID, lang, score) per post, number of failed lines
+    """
+    lang_id_cache = get_lang_id_cache(backend)
+    lang_id_results = []
+    error_ctr = 0
+    for l in lines:
+        try:
+            l_data = json.loads(l)
+            if('delete' not in l_data and l_data[txt_var] != delete_val):
+                txt_lang, txt_lang_score = lang_id_cache.detect(l_data[txt_var])
+                lang_id_results.append((l_data[id_var], txt_lang, txt_lang_score))
+        except Exception as e:
+            error_ctr += 1
+    lang_id_cache.flush()
+    return lang_id_results, error_ctr
+
+def run_ordered_batches(batch_fn, batches, workers=1, initializer=None, initargs=(), max_pending=None):
+    """
+    Apply function to batches in a process pool and yield
+    results in input order. At most max_pending batches
+    are in flight, so large files are never read ahead into memory.
+    
+    :param batch_fn: picklable function over one batch
+    :param batches: batch iterator
+    :param workers: number of processes (<= 1 => run in this process)
+    :param initializer: per-process setup function
+    :param initargs: setup function args
+    :param max_pending: max batches in flight (default 2 per worker)
+    """
+    if(workers <= 1):
+        if(initializer is not None):
+            initializer(*initargs)
+        for batch in batches:
+            yield batch_fn(batch)
+        return
+    if(max_pending is None):
+        max_pending = 2 * workers
+    with Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(batch_fn, (batch,)))
+            if(len(pending) >= max_pending):
+                yield pending.popleft().get()
+        while(len(pending) > 0):
+            yield pending.popleft().get()
+
+def tag_lang_txt(txts, backend='langid', workers=1, batch_size=10000, cache_file=None, normalize_txt=False):
+    """
+    Detect language for all texts with worker pool.
+    
+    :param txts: texts
+    :param backend: cld2 or langid
+    :param workers: number of processes
+    :param batch_size: texts per batch
+    :param cache_file: on-disk lang ID cache
+    :param normalize_txt: detect language on normalized text (changes output, see LangIDCache)
+    :returns lang_score_vals:: (lang, score) per text, in input order
+    """
+    txt_batches = (txts[i:i+batch_size] for i in range(0, len(txts), batch_size))
+    batch_fn = partial(detect_lang_txt_batch, backend=backend)
+    lang_score_vals = []
+    for lang_score_batch in run_ordered_batches(batch_fn, txt_batches, workers=workers, initializer=init_lang_id_model, initargs=(backend, cache_file, normalize_txt)):
+        lang_score_vals.extend(lang_score_batch)
+    return lang_score_vals
+
+## columnar author timelines
+AUTHOR_TIMELINE_BUCKETS = 64
+AUTHOR_TIMELINE_TXT_VARS = ['text', 'urls', 'lang']
+AUTHOR_TIMELINE_PARTITION_VARS = ['author_bucket']
+RETURN_CHAR_MATCHER = re.compile('[\n\r\t]')
+def get_author_buckets(authors, bucket_count=AUTHOR_TIMELINE_BUCKETS):
+    """
+    Hash authors (lowercase) to stable partition buckets.
+    
+    :param authors: author names
+    :param bucket_count: number of buckets
+    :returns author_buckets:: bucket per author
+    """
+    author_codes, unique_authors = pd.factorize(pd.Series(authors).astype(str).str.lower())
+    unique_buckets = np.array([zlib.crc32(author.encode('utf-8')) % bucket_count for author in unique_authors], dtype=np.int32)
+    return unique_buckets[author_codes]
+
+def clean_author_timeline_data(data, author_var='screen_name', id_var='id', date_var='created_at', alternate_date_var='date', lang_id_data=None, bucket_count=AUTHOR_TIMELINE_BUCKETS):
+    """
+    Convert raw author post data (from *_tweets.gz files) to typed timeline columns:
+    id (int), screen_name (as written), clean_screen_name (lowercase, for author filters),
+    clean_date (datetime), text, urls, lang (str), lang_score (float),
+    plus partition column (author bucket). Posts are kept
+    as in the files, except posts without numeric ID or author.
+    
+    :param data: author post data
+    :param author_var: author column
+    :param id_var: post ID column
+    :param date_var: date column
+    :param alternate_date_var: date column to use if date_var is missing
+    :param lang_id_data: optional lang ID data (id, lang, lang_score)
+    :param bucket_count: number of author buckets
+    :returns timeline_data:: timeline data
+    """
+    data = data.rename(columns={'user_screen_name' : author_var, 'user_id' : 'author_id'})
+    data = data.assign(**{
+        var : data.loc[:, var].fillna('').astype(str) if var in data.columns else ''
+        for var in [author_var, date_var, alternate_date_var] + AUTHOR_TIMELINE_TXT_VARS
+    })
+    data = clean_date_values(data)
+    clean_author_var = f'clean_{author_var}'
+    data = data.assign(**{
+        id_var : pd.to_numeric(data.loc[:, id_var], errors='coerce'),
+        clean_author_var : data.loc[:, author_var].str.lower(),
+    })
+    valid_data = data.loc[:, id_var].notna() & (data.loc[:, author_var]!='')
+    if(not valid_data.all()):
+        logging.warning('skipping %d/%d posts without numeric ID or author'%((~valid_data).sum(), data.shape[0]))
+    data = data[valid_data]
+    # remove return characters once, so later loads don't have to
+    for txt_var in ['text', 'urls']:
+        data = data.assign(**{
+            txt_var : data.loc[:, txt_var].str.replace(RETURN_CHAR_MATCHER, '', regex=True)
+        })
+    timeline_data = data.loc[:, [id_var, author_var, clean_author_var, 'clean_date'] + AUTHOR_TIMELINE_TXT_VARS].astype({id_var : np.int64})
+    if(lang_id_data is not None):
+        lang_id_data = lang_id_data.loc[:, [id_var, 'lang', 'lang_score']].drop_duplicates(id_var)
+        timeline_data = pd.merge(timeline_data.drop('lang', axis=1), lang_id_data.astype({id_var : np.int64, 'lang' : str}), on=id_var, how='left')
+        timeline_data.fillna({'lang' : ''}, inplace=True)
+    else:
+        timeline_data = timeline_data.assign(**{'lang_score' : np.nan})
+    timeline_data = timeline_data.astype({'lang_score' : np.float32})
+    timeline_data = timeline_data.assign(**{
+        'author_bucket' : get_author_buckets(timeline_data.loc[:, clean_author_var].values, bucket_count=bucket_count),
+    })
+    return timeline_data
+
+def get_author_timeline_schema():
+    """
+    Get Arrow schema for timeline store (see clean_author_timeline_data).
+    """
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('screen_name', pyarrow.string()),
+        ('clean_screen_name', pyarrow.string()),
+        ('clean_date', pyarrow.timestamp('us')),
+        ('text', pyarrow.string()),
+        ('urls', pyarrow.string()),
+        ('lang', pyarrow.string()),
+        ('lang_score', pyarrow.float32()),
+        ('author_bucket', pyarrow.int32()),
+    ])
+
+def write_author_timeline_store(timeline_data_iter, store_dir, max_rows_per_file=10000000, min_rows_per_group=100000, max_rows_per_group=1000000):
+    """
+    Write timeline data to Parquet store in one pass, partitioned by author bucket:
+    each bucket gets a few large files (not one file per write), and date
+    filters use row group statistics. Data is sorted by date
+    within each chunk so that row group date ranges stay narrow.
+    
+    :param timeline_data_iter: timeline data chunks (see clean_author_timeline_data)
+    :param store_dir: store directory
+    :param max_rows_per_file: max rows per Parquet file
+    :param min_rows_per_group: min rows per row group (rows are buffered until then)
+    :param max_rows_per_group: max rows per row group
+    """
+    if(pyarrow is None):
+        raise ImportError('author timeline store requires pyarrow')
+    schema = get_author_timeline_schema()
+    def iter_record_batches():
+        for timeline_data in timeline_data_iter:
+            timeline_data = timeline_data.sort_values('clean_date', kind='stable').loc[:, schema.names]
+            yield pyarrow.RecordBatch.from_pandas(timeline_data, schema=schema, preserve_index=False)
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([('author_bucket', pyarrow.int32())]), flavor='hive')
+    pyarrow.dataset.write_dataset(iter_record_batches(), store_dir, schema=schema, format='parquet', partitioning=partitioning,
+                                  max_rows_per_file=max_rows_per_file, min_rows_per_group=min_rows_per_group, max_rows_per_group=max_rows_per_group,
+                                  existing_data_behavior='overwrite_or_ignore')
+
+def build_author_timeline_store(data_files, store_dir, lang_id_data=None, files_per_batch=500, compression='gzip', bucket_count=AUTHOR_TIMELINE_BUCKETS):
+    """
+    Convert author post files (*_tweets.gz) to Parquet timeline store.
+    Files are read a batch at a time and streamed to one dataset write.
+    
+    :param data_files: author post files
+    :param store_dir: store directory (replaced if it exists)
+    :param lang_id_data: optional lang ID data (id, lang, lang_score)
+    :param files_per_batch: files loaded at once
+    :param compression: file compression type
+    :param bucket_count: number of author buckets
+    :returns post_ctr:: number of posts written
+    """
+    if(pyarrow is None):
+        raise ImportError('author timeline store requires pyarrow')
+    if(os.path.exists(store_dir)):
+        shutil.rmtree(store_dir)
+    post_ctr = 0
+    def iter_timeline_data():
+        nonlocal post_ctr
+        for i in range(0, len(data_files), files_per_batch):
+            data = []
+            for data_file in data_files[i:i+files_per_batch]:
+                try:
+                    data.append(pd.read_csv(data_file, sep='\t', index_col=False, compression=compression, dtype=str))
+                except Exception as e:
+                    logging.info(f'skipped file {data_file} because error {e}')
+            if(len(data) == 0):
+                continue
+            data = pd.concat(data, axis=0, ignore_index=True)
+            timeline_data = clean_author_timeline_data(data, lang_id_data=lang_id_data, bucket_count=bucket_count)
+            post_ctr += timeline_data.shape[0]
+            logging.info('loaded %d posts from %d/%d files for timeline store'%(post_ctr, min(i+files_per_batch, len(data_files)), len(data_files)))
+            yield timeline_data
+    write_author_timeline_store(iter_timeline_data(), store_dir)
+    return post_ctr
+
+def load_author_timelines(store_dir, columns=None, authors=None, start_date=None, end_date=None, author_var='screen_name', bucket_count=AUTHOR_TIMELINE_BUCKETS):
+    """
+    Load author timelines from Parquet store. Only the
+    requested columns are read, and author/date filters skip
+    partitions (author bucket) and row groups (date statistics) that can't match.
+    
+    :param store_dir: store directory
+    :param columns: columns to load (default = all)
+    :param authors: optional authors to include (case-insensitive)
+    :param start_date: optional start date (inclusive)
+    :param end_date: optional end date (exclusive)
+    :param author_var: author column
+    :param bucket_count: number of author buckets used to write store
+    :returns timeline_data:: timeline data
+    """
+    if(pyarrow is None):
+        raise ImportError('author timeline store requires pyarrow')
+    field = pyarrow.dataset.field
+    filters = []
+    if(authors is not None):
+        authors = list(set(map(lambda x: str(x).lower(), authors)))
+        author_buckets = list(set(get_author_buckets(authors, bucket_count=bucket_count).tolist()))
+        filters.append(field('author_bucket').isin(author_buckets))
+        filters.append(field(f'clean_{author_var}').isin(authors))
+    if(start_date is not None):
+        start_date = pd.Timestamp(start_date)
+        filters.append(field('clean_date') >= start_date)
+    if(end_date is not None):
+        end_date = pd.Timestamp(end_date)
+        filters.append(field('clean_date') < end_date)
+    filter_expr = reduce(lambda x,y: x & y, filters) if len(filters) > 0 else None
+    timeline_dataset = pyarrow.dataset.dataset(store_dir, format='parquet', partitioning='hive')
+    timeline_data = timeline_dataset.to_table(columns=columns, filter=filter_expr).to_pandas()
+    return timeline_data
+
+## per-author feature extraction
+AUTHOR_FEATURE_FNS = OrderedDict()
+def register_author_features(name):
+    """
+    Register per-author feature function under name.
+    The function takes one author's posts (data frame)
+    and returns {feature name : value}; it must be defined
+    at module level so that worker processes can load it.
+    
+    :param name: feature set name
+    """
+    def register(feature_fn):
+        AUTHOR_FEATURE_FNS[name] = feature_fn
+        return feature_fn
+    return register
+
+def get_data_files(data_dirs, file_matcher=None):
+    """
+    List data files in directories that match file pattern.
+    
+    :param data_dirs: data directories
+    :param file_matcher: file matcher (default = tweets)
+    :returns data_files:: data files
+    """
+    if(file_matcher is None):
+        file_matcher = re.compile('.*tweets\.gz')
+    data_files = []
+    for data_dir in data_dirs:
+        data_files_i = list(filter(lambda x: file_matcher.search(x) is not None, sorted(os.listdir(data_dir))))
+        data_files_i = list(map(lambda x: os.path.join(data_dir, x), data_files_i))
+        data_files += list(filter(lambda x: not os.path.isdir(x), data_files_i))
+    return data_files
+
+def extract_author_features_from_file(data_file, feature_fns=[], author_var='screen_name', use_cols=None, compression='gzip', clean_data_fn=None):
+    """
+    Load one author data file and compute features for each author in the file.
+    
+    :param data_file: author data file
+    :param feature_fns: per-author feature functions
+    :param author_var: author column
+    :param use_cols: columns to include from data
+    :param compression: file compression type
+    :param clean_data_fn: optional function to clean file data before computing features
+    :returns author_features:: feature rows, one per author
+    """
+    try:
+        if(use_cols is None):
+            data = pd.read_csv(data_file, sep='\t', index_col=False, compression=compression)
+        else:
+            data = pd.read_csv(data_file, sep='\t', index_col=False, compression=compression, usecols=lambda x: x in use_cols)
+    except Exception as e:
+        logging.info(f'skipped file {data_file} because error {e}')
+        return []
+    data = data.fillna('')
+    data = data.assign(**{
+        author_var : data.loc[:, author_var].astype(str)
+    })
+    data = data[data.loc[:, author_var]!='']
+    if(clean_data_fn is not None):
+        data = clean_data_fn(data)
+    author_features = []
+    for author_i, data_i in data.groupby(author_var):
+        author_features_i = {author_var : author_i}
+        for feature_fn in feature_fns:
+            author_features_i.update(feature_fn(data_i))
+        author_features.append(author_features_i)
+    return author_features
+
+def extract_author_features(data_files, feature_names, out_file, author_var='screen_name', workers=1, use_cols=None, compression='gzip', clean_data_fn=None):
+    """
+    Compute registered per-author features over all author files in one pass:
+    each file is processed independently in a process pool (bounded number of
+    files in flight) and feature rows are appended to the output table as they finish.
+    Assumes that all posts by an author are in the same file.
+    
+    :param data_files: author data files
+    :param feature_names: registered feature set names (see register_author_features)
+    :param out_file: output .tsv file (one row per author)
+    :param author_var: author column
+    :param workers: number of processes
+    :param use_cols: columns to include from data
+    :param compression: file compression type
+    :param clean_data_fn: optional function to clean file data before computing features
+    :returns author_ctr:: number of authors written
+    """
+    feature_fns = [AUTHOR_FEATURE_FNS[feature_name] for feature_name in feature_names]
+    file_fn = partial(extract_author_features_from_file, feature_fns=feature_fns, author_var=author_var, use_cols=use_cols, compression=compression, clean_data_fn=clean_data_fn)
+    author_ctr = 0
+    feature_cols = None
+    with open(out_file, 'w') as out_file_output:
+        for i, author_features in enumerate(run_ordered_batches(file_fn, data_files, workers=workers)):
+            if(len(author_features) > 0):
+                author_features = pd.DataFrame(author_features)
+                # fix columns from first output
+                if(feature_cols is None):
+                    feature_cols = list(author_features.columns)
+                author_features = author_features.reindex(columns=feature_cols)
+                author_features.to_csv(out_file_output, sep='\t', index=False, header=(author_ctr==0))
+                author_ctr += author_features.shape[0]
+            if(i % 1000 == 0):
+                logging.info('processed %d/%d files, %d authors'%(i+1, len(data_files), author_ctr))
+    return author_ctr
+
 ## significance testing
 def binom_test(p_1, p_2, n_1, n_2):
     """
@@ -7,7 +7,7 @@ We have already extracted extra data about Spotify tracks/artists in extract_spo
 """
 from argparse import ArgumentParser
 import logging
-from data_helpers import load_data_from_dirs, load_artist_names, clean_date_values, try_literal_eval, extract_URL_matches
+from data_helpers import load_data_from_dirs, load_artist_names, clean_date_values, try_literal_eval, extract_URL_matches, load_author_timelines
 import os
 import re
 from functools import reduce
@@ -24,11 +24,15 @@ def get_match(txt, matcher):
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument('data_dirs', nargs='+')
+    parser.add_argument('data_dirs', nargs='*')
     parser.add_argument('--out_dir', default='../../data/mined_tweets/')
     parser.add_argument('--media_id_data', default='../../data/culture_metadata/spotify_track_data.tsv')
     parser.add_argument('--media_artist_data', default='../../data/culture_metadata/spotify_musician_data.tsv')
+    parser.add_argument('--timeline_store_dir', default=None) # load posts from timeline store instead of data_dirs (output files named after store dir), e.g. ../../data/mined_tweets/loanword_author_tweets_all_archives_timelines/
     args = vars(parser.parse_args())
+    # load author posts from either data dirs or timeline store
+    if((len(args['data_dirs']) > 0) == (args.get('timeline_store_dir') is not None)):
+        parser.error('provide either data_dirs or --timeline_store_dir')
     logging_file = '../../output/extract_music_sharing_for_authors.txt'
     if(os.path.exists(logging_file)):
         os.remove(logging_file)
@@ -36,12 +40,16 @@ def main():
     
     ## load author data
     data_dirs = args['data_dirs']
-    file_matcher = re.compile('.+tweets\.gz')
-    use_cols = ['urls', 'screen_name', 'created_at', 'date']
-    combined_data = load_data_from_dirs(data_dirs, file_matcher=file_matcher, compression='gzip', use_cols=use_cols)
-    combined_data.fillna('', inplace=True)
-    # fix date variable
-    combined_data = clean_date_values(combined_data)
+    # columnar store: dates already clean
+    if(args.get('timeline_store_dir') is not None):
+        combined_data = load_author_timelines(args['timeline_store_dir'], columns=['urls', 'screen_name', 'clean_date'])
+    else:
+        file_matcher = re.compile('.+tweets\.gz')
+        use_cols = ['urls', 'screen_name', 'created_at', 'date']
+        combined_data = load_data_from_dirs(data_dirs, file_matcher=file_matcher, compression='gzip', use_cols=use_cols)
+        combined_data.fillna('', inplace=True)
+        # fix date variable
+        combined_data = clean_date_values(combined_data)
     logging.info(combined_data.head())
     
     ## extract media links
@@ -181,7 +189,10 @@ def main():
     
     ## save full data and artist count data
     out_dir = args['out_dir']
-    data_dir_base = os.path.basename(os.path.normpath(data_dirs[0]))
+    if(args.get('timeline_store_dir') is not None):
+        data_dir_base = os.path.basename(os.path.normpath(args['timeline_store_dir']))
+    else:
+        data_dir_base = os.path.basename(os.path.normpath(data_dirs[0]))
     author_media_out_file = os.path.join(out_dir, f'{data_dir_base}_author_spotify_link_data.tsv')
     author_media_counts_out_file = os.path.join(out_dir, f'{data_dir_base}_author_spotify_counts.tsv')
     author_media_data.to_csv(author_media_out_file, sep='\t', index=False)
@@ -12,85 +12,106 @@ Compute data for loanword and native verb posts.
 from argparse import ArgumentParser
 import logging
 import os
-from datetime import datetime
 import re
 import numpy as np
 import pandas as pd
-from pandas import Timestamp
-from data_helpers import clean_txt_simple
+from data_helpers import clean_txt_simple, parse_dates
 
-def convert_to_day(txt_date, date_matchers, date_formats):
+def compute_prior_counts(events, queries, author_var, date_var, event_vars):
     """
-    Convert text to date, according to matching dates. 
-    """
-    date_day = None
-    for date_matcher, date_format in zip(date_matchers, date_formats):
-        try:
-            txt_day = date_matcher.search(txt_date.strip()).group(0)
-            date_day = datetime.strptime(txt_day, date_format)
-        except Exception as e:
-            pass
-    if(date_day is None):
-        print(txt_date)
-        raise Exception('bad')
-    # round down to nearest day
-    if(date_day is not None):
-        date_day = datetime(year=date_day.year, month=date_day.month, day=date_day.day)
-    return date_day
-
-def compute_prior_integrated_verb_rate(data, date_var):
-    """
-    Compute prior integrated verb rate for all authors
-    in data.
+    Count events per author strictly before query dates:
+    for each query (author, date), sum event_vars over
+    the author's events on earlier dates.
+    Events are sorted once by (author, date) and summed cumulatively,
+    and each query is a binary search => O((N+M) log N).
+    
+    :param events: event data (author, date, event indicators/counts)
+    :param queries: query data (author, date)
+    :param author_var: author column
+    :param date_var: date column (e.g. day)
+    :param event_vars: event columns to sum
+    :returns prior_counts:: prior event counts per query (same order as queries; NaN for missing author/date)
     """
-    unique_dates = list(map(lambda x: Timestamp(x), data.loc[:, date_var].unique()))
-    per_date_integrated_counts = data[data.loc[:, 'verb_is_integrated']==1].loc[:, date_var].value_counts().sort_index(ascending=True)
-    # add zeros
-    zero_dates = list(set(unique_dates) - set(per_date_integrated_counts.index))
-    if(len(zero_dates) > 0):
-        zero_dates = pd.Series([0,]*len(zero_dates), index=zero_dates)
-        per_date_integrated_counts = per_date_integrated_counts.append(zero_dates).sort_index(ascending=True)
-    per_date_cumulative_integrated_counts = per_date_integrated_counts.cumsum()
-    return per_date_cumulative_integrated_counts
+    events = events[events.loc[:, author_var].notna() & events.loc[:, date_var].notna()]
+    valid_queries = (queries.loc[:, author_var].notna() & queries.loc[:, date_var].notna()).values
+    query_authors = queries.loc[:, author_var][valid_queries]
+    query_dates = pd.to_datetime(queries.loc[:, date_var][valid_queries]).values
+    # (author, date) => one sortable key: author code * date count + date rank
+    authors = pd.Index(pd.concat([events.loc[:, author_var], query_authors]).unique())
+    event_author_codes = authors.get_indexer(events.loc[:, author_var]).astype(np.int64)
+    query_author_codes = authors.get_indexer(query_authors).astype(np.int64)
+    event_dates = pd.to_datetime(events.loc[:, date_var]).values
+    unique_dates, date_ranks = np.unique(np.concatenate([event_dates, query_dates]), return_inverse=True)
+    date_count = len(unique_dates)
+    event_keys = event_author_codes * date_count + date_ranks[:len(event_dates)]
+    query_keys = query_author_codes * date_count + date_ranks[len(event_dates):]
+    sort_idx = np.argsort(event_keys, kind='mergesort')
+    event_keys = event_keys[sort_idx]
+    # events before query date, minus events before author's first date
+    prior_idx = np.searchsorted(event_keys, query_keys, side='left')
+    author_start_idx = np.searchsorted(event_keys, query_author_codes * date_count, side='left')
+    prior_counts = pd.DataFrame(np.nan, index=queries.index, columns=event_vars)
+    for event_var in event_vars:
+        cumulative_counts = np.concatenate([[0], np.cumsum(events.loc[:, event_var].values[sort_idx])])
+        prior_counts_i = np.full(queries.shape[0], np.nan)
+        prior_counts_i[valid_queries] = cumulative_counts[prior_idx] - cumulative_counts[author_start_idx]
+        prior_counts.loc[:, event_var] = prior_counts_i
+    return prior_counts
 
-def shift_author_dates_forward(data, date_var, author_var, shift=1):
+def add_prior_use_features(data, loanword_events, native_verb_events, author_var, date_var):
     """
-    Shift dates for authors forward by X times.
+    Add author's prior loanword and native verb use to posts,
+    i.e. counts and integrated rates over the author's posts on earlier days.
+    Events have one row per post, with "post" = 1 and "verb_is_integrated".
     """
-    shifted_data = []
-    for author_i, data_i in data.groupby(author_var):
-        data_i.sort_values(date_var, ascending=False, inplace=True)
-        data_i = data_i.iloc[shift:, :]
-        shifted_data.append(data_i)
-    shifted_data = pd.concat(shifted_data, axis=0)
-    return shifted_data
+    event_vars = ['post', 'verb_is_integrated']
+    prior_loanword_counts = compute_prior_counts(loanword_events, data, author_var, date_var, event_vars)
+    prior_native_verb_counts = compute_prior_counts(native_verb_events, data, author_var, date_var, event_vars)
+    # no prior posts => NaN rate
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data = data.assign(**{
+            'prior_loanword_count' : prior_loanword_counts.loc[:, 'post'].values,
+            'prior_integrated_loanword_count' : prior_loanword_counts.loc[:, 'verb_is_integrated'].values,
+            'integrated_loanword_pct' : (prior_loanword_counts.loc[:, 'verb_is_integrated'] / prior_loanword_counts.loc[:, 'post']).values,
+            'native_verb_integrated_pct' : (prior_native_verb_counts.loc[:, 'verb_is_integrated'] / prior_native_verb_counts.loc[:, 'post']).values,
+        })
+    return data
 
 def align_counts(data_1, data_2, author_var, date_var, count_var):
     """
     Align new data_2 with dates from data_1.
+    For each data_1 row, get count_var from the data_2 row with
+    the same author and the latest date <= data_1 date
+    (backward as-of join); data_1 rows without an earlier
+    data_2 row are dropped. Rows are sorted by author
+    and keep their data_1 order within author.
+    (author, date) keys are searched in sorted array => O(N log N)
+    instead of scanning all of the author's data_2 rows per row.
     """
-    # need to connect count data from data_2 to data_1
-    # get count 1 data at time t, align with count 2 data at time {max(t') \in t'<=t}
-    aligned_data = []
-    for author_i, data_1_i in data_1.groupby(author_var):
-        data_2_i = data_2[data_2.loc[:, author_var] == author_i]
-        if(data_2_i.shape[0] > 0):
-            aligned_data_i = []
-            for idx_j, data_1_j in data_1_i.iterrows():
-                date_1_j = data_1_j.loc[date_var]
-                data_2_j = data_2_i.assign(**{
-                    'date_diff' : (date_1_j - data_2_i.loc[:, date_var]).apply(lambda x: x.days)
-                })
-                data_2_j = data_2_j[data_2_j.loc[:, 'date_diff'] >= 0.]
-                if(data_2_j.shape[0] > 0):
-                    data_2_j.sort_values('date_diff', inplace=True, ascending=True)
-                    data_2_j = data_2_j.iloc[0, :].loc[[count_var]]
-                    data_1_j = data_1_j.append(data_2_j)
-                    aligned_data_i.append(data_1_j)
-            if(len(aligned_data_i) > 0):
-                aligned_data_i = pd.concat(aligned_data_i, axis=1).transpose()
-                aligned_data.append(aligned_data_i)
-    aligned_data = pd.concat(aligned_data, axis=0)
+    data_1 = data_1[data_1.loc[:, author_var].notna() & data_1.loc[:, date_var].notna()]
+    data_2 = data_2[data_2.loc[:, author_var].notna() & data_2.loc[:, date_var].notna()]
+    # same order as groupby: sorted authors, original order within author
+    data_1 = data_1.sort_values(author_var, kind='mergesort')
+    # combine (author, date) into one sortable key: author code * date count + date rank
+    authors = pd.Index(pd.concat([data_1.loc[:, author_var], data_2.loc[:, author_var]]).unique())
+    author_codes_1 = authors.get_indexer(data_1.loc[:, author_var]).astype(np.int64)
+    author_codes_2 = authors.get_indexer(data_2.loc[:, author_var]).astype(np.int64)
+    dates_1 = pd.to_datetime(data_1.loc[:, date_var]).values
+    dates_2 = pd.to_datetime(data_2.loc[:, date_var]).values
+    unique_dates, date_ranks = np.unique(np.concatenate([dates_1, dates_2]), return_inverse=True)
+    date_count = len(unique_dates)
+    keys_1 = author_codes_1 * date_count + date_ranks[:len(dates_1)]
+    keys_2 = author_codes_2 * date_count + date_ranks[len(dates_1):]
+    # stable sort => same-date ties resolve to last data_2 row
+    sort_idx_2 = np.argsort(keys_2, kind='mergesort')
+    keys_2 = keys_2[sort_idx_2]
+    # latest data_2 key <= data_1 key, from same author
+    match_idx = np.searchsorted(keys_2, keys_1, side='right') - 1
+    has_match = match_idx >= 0
+    has_match[has_match] = author_codes_2[sort_idx_2[match_idx[has_match]]] == author_codes_1[has_match]
+    aligned_data = data_1[has_match].assign(**{
+        count_var : data_2.loc[:, count_var].values[sort_idx_2[match_idx[has_match]]]
+    })
     return aligned_data
 
 def compute_content_features(data, word_var='loanword_verb'):
@@ -205,23 +226,14 @@ def main():
         '%a %b %d %H:%M:%S +0000 %Y',
     ]
     native_verb_data = native_verb_data.assign(**{
-        date_day_var : native_verb_data.loc[:, date_var].apply(lambda x: convert_to_day(x, date_matchers, date_formats))
+        date_day_var : parse_dates(native_verb_data.loc[:, date_var], date_formats, date_matchers=date_matchers)
     })
-    # compute prior native integrated verb count
     author_var = 'screen_name'
     clean_author_var = 'clean_screen_name'
     native_verb_data = native_verb_data.assign(**{
         'verb_is_integrated' : (native_verb_data.loc[:, 'native_word_category']=='native_integrated_verb').astype(int),
         clean_author_var : native_verb_data.loc[:, author_var].apply(lambda x: x.lower()),
     })
-    per_author_native_verb_counts = native_verb_data.groupby([clean_author_var]).apply(lambda x: x.loc[:, date_day_var].value_counts().sort_index(ascending=True).cumsum()).reset_index().rename(columns={'level_1' : date_day_var, date_day_var : 'native_verb_count'})
-    per_author_native_verb_integrated_counts = native_verb_data.groupby(clean_author_var).apply(lambda x: compute_prior_integrated_verb_rate(x, date_day_var)).reset_index().rename(columns={'level_1' : date_day_var, 0 : 'native_verb_integrated_count'})
-    # combine
-    author_native_verb_counts = pd.merge(per_author_native_verb_counts, per_author_native_verb_integrated_counts, on=[clean_author_var, date_day_var], how='left')
-    # compute native integrated verb percent
-    author_native_verb_counts = author_native_verb_counts.assign(**{
-        'native_verb_integrated_pct' : author_native_verb_counts.loc[:, 'native_verb_integrated_count'] / author_native_verb_counts.loc[:, 'native_verb_count']
-    })
     
     ## content features: hashtags, @-mentions, post length
     combined_loanword_data = compute_content_features(combined_loanword_data, word_var='loanword_verb')
@@ -239,36 +251,20 @@ def main():
     ]
     date_day_var = 'date_day'
     combined_loanword_data = combined_loanword_data.assign(**{
-        date_day_var : combined_loanword_data.loc[:, date_var].apply(lambda x: convert_to_day(x, date_matchers, date_formats))
-    })
-    clean_author_var = 'clean_screen_name'
-    author_integrated_loanword_per_date_counts = combined_loanword_data.groupby(clean_author_var).apply(lambda x: compute_prior_integrated_verb_rate(x, date_day_var)).reset_index().rename(columns={'level_1' : date_day_var, date_day_var : 'prior_integrated_loanword_count'})
-    clean_author_var = 'clean_screen_name'
-    loanword_var = 'loanword'
-    date_day_var = 'date_day'
-    author_loanword_per_date_counts = combined_loanword_data.groupby([clean_author_var]).apply(lambda x: x.loc[:, date_day_var].value_counts().sort_index(ascending=True).cumsum()).reset_index().rename(columns={'level_1' : date_day_var, date_day_var : 'prior_loanword_count'})
-    author_integrated_loanword_per_date_counts = combined_loanword_data.groupby(clean_author_var).apply(lambda x: compute_prior_integrated_verb_rate(x, date_day_var)).reset_index().rename(columns={'level_1' : date_day_var, 0 : 'prior_integrated_loanword_count'})
-    ## combine 
-    author_loanword_prior_counts = pd.merge(author_loanword_per_date_counts, author_integrated_loanword_per_date_counts, on=[clean_author_var, date_day_var])
-    ## compute prior rate of integrated loanword/native verb use
-    author_loanword_prior_counts = author_loanword_prior_counts.assign(**{
-        'integrated_loanword_pct' : author_loanword_prior_counts.loc[:, 'prior_integrated_loanword_count'] / author_loanword_prior_counts.loc[:, 'prior_loanword_count']
+        date_day_var : parse_dates(combined_loanword_data.loc[:, date_var], date_formats, date_matchers=date_matchers)
     })
-    date_shift = 1
-    author_loanword_prior_counts = shift_author_dates_forward(author_loanword_prior_counts, date_day_var, clean_author_var, shift=date_shift)
+    ## prior loanword/native verb use: counts and integrated rates
+    ## over author's posts on earlier days
     clean_author_var = 'clean_screen_name'
-    date_var = 'date_day'
-    count_var = 'native_verb_integrated_pct'
-    author_prior_word_use_data = align_counts(author_loanword_prior_counts, author_native_verb_counts, clean_author_var, date_var, count_var)
-    ## join with prior data
+    event_vars = ['post', 'verb_is_integrated']
+    loanword_events = combined_loanword_data.assign(**{'post' : 1}).loc[:, [clean_author_var, date_day_var] + event_vars]
+    native_verb_events = native_verb_data.assign(**{'post' : 1}).loc[:, [clean_author_var, date_day_var] + event_vars]
     prior_count_vars = ['prior_loanword_count', 'prior_integrated_loanword_count']
     for prior_count_var in prior_count_vars:
         if(prior_count_var in combined_loanword_data.columns):
             combined_loanword_data.drop(prior_count_var, axis=1, inplace=True)
-    combined_loanword_data = pd.merge(combined_loanword_data, author_loanword_prior_counts, on=[clean_author_var, date_day_var], how='left')
-    combined_loanword_data = pd.merge(combined_loanword_data, author_prior_word_use_data.loc[:, ['clean_screen_name', 'date_day', 'native_verb_integrated_pct']], on=['clean_screen_name', 'date_day'], how='left')
-    native_verb_data = pd.merge(native_verb_data, author_loanword_prior_counts, on=[clean_author_var, date_day_var], how='left')
-    native_verb_data = pd.merge(native_verb_data, author_prior_word_use_data.loc[:, ['clean_screen_name', 'date_day', 'native_verb_integrated_pct']], on=['clean_screen_name', 'date_day'], how='left')
+    combined_loanword_data = add_prior_use_features(combined_loanword_data, loanword_events, native_verb_events, clean_author_var, date_day_var)
+    native_verb_data = add_prior_use_features(native_verb_data, loanword_events, native_verb_events, clean_author_var, date_day_var)
     # fix missing vals
     combined_loanword_data.fillna(value={prior_count_var : 0. for prior_count_var in prior_count_vars}, inplace=True)
     native_verb_data.fillna(value={prior_count_var : 0. for prior_count_var in prior_count_vars}, inplace=True)
@@ -11,14 +11,11 @@ import re
 # from nltk.corpus import stopwords # incomplete list
 from stop_words import get_stop_words
 from unidecode import unidecode
-import gzip
-from bz2 import BZ2File
 import numpy as np
 import pandas as pd
 import json
 from nltk.tokenize import word_tokenize
-import lzma
-from data_helpers import ZstdWrapper
+from data_helpers import get_file_iter, load_lang_id_store
 
 HASH_MATCHER = re.compile('#[^\s#]+')
 USER_MATCHER = re.compile('@\w+')
@@ -62,8 +59,8 @@ def main():
     ## if provided, load language lookup for filtering
     if('lang_id_dir' in args):
         lang_id_file = os.path.join(os.path.join(data_file_dir, args['lang_id_dir']), data_file_name_base.replace('.%s'%(data_file_ext), '_lang_id.tsv.gz'))
-        lang_id_df = pd.read_csv(lang_id_file, sep='\t', index_col=False, compression='gzip', header=None, names=['id', 'lang', 'score'])
-        lang_ids = set(lang_id_df[lang_id_df.loc[:, 'lang']==args['lang']].loc[:, 'id'].unique())
+        lang_id_store = load_lang_id_store(lang_id_file)
+        lang_ids = lang_id_store.get_id_set(lang=args['lang'])
     
     ## collect text
     ## TODO: make this an iterator
@@ -74,17 +71,9 @@ def main():
     post_ctr = 0
     valid_post_ctr = 0
     try:
-        if(data_file_ext == 'gz'):
-            data_input = gzip.open(args['data_file_name'], 'r')
-        elif(data_file_ext == 'bz2'):
-            data_input = BZ2File(args['data_file_name'], 'r')
-        elif(data_file_ext == 'xz'):
-            data_input = lzma.open(args['data_file_name'])
-        elif(data_file_ext == 'zst'):
-            data_input = ZstdWrapper(args['data_file_name']) # WARNING returns list of lines to process
+        # batches of lines
+        data_input = get_file_iter(args['data_file_name'])
         for lines in data_input:
-            if(type(lines) is str or type(lines) is bytes):
-                lines = [lines]
             for l in lines:
                 try:
                     l_data = json.loads(l)
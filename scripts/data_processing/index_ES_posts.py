@@ -6,15 +6,19 @@ from argparse import ArgumentParser
 import logging
 import os
 from subprocess import Popen
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, helpers, TransportError, ConnectionTimeout
 from time import sleep
 import re
-import cld2
-from data_helpers import get_file_iter, clean_txt_simple
+from data_helpers import get_file_iter, clean_txt_simple, JSONLineDecoder, LangIDCache, init_lang_id_model, get_lang_id_cache, run_ordered_batches, SHINGLE_SUBFIELD, QueryResultCache
 import json
+import hashlib
 from math import ceil
 from datetime import datetime
 from collections import deque
+from functools import partial
+from threading import Thread, Lock
+from queue import Queue
+from time import time
 from dateutil import parser as date_parser
 
 URL_MATCHER=re.compile('\(http://[^\)]+\)|\(www\.[^\)]+\)')
@@ -42,71 +46,140 @@ def get_val_from_recursive_key(key, data):
             break
     return val
 
+def add_shingle_subfield(body, txt_var, post_type, max_shingle_size=3, text_field_type='string'):
+    """
+    Add shingle subfield to index settings/mapping
+    (e.g. body.shingles), which indexes 2..max_shingle_size word
+    phrases as single terms for fast exact phrase queries.
+    Text field is analyzed with same tokenizer, without shingles.
+    
+    :param body: index creation body (settings + mappings)
+    :param txt_var: text field
+    :param post_type: doc type
+    :param max_shingle_size: max words per shingle
+    :param text_field_type: text field type ("string" for ES 2.x, "text" for ES 5+)
+    :returns body:: updated body
+    """
+    analysis = body.setdefault('settings', {}).setdefault('analysis', {})
+    analysis.setdefault('filter', {})['phrase_shingles'] = {
+        'type' : 'shingle',
+        'min_shingle_size' : 2,
+        'max_shingle_size' : max_shingle_size,
+        'output_unigrams' : False,
+    }
+    analysis.setdefault('analyzer', {})
+    analysis['analyzer']['%s_%s'%(txt_var, SHINGLE_SUBFIELD)] = {
+        'type' : 'custom',
+        'tokenizer' : 'classic',
+        'filter' : ['lowercase', 'phrase_shingles'],
+    }
+    txt_mapping = body.setdefault('mappings', {}).setdefault(post_type, {}).setdefault('properties', {}).setdefault(txt_var, {'type' : text_field_type})
+    # keep analyzer from mapping file; otherwise tokenize like the shingles
+    if('analyzer' not in txt_mapping and 'index' not in txt_mapping):
+        plain_analyzer = '%s_plain'%(txt_var)
+        analysis['analyzer'].setdefault(plain_analyzer, {
+            'type' : 'custom',
+            'tokenizer' : 'classic',
+            'filter' : ['lowercase'],
+        })
+        txt_mapping['analyzer'] = plain_analyzer
+    txt_mapping.setdefault('fields', {})[SHINGLE_SUBFIELD] = {
+        'type' : text_field_type,
+        'analyzer' : '%s_%s'%(txt_var, SHINGLE_SUBFIELD),
+    }
+    return body
+
+def get_post_data_converters(data_fields):
+    """
+    Split data fields into regular and recursive fields (e.g. user.bio)
+    and get converters for fields that need them (e.g. date).
+    """
+    recursive_data_fields = list(filter(lambda x: '.' in x, data_fields))
+    data_fields = list(filter(lambda x: x not in recursive_data_fields, data_fields))
+    data_field_converters = {'created_at' : date_parser.parse}
+    data_field_converters = {data_field : data_field_converters[data_field] for data_field in set(data_fields) & set(data_field_converters.keys())}
+    return data_fields, recursive_data_fields, data_field_converters
+
+def convert_post_data(complete_data_i, ES_index, post_type, post_subset, txt_var, data_fields, recursive_data_fields, data_field_converters, lang_id_cache):
+    """
+    Convert raw post to dict to be indexed by ES,
+    with language ID and score.
+    Returns None for deleted posts.
+    """
+    if('delete' in complete_data_i.keys()):
+        return None
+    data_i = {data_field : complete_data_i[data_field] for data_field in data_fields}
+    # convert fields when needed, e.g. date
+    for data_field, data_field_converter in data_field_converters.items():
+        data_i[data_field] = data_field_converter(data_i[data_field])
+    # collect recursive data, e.g. user.bio
+    for recursive_data_field in recursive_data_fields:
+        data_i_j = get_val_from_recursive_key(recursive_data_field, complete_data_i)
+        if(data_i_j is not None):
+            data_i[recursive_data_field.replace('.', '_')] = data_i_j
+    # add tokenized text
+#     data_i[tokenized_txt_var] = data_i[txt_var]
+    data_i['_type'] = post_type
+    data_i['_index'] = ES_index
+    data_i['_id'] = "t%d_%s"%(post_subset, data_i['id']) #setting fullname as ID to avoid duplicates
+    txt = data_i[txt_var]
+    if(post_type == 'reddit'):
+        txt_clean = clean_txt_reddit(txt)
+    else:
+        txt_clean = clean_txt_simple(txt)
+    # add lang ID and score
+    txt_lang, txt_lang_conf_score = lang_id_cache.detect(txt)
+    data_i['lang'] = txt_lang
+    data_i['lang_score'] = txt_lang_conf_score
+    return data_i
+
 # tmp debugging
 # need global because function is used as iterator
 LINE_CTR=0
 FILE_CTR=0
-def convert_file_to_dict(post_files, ES_index, post_type, post_subset, txt_var='body', data_fields=['body', 'subreddit', 'id', 'author', 'author_flair_text', 'created_utc', 'parent_id', 'score'], valid_langs=None):
+def convert_file_to_dict(post_files, ES_index, post_type, post_subset, txt_var='body', data_fields=['body', 'subreddit', 'id', 'author', 'author_flair_text', 'created_utc', 'parent_id', 'score'], valid_langs=None, json_backend=None, lang_id_cache_file=None):
     """
     Read JSON from file and convert to dict
     to be indexed by ES.
+    Optional fast JSON decoding (json_backend) skips deleted/withheld
+    records before parsing and only extracts data_fields.
+    Lang ID results are cached by text hash (lang_id_cache_file => on disk).
     """
     global LINE_CTR
     global FILE_CTR
+    if(json_backend is not None):
+        json_decoder = JSONLineDecoder(backend=json_backend, fields=data_fields)
+    else:
+        json_decoder = None
+    lang_id_cache = LangIDCache(cache_file=lang_id_cache_file, backend='cld2')
     # separate regular and recursive data fields
     # e.g. user.bio
-    recursive_data_fields = list(filter(lambda x: '.' in x, data_fields))
-    recursive_data_field_tuples = list(map(lambda x: x.split('.'), recursive_data_fields))
-    data_fields = list(filter(lambda x: x not in recursive_data_fields, data_fields))
+    data_fields, recursive_data_fields, data_field_converters = get_post_data_converters(data_fields)
     # tmp debugging
     line_cutoff = 100000
     test_valid_lang = valid_langs is not None
-    # convert fields when needed, e.g. date
-    data_field_converters = {'created_at' : date_parser.parse}
-    data_fields_to_convert = list(set(data_fields) & set(data_field_converters.keys()))
-    # TODO: experiment with 2-gram indexing (shingles??) for faster queries
+    # 2-gram indexing: see add_shingle_subfield
 #     tokenized_txt_var = f'{txt_var}_tokenized'
     for post_file in post_files:
         logging.warning('starting to process file %s'%(post_file))
         try:
             post_iter = get_file_iter(post_file)
             for lines in post_iter:
-                if(type(lines) is not list):
-                    lines = [lines]
                 for line_i in lines:
                     try:
-                        complete_data_i = json.loads(line_i)
-                        if('delete' not in complete_data_i.keys()):
-                            data_i = {data_field : complete_data_i[data_field] for data_field in data_fields}
-                            # convert fields when needed, e.g. date
-                            for data_field in data_fields_to_convert:
-                                data_i[data_field] = data_field_converters[data_field](data_i[data_field])
-                            # collect recursive data, e.g. user.bio
-                            for recursive_data_field in recursive_data_fields:
-                                data_i_j = get_val_from_recursive_key(recursive_data_field, complete_data_i)
-                                if(data_i_j is not None):
-                                    data_i[recursive_data_field.replace('.', '_')] = data_i_j
-                            # add tokenized text
-#                             data_i[tokenized_txt_var] = data_i[txt_var]
-                            data_i['_type'] = post_type
-                            data_i['_index'] = ES_index
-                            data_i['_id'] = "t%d_%s"%(post_subset, data_i['id']) #setting fullname as ID to avoid duplicates
-                            txt = data_i[txt_var]
-                            if(post_type == 'reddit'):
-                                txt_clean = clean_txt_reddit(txt)
-                            else:
-                                txt_clean = clean_txt_simple(txt)
-                            # add lang ID and score
-                            txt_lang_results = cld2.detect(txt).details
-                            txt_lang = txt_lang_results[0].language_code
-                            txt_lang_conf_score = txt_lang_results[0].percent
-                            data_i['lang'] = txt_lang
-                            data_i['lang_score'] = txt_lang_conf_score
-                            if(not test_valid_lang or txt_lang in valid_langs):
-                                LINE_CTR += 1
-                                if(LINE_CTR % 100000 == 0):
-                                    logging.warning('processed %d lines'%(LINE_CTR))
-                                yield(data_i)
+                        if(json_decoder is not None):
+                            # deleted/withheld posts => None
+                            complete_data_i = json_decoder.decode(line_i)
+                            if(complete_data_i is None):
+                                continue
+                        else:
+                            complete_data_i = json.loads(line_i)
+                        data_i = convert_post_data(complete_data_i, ES_index, post_type, post_subset, txt_var, data_fields, recursive_data_fields, data_field_converters, lang_id_cache)
+                        if(data_i is not None and (not test_valid_lang or data_i['lang'] in valid_langs)):
+                            LINE_CTR += 1
+                            if(LINE_CTR % 100000 == 0):
+                                logging.warning('processed %d lines'%(LINE_CTR))
+                            yield(data_i)
                     except Exception as e:
                         logging.warning('bad line with error %s'%(e))
 #                 if(LINE_CTR >= line_cutoff):
@@ -118,9 +191,374 @@ def convert_file_to_dict(post_files, ES_index, post_type, post_subset, txt_var='
             pass
         FILE_CTR += 1
         logging.warning('%d files done; finished file %s'%(FILE_CTR, post_file))
+        logging.warning('lang ID cache hits = %d, misses = %d'%(lang_id_cache.hit_ctr, lang_id_cache.miss_ctr))
+        lang_id_cache.flush()
 #         if(LINE_CTR >= line_cutoff):
 #             logging.warning('line cutoff at lines=%d'%(LINE_CTR))
 #             break
+    lang_id_cache.close()
+
+## streaming bulk ingestion
+## parse workers (processes) => doc queue => batcher => bulk queue => senders (threads)
+## bounded queues: a slow stage blocks the stages before it
+def serialize_bulk_val(val):
+    # same as ES client serializer
+    if(isinstance(val, datetime)):
+        return val.isoformat()
+    return str(val)
+
+def serialize_bulk_doc(data_i):
+    """
+    Serialize doc as bulk action + source lines (bytes).
+    """
+    action = {'index' : {'_index' : data_i.pop('_index'), '_type' : data_i.pop('_type'), '_id' : data_i.pop('_id')}}
+    return ('%s\n%s\n'%(json.dumps(action), json.dumps(data_i, default=serialize_bulk_val))).encode('utf-8')
+
+# one JSON decoder per (worker) process
+JSON_DECODERS = {}
+def init_post_converter(lang_id_cache_file=None):
+    init_lang_id_model('cld2', cache_file=lang_id_cache_file)
+
+def convert_line_batch(lines, ES_index, post_type, post_subset, txt_var='body', data_fields=['body', 'subreddit', 'id', 'author', 'author_flair_text', 'created_utc', 'parent_id', 'score'], valid_langs=None, json_backend=None):
+    """
+    Decode, clean and lang-ID batch of JSON lines
+    and serialize valid posts for bulk indexing.
+    
+    :returns docs, line_ctr, error_ctr:: serialized docs, lines in batch, bad lines
+    """
+    if(json_backend is not None):
+        json_decoder_key = (json_backend, tuple(data_fields))
+        if(json_decoder_key not in JSON_DECODERS):
+            JSON_DECODERS[json_decoder_key] = JSONLineDecoder(backend=json_backend, fields=data_fields)
+        json_decoder = JSON_DECODERS[json_decoder_key]
+    else:
+        json_decoder = None
+    lang_id_cache = get_lang_id_cache('cld2')
+    data_fields, recursive_data_fields, data_field_converters = get_post_data_converters(data_fields)
+    docs = []
+    error_ctr = 0
+    for line_i in lines:
+        try:
+            if(json_decoder is not None):
+                complete_data_i = json_decoder.decode(line_i)
+                if(complete_data_i is None):
+                    continue
+            else:
+                complete_data_i = json.loads(line_i)
+            data_i = convert_post_data(complete_data_i, ES_index, post_type, post_subset, txt_var, data_fields, recursive_data_fields, data_field_converters, lang_id_cache)
+            if(data_i is not None and (valid_langs is None or data_i['lang'] in valid_langs)):
+                docs.append(serialize_bulk_doc(data_i))
+        except Exception as e:
+            error_ctr += 1
+    lang_id_cache.flush()
+    return docs, len(lines), error_ctr
+
+def iter_post_line_batches(post_files, buffer_size=2**22):
+    """
+    Iterate over batches of lines from all post files.
+    """
+    for i, post_file in enumerate(post_files):
+        logging.warning('starting to process file %s'%(post_file))
+        try:
+            with get_file_iter(post_file, buffer_size=buffer_size) as post_iter:
+                for lines in post_iter:
+                    yield lines
+        except Exception as e:
+            logging.warning('exception when reading file %s = %s'%(post_file, e))
+        logging.warning('%d files read; finished reading file %s'%(i+1, post_file))
+
+class StageCounter:
+    """
+    Count docs through one pipeline stage. Busy time excludes
+    time spent waiting on queues, so busy fraction close to 1
+    means this stage is the bottleneck.
+    """
+    def __init__(self, name, threads=1):
+        self.name = name
+        self.threads = threads
+        self.doc_ctr = 0
+        self.busy_time = 0.
+        self.start_time = time()
+        self.lock = Lock()
+    
+    def add(self, docs, busy_time):
+        with self.lock:
+            self.doc_ctr += docs
+            self.busy_time += busy_time
+    
+    def __str__(self):
+        elapsed_time = max(time() - self.start_time, 1e-6)
+        return '%s: %d docs, %.1f docs/sec, %.2f busy'%(self.name, self.doc_ctr, self.doc_ctr / elapsed_time, self.busy_time / (elapsed_time * self.threads))
+
+def is_retryable_bulk_error(status, error):
+    """
+    Rejected because ES is overloaded (HTTP 429, full bulk queue)
+    => retry later instead of failing.
+    """
+    return status == 429 or 'rejectedexecution' in str(error).lower().replace('_', '')
+
+def send_bulk_docs(es, bulk_docs, max_retries=8, initial_backoff=1., max_backoff=60.):
+    """
+    Send serialized docs in bulk request. Retry docs that
+    were rejected for load with exponential backoff.
+    
+    :param es: ES client
+    :param bulk_docs: serialized docs (action + source lines)
+    :param max_retries: max retries per doc
+    :param initial_backoff: seconds before first retry
+    :param max_backoff: max seconds between retries
+    :returns failed_docs:: (doc, error) for docs that failed permanently
+    """
+    failed_docs = []
+    for retry_ctr in range(max_retries+1):
+        retry_docs = []
+        try:
+            bulk_response = es.bulk(body=b''.join(bulk_docs))
+            if(bulk_response.get('errors')):
+                # one item per doc, in request order
+                for doc, item in zip(bulk_docs, bulk_response['items']):
+                    item_result = list(item.values())[0]
+                    if('error' in item_result):
+                        if(is_retryable_bulk_error(item_result.get('status'), item_result['error'])):
+                            retry_docs.append((doc, item_result['error']))
+                        else:
+                            failed_docs.append((doc, item_result['error']))
+        except TransportError as e:
+            if(isinstance(e, ConnectionTimeout) or is_retryable_bulk_error(e.status_code, e)):
+                retry_docs = [(doc, str(e)) for doc in bulk_docs]
+            else:
+                failed_docs.extend([(doc, str(e)) for doc in bulk_docs])
+        except Exception as e:
+            failed_docs.extend([(doc, str(e)) for doc in bulk_docs])
+        if(len(retry_docs) == 0):
+            break
+        if(retry_ctr == max_retries):
+            failed_docs.extend(retry_docs)
+            break
+        backoff = min(initial_backoff * 2**retry_ctr, max_backoff)
+        logging.warning('%d/%d docs rejected (%s); retry %d in %.1f sec'%(len(retry_docs), len(bulk_docs), retry_docs[0][1], retry_ctr+1, backoff))
+        sleep(backoff)
+        bulk_docs = [doc for doc, error in retry_docs]
+    return failed_docs
+
+## bulk-load mode: no refresh or replicas during ingest
+BULK_LOAD_SETTINGS = {'refresh_interval' : '-1', 'number_of_replicas' : 0}
+def start_bulk_load(es, ES_index):
+    """
+    Turn off refresh and replicas for ingest.
+    
+    :returns original_settings:: settings to restore after ingest
+    """
+    index_settings = es.indices.get_settings(index=ES_index)[ES_index]['settings']['index']
+    original_settings = {'refresh_interval' : index_settings.get('refresh_interval', '1s'), 'number_of_replicas' : index_settings.get('number_of_replicas', 1)}
+    es.indices.put_settings(index=ES_index, body={'index' : BULK_LOAD_SETTINGS})
+    logging.warning('bulk load: changed settings %s => %s'%(original_settings, BULK_LOAD_SETTINGS))
+    return original_settings
+
+def finish_bulk_load(es, ES_index, original_settings, force_merge_segments=None):
+    """
+    Restore settings after ingest, refresh and
+    optionally force-merge to fewer segments.
+    """
+    es.indices.put_settings(index=ES_index, body={'index' : original_settings})
+    es.indices.refresh(index=ES_index)
+    logging.warning('bulk load: restored settings %s'%(original_settings))
+    if(force_merge_segments is not None):
+        logging.warning('bulk load: force-merging to %d segments'%(force_merge_segments))
+        # ES < 2.1 => optimize
+        if(hasattr(es.indices, 'forcemerge')):
+            es.indices.forcemerge(index=ES_index, max_num_segments=force_merge_segments)
+        else:
+            es.indices.optimize(index=ES_index, max_num_segments=force_merge_segments)
+
+def index_posts_pipeline(es, post_files, convert_args, parse_workers=4, sender_threads=8, max_bulk_bytes=10*2**20, max_bulk_docs=10000, queue_size=16, buffer_size=2**22, lang_id_cache_file=None, report_interval=60, max_retries=8, initial_backoff=1., max_backoff=60., dead_letter_file=None):
+    """
+    Index posts with streaming pipeline:
+    1. parse: decode, clean, lang-ID and serialize line batches in process pool
+    2. batch: group serialized docs into bulk requests by size
+    3. send: concurrent bulk requests
+    Logs docs/sec per stage and queue fill every report_interval seconds.
+    
+    :param es: ES client
+    :param post_files: post files
+    :param convert_args: args for convert_line_batch (ES_index, post_type, etc.)
+    :param parse_workers: parse processes
+    :param sender_threads: concurrent bulk requests
+    :param max_bulk_bytes: max bulk request size (bytes)
+    :param max_bulk_docs: max docs per bulk request
+    :param queue_size: max items in each queue between stages
+    :param buffer_size: decompressed bytes per line batch
+    :param lang_id_cache_file: on-disk lang ID cache
+    :param report_interval: seconds between stage reports
+    :param max_retries: max retries for docs rejected by overloaded ES
+    :param initial_backoff: seconds before first retry
+    :param max_backoff: max seconds between retries
+    :param dead_letter_file: file for docs that failed permanently, as bulk lines (replay with _bulk)
+    :returns stage_counters, error_ctrs:: counters per stage, errors per stage (parse = bad lines, send = failed docs)
+    """
+    doc_queue = Queue(maxsize=queue_size)
+    bulk_queue = Queue(maxsize=queue_size)
+    stage_counters = {'parse' : StageCounter('parse', threads=1), 'batch' : StageCounter('batch', threads=1), 'send' : StageCounter('send', threads=sender_threads)}
+    error_ctrs = {'parse' : 0, 'send' : 0}
+    error_lock = Lock()
+    
+    def batch_docs():
+        bulk_docs = []
+        bulk_bytes = 0
+        while(True):
+            docs = doc_queue.get()
+            if(docs is None):
+                break
+            start_time = time()
+            for doc in docs:
+                # full request => send before adding doc
+                if(len(bulk_docs) > 0 and (bulk_bytes + len(doc) > max_bulk_bytes or len(bulk_docs) >= max_bulk_docs)):
+                    stage_counters['batch'].add(len(bulk_docs), time() - start_time)
+                    bulk_queue.put(bulk_docs)
+                    start_time = time()
+                    bulk_docs = []
+                    bulk_bytes = 0
+                bulk_docs.append(doc)
+                bulk_bytes += len(doc)
+            stage_counters['batch'].add(0, time() - start_time)
+        if(len(bulk_docs) > 0):
+            stage_counters['batch'].add(len(bulk_docs), 0.)
+            bulk_queue.put(bulk_docs)
+        for i in range(sender_threads):
+            bulk_queue.put(None)
+    
+    def send_bulk():
+        while(True):
+            bulk_docs = bulk_queue.get()
+            if(bulk_docs is None):
+                break
+            start_time = time()
+            failed_docs = send_bulk_docs(es, bulk_docs, max_retries=max_retries, initial_backoff=initial_backoff, max_backoff=max_backoff)
+            stage_counters['send'].add(len(bulk_docs), time() - start_time)
+            if(len(failed_docs) > 0):
+                logging.warning('%d/%d docs failed in bulk request, e.g. %s'%(len(failed_docs), len(bulk_docs), failed_docs[0][1]))
+                with error_lock:
+                    error_ctrs['send'] += len(failed_docs)
+                    if(dead_letter_file is not None):
+                        with open(dead_letter_file, 'ab') as dead_letter_output:
+                            for doc, error in failed_docs:
+                                dead_letter_output.write(doc)
+    
+    def log_stages():
+        logging.warning('; '.join(map(str, stage_counters.values())))
+        logging.warning('queues: docs %d/%d, bulk %d/%d'%(doc_queue.qsize(), queue_size, bulk_queue.qsize(), queue_size))
+    
+    batch_thread = Thread(target=batch_docs, daemon=True)
+    batch_thread.start()
+    sender_thread_list = [Thread(target=send_bulk, daemon=True) for i in range(sender_threads)]
+    for sender_thread in sender_thread_list:
+        sender_thread.start()
+    # parse in pool; ordered results with bounded in-flight batches
+    line_batches = iter_post_line_batches(post_files, buffer_size=buffer_size)
+    batch_fn = partial(convert_line_batch, **convert_args)
+    last_report_time = time()
+    start_time = time()
+    for docs, line_ctr, error_ctr in run_ordered_batches(batch_fn, line_batches, workers=parse_workers, initializer=init_post_converter, initargs=(lang_id_cache_file,)):
+        # parse stage runs in pool => busy time = time since last batch, excluding queue wait
+        stage_counters['parse'].add(len(docs), time() - start_time)
+        error_ctrs['parse'] += error_ctr
+        doc_queue.put(docs)
+        start_time = time()
+        if(time() - last_report_time >= report_interval):
+            log_stages()
+            last_report_time = time()
+    doc_queue.put(None)
+    batch_thread.join()
+    for sender_thread in sender_thread_list:
+        sender_thread.join()
+    log_stages()
+    logging.warning('%d bad lines, %d failed docs'%(error_ctrs['parse'], error_ctrs['send']))
+    if(error_ctrs['send'] > 0 and dead_letter_file is not None):
+        logging.warning('wrote failed docs to %s'%(dead_letter_file))
+    return stage_counters, error_ctrs
+
+## incremental sync: manifest of indexed files per index
+def get_file_checksum(file_name, block_size=2**24):
+    file_hash = hashlib.sha1()
+    with open(file_name, 'rb') as file_input:
+        for block in iter(lambda: file_input.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+class IngestManifest:
+    """
+    Manifest of post files indexed into one index:
+    size, mtime, checksum and doc counts per file.
+    Files with the same size and mtime as in the manifest are skipped
+    without reading them, otherwise the checksum decides.
+    Doc IDs are deterministic (post subset + post ID), so re-indexing
+    a changed file overwrites its docs instead of duplicating them,
+    as long as the ID params match the manifest.
+    """
+    def __init__(self, manifest_file, ES_index, id_params):
+        """
+        :param manifest_file: manifest file (JSON)
+        :param ES_index: ES index
+        :param id_params: params that determine doc IDs (e.g. post subset)
+        """
+        self.manifest_file = manifest_file
+        self.ES_index = ES_index
+        self.id_params = id_params
+        self.files = {}
+        self.id_params_match = True
+        if(os.path.exists(manifest_file)):
+            with open(manifest_file, 'r') as manifest_input:
+                manifest = json.load(manifest_input)
+            if(manifest.get('id_params') != id_params):
+                logging.warning('manifest %s has different doc ID params %s != %s'%(manifest_file, manifest.get('id_params'), id_params))
+                self.id_params_match = False
+            else:
+                self.files = manifest['files']
+    
+    def save(self):
+        tmp_manifest_file = '%s.tmp'%(self.manifest_file)
+        with open(tmp_manifest_file, 'w') as manifest_output:
+            json.dump({'index' : self.ES_index, 'id_params' : self.id_params, 'files' : self.files}, manifest_output, indent=2)
+        os.replace(tmp_manifest_file, self.manifest_file)
+    
+    def reset(self):
+        self.files = {}
+        self.save()
+    
+    def is_indexed(self, post_file, verify_checksum=False):
+        """
+        Check whether file was completely indexed and has not changed since.
+        
+        :param verify_checksum: compare checksum even if size and mtime match
+        """
+        file_info = self.files.get(os.path.basename(post_file))
+        if(file_info is None or file_info['status'] != 'complete'):
+            return False
+        file_stat = os.stat(post_file)
+        if(file_stat.st_size != file_info['size']):
+            return False
+        if(file_stat.st_mtime == file_info['mtime'] and not verify_checksum):
+            return True
+        return get_file_checksum(post_file) == file_info['checksum']
+    
+    def record(self, post_file, doc_ctr, bad_line_ctr, failed_doc_ctr):
+        """
+        Record indexed file; files with failed docs
+        are marked partial and indexed again on the next run.
+        """
+        file_stat = os.stat(post_file)
+        self.files[os.path.basename(post_file)] = {
+            'path' : os.path.abspath(post_file),
+            'size' : file_stat.st_size,
+            'mtime' : file_stat.st_mtime,
+            'checksum' : get_file_checksum(post_file),
+            'docs' : doc_ctr,
+            'bad_lines' : bad_line_ctr,
+            'failed_docs' : failed_doc_ctr,
+            'status' : 'complete' if failed_doc_ctr == 0 else 'partial',
+            'indexed_at' : datetime.now().isoformat(),
+        }
+        self.save()
 
 def main():
     parser = ArgumentParser()
@@ -134,6 +572,25 @@ def main():
     parser.add_argument('--post_end_month', type=int, default=6)
     parser.add_argument('--post_type', default='reddit')
     parser.add_argument('--valid_langs', nargs='+', default=['en'])
+    parser.add_argument('--json_backend', default=None) # fast JSON decoding: json, orjson, simdjson, auto
+    parser.add_argument('--lang_id_cache', default=None) # sqlite cache of lang ID by text hash
+    parser.add_argument('--parse_workers', type=int, default=4) # processes for decode/clean/lang ID
+    parser.add_argument('--sender_threads', type=int, default=8) # concurrent bulk requests
+    parser.add_argument('--max_bulk_bytes', type=int, default=10*2**20)
+    parser.add_argument('--max_bulk_docs', type=int, default=10000)
+    parser.add_argument('--queue_size', type=int, default=16) # max batches waiting between stages
+    parser.add_argument('--bulk_load', action='store_true') # no refresh/replicas during ingest
+    parser.add_argument('--force_merge_segments', type=int, default=None) # force-merge after bulk load
+    parser.add_argument('--max_retries', type=int, default=8) # retries for docs rejected by overloaded ES
+    parser.add_argument('--initial_backoff', type=float, default=1.)
+    parser.add_argument('--max_backoff', type=float, default=60.)
+    parser.add_argument('--dead_letter_file', default=None) # failed docs as bulk lines
+    parser.add_argument('--shingle_field', action='store_true') # add shingle subfield (e.g. body.shingles) for exact phrase queries
+    parser.add_argument('--max_shingle_size', type=int, default=3)
+    parser.add_argument('--query_cache_dir', default=None) # query result cache to invalidate for this index
+    parser.add_argument('--incremental', action='store_true') # keep index and only index new/changed files
+    parser.add_argument('--manifest_file', default=None) # indexed files per index (default ../../output/index_ES_posts_<index>_manifest.json)
+    parser.add_argument('--verify_checksums', action='store_true') # incremental: checksum all files, not only files with new size/mtime
     args = vars(parser.parse_args())
     logging_file = '../../output/index_ES_posts.txt'
     if(os.path.exists(logging_file)):
@@ -178,9 +635,30 @@ def main():
     ## create index
     ES_index = args['ES_index']
     es = Elasticsearch(timeout=600)
-    # tmp debugging: remove index
-    if(es.indices.exists(ES_index)):
-        es.indices.delete(index=ES_index, ignore=[400, 404])
+    manifest_file = args.get('manifest_file')
+    if(manifest_file is None):
+        manifest_file = '../../output/index_ES_posts_%s_manifest.json'%(ES_index)
+    manifest = IngestManifest(manifest_file, ES_index, {'post_type' : post_type, 'post_subset' : post_year_subset})
+    if(args['incremental']):
+        if(not es.indices.exists(ES_index)):
+            manifest.reset()
+        elif(not manifest.id_params_match):
+            # new doc IDs would duplicate indexed docs
+            raise ValueError('index %s was built with different doc ID params; rebuild without --incremental'%(ES_index))
+        # skip files that are already indexed
+        post_file_count = len(post_files)
+        post_files = list(filter(lambda x: not manifest.is_indexed(x, verify_checksum=args['verify_checksums']), post_files))
+        logging.warning('incremental: %d/%d files already indexed; indexing %s'%(post_file_count - len(post_files), post_file_count, ', '.join(post_files)))
+    else:
+        # tmp debugging: remove index
+        if(es.indices.exists(ES_index)):
+            es.indices.delete(index=ES_index, ignore=[400, 404])
+        manifest.reset()
+    # cached query results are stale once index changes
+    query_cache = None
+    if(args['query_cache_dir'] is not None and len(post_files) > 0):
+        query_cache = QueryResultCache(args['query_cache_dir'])
+        query_cache.invalidate(ES_index)
     # get text var for analyzer and for generating data for indexer
     if(post_type == 'reddit'):
         txt_var = 'body'
@@ -233,6 +711,11 @@ def main():
     #                     }
     #                 }
             }
+        # index phrases as terms => fast phrase queries
+        if(args['shingle_field']):
+            if(not os.path.exists(ES_mapping_file)):
+                body = {}
+            body = add_shingle_subfield(body, txt_var, post_type, max_shingle_size=args['max_shingle_size'])
         index_create_response = es.indices.create(index=ES_index, body=body)
         
 #     logging.warning(index_create_response)
@@ -249,13 +732,36 @@ def main():
     ES_dir = args['ES_dir']
 #     out_file_name = os.path.join(ES_dir, ES_index)
     valid_langs = args['valid_langs']
+    json_backend = args.get('json_backend')
     if(len(valid_langs) == 0 or valid_langs[0] == ''):
         valid_langs = None
     logging.warning('es info:\n%s'%(es.info()))
     # serial
 #     es_output = helpers.bulk(es, convert_file_to_dict(post_files, ES_index, post_type, post_year_subset, data_fields=data_fields, txt_var=txt_var, valid_langs=valid_langs), yield_ok=False)
-    MAX_THREADS=30
-    deque(helpers.parallel_bulk(es, convert_file_to_dict(post_files, ES_index, post_type, post_year_subset, data_fields=data_fields, txt_var=txt_var, valid_langs=valid_langs), thread_count=MAX_THREADS, raise_on_exception=True), maxlen=0)
+    # old: threads only parallelize HTTP; parsing + lang ID run serially in generator
+#     MAX_THREADS=30
+#     deque(helpers.parallel_bulk(es, convert_file_to_dict(post_files, ES_index, post_type, post_year_subset, data_fields=data_fields, txt_var=txt_var, valid_langs=valid_langs, json_backend=json_backend, lang_id_cache_file=args['lang_id_cache']), thread_count=MAX_THREADS, raise_on_exception=True), maxlen=0)
+    convert_args = {'ES_index' : ES_index, 'post_type' : post_type, 'post_subset' : post_year_subset, 'txt_var' : txt_var, 'data_fields' : data_fields, 'valid_langs' : valid_langs, 'json_backend' : json_backend}
+    dead_letter_file = args.get('dead_letter_file')
+    if(dead_letter_file is None):
+        dead_letter_file = '../../output/index_ES_posts_%s_failed_docs.json'%(ES_index)
+    if(os.path.exists(dead_letter_file)):
+        os.remove(dead_letter_file)
+    bulk_load = args['bulk_load'] and len(post_files) > 0
+    if(bulk_load):
+        original_settings = start_bulk_load(es, ES_index)
+    try:
+        # one file at a time => manifest records each file when it's done
+        for post_file in post_files:
+            stage_counters, error_ctrs = index_posts_pipeline(es, [post_file], convert_args, parse_workers=args['parse_workers'], sender_threads=args['sender_threads'], max_bulk_bytes=args['max_bulk_bytes'], max_bulk_docs=args['max_bulk_docs'], queue_size=args['queue_size'], lang_id_cache_file=args['lang_id_cache'], max_retries=args['max_retries'], initial_backoff=args['initial_backoff'], max_backoff=args['max_backoff'], dead_letter_file=dead_letter_file)
+            manifest.record(post_file, stage_counters['send'].doc_ctr - error_ctrs['send'], error_ctrs['parse'], error_ctrs['send'])
+    finally:
+        # restore settings even if load fails
+        if(bulk_load):
+            finish_bulk_load(es, ES_index, original_settings, force_merge_segments=args.get('force_merge_segments'))
+        # drop anything cached during load
+        if(query_cache is not None):
+            query_cache.invalidate(ES_index)
     logging.warning('finished parallel load')
     
     ## execute query
@@ -90,6 +90,9 @@ sleep "$ES_SETUP_TIME"s
 VALID_LANGS=(en es)
 # VALID_LANGS=''
 
+# fast JSON decoding (json, orjson, simdjson, auto)
+# JSON_BACKEND=auto
+
 ## verify that index exists!
 curl 'localhost:9200/_cat/indices?v'
 
@@ -103,8 +106,20 @@ curl 'localhost:9200/_cat/indices?v'
 # curl -XPUT 'localhost:9200/'$"$ES_INDEX"/"$ES_INDEX_TYPE"$'/_mapping' -d @"$POST_MAP_FILE"
 
 ## index posts
+## pipeline: parse workers => byte-sized bulk batches => concurrent senders
+## log reports docs/sec and busy fraction per stage => raise workers/threads for the busiest stage
+# PARSE_WORKERS=8
+# SENDER_THREADS=8
+# python3 index_ES_posts.py $ES_INDEX --post_dir $POST_DIR --post_year $YEAR --post_start_month $START_MONTH --post_end_month $END_MONTH --post_type $POST_TYPE --valid_langs "${VALID_LANGS[@]}" --ES_mapping_file $ES_MAPPING_FILE --parse_workers $PARSE_WORKERS --sender_threads $SENDER_THREADS
 cd $SCRIPT_DIR
-python3 index_ES_posts.py $ES_INDEX --post_dir $POST_DIR --post_year $YEAR --post_start_month $START_MONTH --post_end_month $END_MONTH --post_type $POST_TYPE --valid_langs "${VALID_LANGS[@]}" --ES_mapping_file $ES_MAPPING_FILE
+## bulk load: no refresh/replicas during ingest, retry rejected docs, force-merge at end
+## failed docs => ../../output/index_ES_posts_"$ES_INDEX"_failed_docs.json (replay with curl -XPOST localhost:9200/_bulk --data-binary @FILE)
+FORCE_MERGE_SEGMENTS=1
+## optional: add new dump files to existing index (e.g. after extending END_MONTH)
+## => add --incremental; indexed files are listed in ../../output/index_ES_posts_"$ES_INDEX"_manifest.json
+## optional: index 2-3 word phrases as terms (body.shingles) for exact phrase queries
+## => add --shingle_field --max_shingle_size 3; query with data_helpers.generate_phrase_queries
+python3 index_ES_posts.py $ES_INDEX --post_dir $POST_DIR --post_year $YEAR --post_start_month $START_MONTH --post_end_month $END_MONTH --post_type $POST_TYPE --valid_langs "${VALID_LANGS[@]}" --ES_mapping_file $ES_MAPPING_FILE --bulk_load --force_merge_segments $FORCE_MERGE_SEGMENTS
 
 ## shut down index
 kill $PID
\ No newline at end of file
@@ -4,70 +4,102 @@ Mine reddit comments for specified subreddit, language, etc.
 from argparse import ArgumentParser
 import logging
 import os
-import gzip
 import json
-import pandas as pd
-import re
-from bz2 import BZ2File
+from data_helpers import PhraseMatcher, get_file_iter, load_lang_id_store, CompressedFileWriter, ProgressJournal, truncate_out_files
 
-def mine_comments(data_file, out_file_name, lang=None, lang_id_dir='', subreddit=None, subreddits=None, phrases=None, users=None):
+def mine_comments(data_file, out_file_name, lang=None, lang_id_dir='', subreddit=None, subreddits=None, phrases=None, users=None, journal_file=None, checkpoint_size=1000000):
     """
     Mine comments for specified metadata.
+    With a progress journal, skip the data file if it was
+    already mined, or resume from the last checkpoint.
     """
+    journal = None
+    start_record = 0
+    if(journal_file is not None):
+        journal_config = {'out_file' : out_file_name, 'lang' : lang, 'subreddits' : sorted(subreddits) if subreddits is not None else None, 'phrases' : phrases, 'users' : users}
+        journal = ProgressJournal(journal_file, config=journal_config)
+        if(journal.is_complete(data_file)):
+            logging.debug('skipping completed data file %s'%(data_file))
+            return
+        progress = journal.get(data_file)
+        if(progress is not None):
+            # roll back output to last checkpoint and skip comments already mined
+            truncate_out_files([out_file_name], progress['out_file_sizes'])
+            start_record = progress['records']
+            logging.debug('resuming data file %s at record %d'%(data_file, start_record))
+    if(start_record == 0 and os.path.exists(out_file_name)):
+        os.remove(out_file_name)
     # load lang ID data
     if(lang is not None):
         data_file_format = '.'.join(os.path.basename(data_file).split('.')[1:])
         lang_id_file = os.path.join(lang_id_dir, os.path.basename(data_file).replace('.%s'%(data_file_format), '_lang_id.tsv.gz'))
-        lang_id_data = pd.read_csv(lang_id_file, sep='\t', index_col=False, compression='gzip', header=None, names=['id', 'lang', 'score'])
-        valid_lang_ids = set(lang_id_data[lang_id_data.loc[:, 'lang']==lang].loc[:, 'id'].unique())
+        lang_id_store = load_lang_id_store(lang_id_file)
+        valid_lang_ids = lang_id_store.get_id_set(lang=lang)
         logging.debug('%d valid IDs with lang=%s'%(len(valid_lang_ids), lang))
     if(phrases is not None):
         # we want phrases to match tokenized words
-        punct = '[ ,\.?!;:]'
-        punct_phrase_template = '|'.join(['^%s'+punct, punct+'%s$', punct+'%s'+punct])
-        phrases_clean = [punct_phrase_template%(phrase,)*3 for phrase in phrases]
-        phrase_matcher = re.compile('|'.join(phrases_clean))
+        punct = ' ,.?!;:'
+        phrase_matcher = PhraseMatcher([phrase.lower() for phrase in phrases], boundary_chars=punct)
     comment_match_ctr = 0
     comment_ctr = 0
     id_var = 'id'
     subreddit_var = 'subreddit'
     txt_var = 'body'
     user_var = 'author'
-    with gzip.open(out_file_name, 'wt') as out_file:
-        with BZ2File(data_file, 'r') as data_input:
-            for l in data_input:
-                try:
-                    l_data = json.loads(l.strip())
-                    comment_ctr += 1
-                    valid_lang = True
-                    if(lang is not None):
-                        l_id = l_data[id_var]
-                        valid_lang = l_id in valid_lang_ids
-                    valid_subreddit = True
-                    if(subreddits is not None):
-                        l_subreddit = l_data[subreddit_var]
-                        valid_subreddit = l_subreddit in subreddits
-                    valid_phrase = True
-                    phrase_matches = []
-                    if(phrases is not None):
-                        l_txt = l_data[txt_var].lower()
-                        phrase_matches = phrase_matcher.findall(l_txt)
-                        valid_phrase = len(phrase_matches) > 0
-                    valid_user = True
-                    if(users is not None):
-                        l_user = l_data[user_var]
-                        valid_user = l_user in users
-                    valid_post = (valid_lang and valid_subreddit and valid_phrase and valid_user)
-                    if(valid_post):
-                        comment_match_ctr += 1
-                        if(len(phrase_matches) > 0):
-                            l_data['phrase_matches'] = phrase_matches
-                        out_file.write('%s\n'%(json.dumps(l_data)))
-                        if(comment_match_ctr % 1000 == 0):
-                            logging.debug('%d/%d comments mined'%(comment_match_ctr, comment_ctr))
-                except Exception as e:
-                    print(e)
-                    pass
+    record_ctr = 0
+    next_checkpoint = start_record + checkpoint_size
+    with CompressedFileWriter(out_file_name, append=True) as out_file:
+        # batches of lines from bz2/xz/zst dump
+        with get_file_iter(data_file) as data_input:
+            for lines in data_input:
+                # skip batches mined before last checkpoint
+                if(record_ctr + len(lines) <= start_record):
+                    record_ctr += len(lines)
+                    continue
+                if(record_ctr < start_record):
+                    lines = lines[start_record-record_ctr:]
+                    record_ctr = start_record
+                record_ctr += len(lines)
+                for l in lines:
+                    try:
+                        l_data = json.loads(l.strip())
+                        comment_ctr += 1
+                        valid_lang = True
+                        if(lang is not None):
+                            l_id = l_data[id_var]
+                            valid_lang = l_id in valid_lang_ids
+                        valid_subreddit = True
+                        if(subreddits is not None):
+                            l_subreddit = l_data[subreddit_var]
+                            valid_subreddit = l_subreddit in subreddits
+                        valid_phrase = True
+                        phrase_matches = []
+                        if(phrases is not None):
+                            l_txt = l_data[txt_var].lower()
+                            phrase_matches = phrase_matcher.findall(l_txt)
+                            valid_phrase = len(phrase_matches) > 0
+                        valid_user = True
+                        if(users is not None):
+                            l_user = l_data[user_var]
+                            valid_user = l_user in users
+                        valid_post = (valid_lang and valid_subreddit and valid_phrase and valid_user)
+                        if(valid_post):
+                            comment_match_ctr += 1
+                            if(len(phrase_matches) > 0):
+                                l_data['phrase_matches'] = phrase_matches
+                            out_file.write('%s\n'%(json.dumps(l_data)))
+                            if(comment_match_ctr % 1000 == 0):
+                                logging.debug('%d/%d comments mined'%(comment_match_ctr, comment_ctr))
+                    except Exception as e:
+                        print(e)
+                        pass
+                # checkpoint at batch boundaries
+                if(journal is not None and record_ctr >= next_checkpoint):
+                    out_file_size = out_file.checkpoint()
+                    journal.record(data_file, 'partial', records=record_ctr, offset=data_input.offset, out_file_sizes={out_file_name : out_file_size})
+                    next_checkpoint = record_ctr + checkpoint_size
+    if(journal is not None):
+        journal.record(data_file, 'completed', records=record_ctr, out_file_sizes={out_file_name : os.path.getsize(out_file_name)})
 
 def main():
     parser = ArgumentParser()
@@ -80,8 +112,10 @@ def main():
     parser.add_argument('--subreddit_file', default=None)
     parser.add_argument('--subreddit', default=None)
     parser.add_argument('--user_file', default=None)
+    parser.add_argument('--resume', action='store_true') # continue interrupted run from progress journal
+    parser.add_argument('--checkpoint_size', type=int, default=1000000) # comments between checkpoints
     args = vars(parser.parse_args())
-    out_file_str = os.path.basename(args['data_file']).replace('.bz2', '')
+    out_file_str = os.path.splitext(os.path.basename(args['data_file']))[0]
     if('lang' in args and args['lang'] is not None):
         lang = args['lang']
         lang_id_dir = os.path.join(os.path.dirname(args['data_file']), args['lang_id_dir'])
@@ -115,7 +149,7 @@ def main():
     else:
         users = None
     logging_file = '../../output/mine_reddit_comments_%s.txt'%(out_file_str)
-    if(os.path.exists(logging_file)):
+    if(os.path.exists(logging_file) and not args['resume']):
         os.remove(logging_file)
     logging.basicConfig(filename=logging_file, level=logging.DEBUG)
     
@@ -124,7 +158,11 @@ def main():
     if(not os.path.exists(out_dir)):
         os.mkdir(out_dir)
     out_file_name = os.path.join(out_dir, '%s.gz'%(out_file_str))
-    mine_comments(args['data_file'], out_file_name, lang=lang, lang_id_dir=lang_id_dir, subreddits=subreddits, phrases=phrases, users=users)
+    # per-file journal => rerunning a batch of files with --resume skips finished files
+    journal_file = os.path.join(out_dir, '%s.journal'%(out_file_str))
+    if(not args['resume'] and os.path.exists(journal_file)):
+        os.remove(journal_file)
+    mine_comments(args['data_file'], out_file_name, lang=lang, lang_id_dir=lang_id_dir, subreddits=subreddits, phrases=phrases, users=users, journal_file=journal_file, checkpoint_size=args['checkpoint_size'])
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
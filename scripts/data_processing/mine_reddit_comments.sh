@@ -44,6 +44,8 @@ JOBS=20
 # parallel --jobs $JOBS --bar --verbose python mine_reddit_comments.py {} --out_dir $OUT_DIR --lang $POST_LANG --lang_id_dir $LANG_ID_DIR --phrase_file $PHRASE_FILE --subreddit_file $SUBREDDIT_FILE ::: $(ls $ARCHIVE_FILES)
 # loanword user comments
 parallel --jobs $JOBS --bar --verbose python mine_reddit_comments.py {} --out_dir $OUT_DIR --user_file $USER_FILE ::: $(ls $ARCHIVE_FILES)
+# interrupted run: --resume skips finished files, continues others from last checkpoint
+# parallel --jobs $JOBS --bar --verbose python mine_reddit_comments.py {} --out_dir $OUT_DIR --user_file $USER_FILE --resume ::: $(ls $ARCHIVE_FILES)
 
 ## serial processing => FOR LOSERS
 # for ARCHIVE_FILE in $ARCHIVE_FILES;
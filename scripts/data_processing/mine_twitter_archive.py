@@ -7,32 +7,368 @@ import gzip
 import json
 from argparse import ArgumentParser
 import os, re
+import shutil
 from unidecode import unidecode
-from functools import reduce
 from langid import langid
-import cld2
 from multiprocessing import Pool
 import logging
-import pandas as pd
+# optional: YAML query manifests
+try:
+    import yaml
+except ImportError:
+    yaml = None
+from data_helpers import PhraseMatcher, CompressedFileWriter, JSONLineDecoder, load_lang_id_store, LangIDCache, GeoRegionFilter, load_geo_regions, ProgressJournal, truncate_out_files, get_out_file_sizes
 
-def contains_geo(geo, location_box):
+def build_geo_regions(location_box=None, location_info=None, geo_regions=None):
     """
-    Determine if location box contains geo point.
+    Combine old-style location box/place info with named
+    geo regions, so all location matching happens in one stage.
+    Location box and place info together form one region
+    that needs both to match.
     
     Parameters:
     -----------
-    geo : [float, float]
-    Latitude, longitude.
     location_box : [[float, float], [float, float]]
-    Latitude 1 (W), latitude 2 (E), longitude 1 (S), longitude 2 (N).
+    Latitude 1 (S), latitude 2 (N), longitude 1 (W), longitude 2 (E).
+    location_info : dict
+    Place fields that must all match, e.g. {'country_code' : 'FR'}.
+    geo_regions : dict
+    Region name => region (see data_helpers.load_geo_regions).
     """
-    lat, lon = geo
-    lat1, lat2 = location_box[0]
-    lon1, lon2 = location_box[1]
-    contains = (lat >= lat1 and lat <= lat2 and lon >= lon1 and lon <= lon2)
-    return contains
+    combined_geo_regions = {}
+    # box and place info together => one region that must match both
+    if(location_box is not None):
+        (lat1, lat2), (lon1, lon2) = location_box
+        combined_geo_regions['location_box'] = {'box' : [lon1, lat1, lon2, lat2]}
+        if(location_info is not None and len(location_info) > 0):
+            combined_geo_regions['location_box']['place'] = location_info
+    elif(location_info is not None and len(location_info) > 0):
+        combined_geo_regions['location_info'] = {'place' : location_info}
+    if(geo_regions is not None):
+        combined_geo_regions.update(geo_regions)
+    if(len(combined_geo_regions) == 0):
+        combined_geo_regions = None
+    return combined_geo_regions
+
+def build_region_out_file(out_file, region_name):
+    """
+    Build per-region out file, e.g. archive_X.gz => archive_X_REGION=paris.gz
+    """
+    out_file_base, out_file_ext = os.path.splitext(out_file)
+    return '%s_REGION=%s%s'%(out_file_base, region_name, out_file_ext)
+
+def get_mining_fields(phrases=None, location_box=None, location_info=None, match_hashtags=False, user_loc_phrase=None, lang=None, lang_detect=None, lang_detect_dir=None, geo_regions=None):
+    """
+    Get tweet fields needed to test a tweet for a match,
+    according to the mining parameters.
+    """
+    fields = ['id']
+    if(phrases is not None):
+        if(match_hashtags):
+            fields.append('entities.hashtags')
+        else:
+            fields.append('text')
+    if(location_box is not None or geo_regions is not None):
+        fields += ['coordinates', 'geo', 'place']
+    if(location_info is not None and len(location_info) > 0):
+        fields.append('place')
+    if(user_loc_phrase is not None):
+        fields.append('user.location')
+    if(lang is not None):
+        fields.append('lang')
+    if(lang_detect is not None and lang_detect_dir is None):
+        fields.append('text')
+    fields = list(dict.fromkeys(fields))
+    return fields
+
+class TweetQuery:
+    """
+    Named set of tweet filters (phrases, location, user location, lang).
+    Many queries can be tested against each decoded tweet,
+    so that one archive scan serves all of them.
+    """
+    
+    def __init__(self, name, phrases=None, location_box=None, location_info=None, match_hashtags=False, user_loc_phrase=None, lang=None, lang_detect=None, geo_regions=None, split_regions=False):
+        self.name = name
+        self.phrases = phrases
+        self.location_box = location_box
+        self.location_info = location_info
+        self.match_hashtags = match_hashtags
+        self.user_loc_phrase = user_loc_phrase
+        self.lang = lang
+        self.lang_detect = lang_detect
+        self.split_regions = split_regions
+        self.phrase_matcher = None
+        if(phrases is not None):
+            # logging.debug('phrases %s'%(','.join(phrases)))
+            if(match_hashtags):
+                self.phrase_tags = set([unidecode(x.replace('#','').lower()) for x in phrases])
+                logging.debug('phrase tags %s'%(self.phrase_tags))
+            else:
+#                 phrase_matcher = re.compile('|'.join(phrases).lower())
+                # remove spaces when needed
+                phrases_fixed = phrases + [x.replace(' ', '') for x in phrases if ' ' in x]
+                phrases_fixed = [x.lower() for x in phrases_fixed]
+                # match tokenized words
+                # one automaton for all phrases => much faster than giant regex alternation
+#                 phrases_fixed_combined = '|'.join(phrases_fixed).lower()
+#                 phrases_fixed_str = '(?<=[,\.! #])(%s)(?=[,\.! #])|(?<=[,\.! #])(%s)$|^(%s)(?=[,\.! #])'%(phrases_fixed_combined, phrases_fixed_combined, phrases_fixed_combined)
+#                 phrase_matcher = re.compile(phrases_fixed_str)
+                self.phrase_matcher = PhraseMatcher(phrases_fixed, boundary_chars=',.! #')
+#                 logging.debug('phrase match pattern %s'%(phrase_matcher.pattern))
+        if(user_loc_phrase is not None):
+            self.user_loc_phrase_matcher = re.compile(user_loc_phrase.lower())
+        if(location_info is not None):
+            logging.debug('location info %s'%(location_info))
+        # location matching: one stage over batches of otherwise-matching tweets
+        self.geo_regions = build_geo_regions(location_box=location_box, location_info=location_info, geo_regions=geo_regions)
+        self.geo_filter = None
+        if(self.geo_regions is not None):
+            self.geo_filter = GeoRegionFilter(self.geo_regions)
+            logging.debug('query %s matching geo regions %s'%(name, ','.join(self.geo_regions.keys())))
+        self.geo_batch = []
+        self.match_ctr = 0
+    
+    def get_mining_fields(self, lang_detect_dir=None):
+        return get_mining_fields(phrases=self.phrases, location_box=self.location_box, location_info=self.location_info, match_hashtags=self.match_hashtags, user_loc_phrase=self.user_loc_phrase, lang=self.lang, lang_detect=self.lang_detect, lang_detect_dir=lang_detect_dir, geo_regions=self.geo_regions)
+    
+    def match(self, j, j_cache, lang_detect_valid_ids=None, lang_id_cache=None):
+        """
+        Test tweet against all non-location filters.
+        
+        :param j: tweet data
+        :param j_cache: per-tweet values shared by all queries (clean text, detected lang)
+        :param lang_detect_valid_ids: lang => set of IDs with pre-detected lang
+        :param lang_id_cache: lang ID cache for on-the-fly detection
+        :returns match, phrase_match_j:: tweet match, matching phrase/s
+        """
+        # phrase matching for hashtag/text
+        phrase_match_j = []
+        if(self.phrases is not None):
+            if(self.match_hashtags):
+                if('tags' not in j_cache):
+                    j_cache['tags'] = set()
+                    if(j.get('entities') is not None and j['entities'].get('hashtags') is not None):
+                        j_cache['tags'] = set([unidecode(x['text'].lower()) for x in j['entities']['hashtags']])
+                phrase_match_j = j_cache['tags']
+                if(len(self.phrase_tags & j_cache['tags']) == 0):
+                    return False, phrase_match_j
+            else:
+                if('text' not in j_cache):
+                    j_cache['text'] = unidecode(j['text'].lower())
+                phrase_match_j = self.phrase_matcher.findall(j_cache['text'])
+                if(len(phrase_match_j) == 0):
+                    return False, phrase_match_j
+        # user bio location matching
+        if(self.user_loc_phrase is not None):
+            if(j['user'].get('location') is None):
+                return False, phrase_match_j
+            j_user_loc = unidecode(j['user']['location'].lower())
+            if(self.user_loc_phrase_matcher.search(j_user_loc) is None):
+                return False, phrase_match_j
+        # language matching
+        # use tweet-provided lang, use pre-detected lang, or detect lang on the fly
+        if(self.lang is not None and j['lang'] != self.lang):
+            return False, phrase_match_j
+        if(self.lang_detect is not None):
+            if(lang_detect_valid_ids is not None):
+                lang_match = j['id'] in lang_detect_valid_ids[self.lang_detect]
+            else:
+                if('lang_detect' not in j_cache):
+#                     j_cache['lang_detect'] = langid.classify(j['text'])[0]
+                    j_cache['lang_detect'] = lang_id_cache.detect(j['text'])[0]
+                lang_match = j_cache['lang_detect'] == self.lang_detect
+            if(not lang_match):
+                return False, phrase_match_j
+        return True, phrase_match_j
 
-def mine_tweets(archive_file, out_file, phrases=None, location_box=None, location_info=None, match_hashtags=False, user_loc_phrase=None, lang=None, lang_detect=None, lang_detect_dir=None):
+def mine_tweets_multi(archive_file, query_params, query_out_files, lang_detect_dir=None, compress_level=None, json_backend=None, lang_id_cache_file=None, geo_batch_size=10000, journal_file=None, checkpoint_size=1000000):
+    """
+    Extract tweets from archive that match any of the queries
+    in one scan, and route matches to per-query out files.
+    
+    Parameters:
+    -----------
+    archive_file : str
+    query_params : dict
+    Query name => TweetQuery parameters.
+    query_out_files : dict
+    Query name => writeable output file name; matches are appended.
+    lang_detect_dir : directory for previously detected languages
+    compress_level : int
+    Output compression level (out files end in .gz or .zst).
+    json_backend : str
+    Fast JSON decoding backend (json, orjson, simdjson, auto): skip deleted/withheld
+    tweets before parsing, and only extract fields needed for matching.
+    lang_id_cache_file : str
+    On-disk cache of detected languages by text hash, shared across archive files.
+    geo_batch_size : int
+    Tweets per batch for geo matching.
+    journal_file : str
+    Progress journal: skip archive file if completed, resume from last
+    checkpoint if partial.
+    checkpoint_size : int
+    Archive records between checkpoints.
+    """
+    # resume from progress journal
+    # gzip can't restart mid-member without decompressor state, so we
+    # roll back output to the last checkpoint and skip records already mined
+    all_out_files = [out_file for query_name, query_out_file in query_out_files.items() for out_file in get_query_out_files(query_out_file, query_params[query_name])]
+    journal = None
+    start_record = 0
+    if(journal_file is not None):
+        journal = ProgressJournal(journal_file, config=query_params)
+        if(journal.is_complete(archive_file)):
+            logging.debug('skipping completed archive file %s'%(archive_file))
+            return
+        progress = journal.get(archive_file)
+        if(progress is not None):
+            truncate_out_files(all_out_files, progress['out_file_sizes'])
+            start_record = progress['records']
+            logging.debug('resuming archive file %s at record %d'%(archive_file, start_record))
+        else:
+            journal.record(archive_file, 'partial', records=0, out_file_sizes=get_out_file_sizes(all_out_files))
+    queries = [TweetQuery(query_name, **query_params_i) for query_name, query_params_i in query_params.items()]
+    detect_langs = set([query.lang_detect for query in queries if query.lang_detect is not None])
+    if(len(detect_langs) > 0):
+        langid.set_languages(['en', 'es', 'fr'])
+    # on-the-fly detection: cache repeated text (retweets, spam)
+    lang_id_cache = None
+    if(len(detect_langs) > 0 and lang_detect_dir is None):
+        lang_id_cache = LangIDCache(cache_file=lang_id_cache_file, backend='cld2')
+    if(json_backend is not None):
+        mining_fields = list(dict.fromkeys([field for query in queries for field in query.get_mining_fields(lang_detect_dir=lang_detect_dir)]))
+        json_decoder = JSONLineDecoder(backend=json_backend, fields=mining_fields)
+        logging.debug('decoding JSON with backend %s, fields %s'%(json_decoder.backend, ','.join(mining_fields)))
+    else:
+        json_decoder = None
+    match_ctr = 0
+    error_ctr = 0
+    non_delete_ctr = 0
+    
+    # stream matches straight into compressed output
+    file_outputs = {query.name : CompressedFileWriter(query_out_files[query.name], compress_level=compress_level, append=True) for query in queries}
+    region_file_outputs = {}
+    def write_match(query, l, j, phrase_match_j, j_regions=None):
+        # lazy decoding only extracted the matching fields
+        if(json_decoder is not None and json_decoder.lazy):
+            j = json_decoder.decode_full(l)
+        else:
+            # other queries may tag the same tweet
+            j = dict(j)
+        # add info on matching phrase/s!
+        j['phrase_match'] = phrase_match_j
+        if(j_regions is not None):
+            j['geo_regions'] = j_regions
+        j_dump = json.dumps(j).replace('\n','')
+        try:
+            if(query.split_regions and j_regions is not None):
+                for region_name in j_regions:
+                    if((query.name, region_name) not in region_file_outputs):
+                        region_file_outputs[(query.name, region_name)] = CompressedFileWriter(build_region_out_file(query_out_files[query.name], region_name), compress_level=compress_level, append=True)
+                    region_file_outputs[(query.name, region_name)].write('%s\n'%(j_dump))
+            else:
+                file_outputs[query.name].write('%s\n'%(j_dump))
+        except Exception as e:
+            logging.debug('write exception %s'%(e))
+    
+    def write_geo_batch(query):
+        # malformed geo data => no match for that tweet only
+        batch_regions = query.geo_filter.match_batch([x[1] for x in query.geo_batch])
+        for (l, j, phrase_match_j), j_regions in zip(query.geo_batch, batch_regions):
+            if(len(j_regions) > 0):
+                query.match_ctr += 1
+                write_match(query, l, j, phrase_match_j, j_regions=j_regions)
+        query.geo_batch.clear()
+    
+    record_ctr = 0
+    def checkpoint(archive_offset=None):
+        # write pending matches as complete gz members/zst frames, then record sizes
+        for query in queries:
+            if(len(query.geo_batch) > 0):
+                write_geo_batch(query)
+        out_file_sizes = get_out_file_sizes(all_out_files)
+        for file_output in list(file_outputs.values()) + list(region_file_outputs.values()):
+            out_file_sizes[file_output.file_name] = file_output.checkpoint()
+        journal.record(archive_file, 'partial', records=record_ctr, offset=archive_offset, out_file_sizes=out_file_sizes)
+    
+    with gzip.open(archive_file, 'r') as archive:
+        lang_detect_valid_ids = None
+        if(lang_detect_dir is not None and len(detect_langs) > 0):
+            lang_detect_data_file = os.path.join(lang_detect_dir, os.path.basename(archive_file).replace('.gz', '_lang_id.tsv.gz'))
+            # memory-mapped sorted IDs instead of dict/set (converted from TSV on first use)
+            lang_detect_store = load_lang_id_store(lang_detect_data_file)
+            # get set of all valid IDs per lang
+            lang_detect_valid_ids = {lang_detect : lang_detect_store.get_id_set(lang=lang_detect) for lang_detect in detect_langs}
+            for lang_detect, lang_detect_valid_ids_i in lang_detect_valid_ids.items():
+                logging.debug('%d valid posts with lang %s'%(len(lang_detect_valid_ids_i), lang_detect))
+        for l in archive:
+            # skip records mined before last checkpoint
+            if(record_ctr < start_record):
+                record_ctr += 1
+                continue
+            if(journal is not None and record_ctr > start_record and record_ctr % checkpoint_size == 0):
+                checkpoint(archive_offset=archive.fileobj.tell())
+            record_ctr += 1
+            try:
+                if(json_decoder is not None):
+                    # deleted/withheld tweets => None
+                    j = json_decoder.decode(l)
+                    if(j is None):
+                        continue
+                else:
+                    if(type(l) is bytes):
+                        l = l.decode('utf-8').strip()
+                    j = json.loads(l.strip())
+                if('delete' not in j and 'status_withheld' not in j):
+                    non_delete_ctr += 1
+                    # logging.debug(sorted(j.keys()))
+                    j_cache = {}
+                    j_match = False
+                    for query in queries:
+                        query_match, phrase_match_j = query.match(j, j_cache, lang_detect_valid_ids=lang_detect_valid_ids, lang_id_cache=lang_id_cache)
+                        if(query_match):
+                            j_match = True
+                            # location matching happens in batches
+                            if(query.geo_filter is not None):
+                                query.geo_batch.append((l, j, phrase_match_j))
+                                if(len(query.geo_batch) >= geo_batch_size):
+                                    write_geo_batch(query)
+                            else:
+                                query.match_ctr += 1
+                                write_match(query, l, j, phrase_match_j)
+                    if(j_match):
+                        match_ctr += 1
+                    if(non_delete_ctr % 100000 == 0):
+                        logging.debug('matched %d/%d non-delete tweets'%(match_ctr, non_delete_ctr))
+            except Exception as e:
+                logging.debug(e)
+                # handling broken tweets
+                # logging.debug(e)
+                # logging.debug(type(l))
+                # logging.debug(l)
+                error_ctr += 1
+                pass
+            # tmp debugging
+#             if(non_delete_ctr > 100000):
+#                 break
+    for query in queries:
+        if(len(query.geo_batch) > 0):
+            write_geo_batch(query)
+    for file_output in list(file_outputs.values()) + list(region_file_outputs.values()):
+        file_output.close()
+    if(journal is not None):
+        journal.record(archive_file, 'completed', records=record_ctr, out_file_sizes=get_out_file_sizes(all_out_files))
+    logging.debug('non-delete %d tweets'%(non_delete_ctr))
+    logging.debug('matched %d tweets (before location matching)'%(match_ctr))
+    for query in queries:
+        logging.debug('query %s matched %d tweets'%(query.name, query.match_ctr))
+    logging.debug('errored %d tweets'%(error_ctr))
+    if(lang_id_cache is not None):
+        logging.debug('lang ID cache hits = %d, misses = %d'%(lang_id_cache.hit_ctr, lang_id_cache.miss_ctr))
+        lang_id_cache.close()
+
+def mine_tweets(archive_file, out_file, phrases=None, location_box=None, location_info=None, match_hashtags=False, user_loc_phrase=None, lang=None, lang_detect=None, lang_detect_dir=None, compress_level=None, json_backend=None, lang_id_cache_file=None, geo_regions=None, split_regions=False, geo_batch_size=10000):
     """
     Extract tweets from archive according to matching
     phrases in the main text or location, and write to file.
@@ -40,7 +376,7 @@ def mine_tweets(archive_file, out_file, phrases=None, location_box=None, locatio
     Parameters:
     -----------
     archive_file : str
-    file_output : str
+    out_file : str
     Writeable output file name.
     phrases : [str]
     location_box : [[float]]
@@ -52,146 +388,161 @@ def mine_tweets(archive_file, out_file, phrases=None, location_box=None, locatio
     lang : tweet language
     lang_detect : detected tweet language (via CLD)
     lang_detect_dir : directory for previously detected languages
+    compress_level : int
+    Output compression level (out_file ends in .gz or .zst); matches are appended to out_file.
+    json_backend : str
+    Fast JSON decoding backend (json, orjson, simdjson, auto).
+    lang_id_cache_file : str
+    On-disk cache of detected languages by text hash, shared across archive files.
+    geo_regions : dict
+    Named regions (boxes, polygons, place fields) to match, combined with
+    location_box/location_info; matches are tagged with geo_regions.
+    split_regions : bool
+    Write matches to one out file per region.
+    geo_batch_size : int
+    Tweets per batch for geo matching.
+    """
+    query_name = 'query'
+    query_params = {query_name : dict(phrases=phrases, location_box=location_box, location_info=location_info, match_hashtags=match_hashtags, user_loc_phrase=user_loc_phrase, lang=lang, lang_detect=lang_detect, geo_regions=geo_regions, split_regions=split_regions)}
+    mine_tweets_multi(archive_file, query_params, {query_name : out_file}, lang_detect_dir=lang_detect_dir, compress_level=compress_level, json_backend=json_backend, lang_id_cache_file=lang_id_cache_file, geo_batch_size=geo_batch_size)
+
+def build_query_params(phrases=None, phrase_file=None, match_hashtags=False, location_box=None, location_country=None, region_file=None, regions=None, split_regions=False, user_loc_phrase=None, lang=None, lang_detect=None):
     """
+    Convert query filters from command line or query manifest
+    to TweetQuery parameters.
+    
+    Parameters:
+    -----------
+    phrases : [str] or str
+    List or comma-separated phrases (ignored if phrase_file is given).
+    phrase_file : str
+    File with one phrase per line.
+    location_box : [float]
+    Latitude 1, latitude 2, longitude 1, longitude 2.
+    location_country : str
+    Place country code.
+    region_file : str
+    JSON file of named regions.
+    regions : dict
+    Named regions (same format as region_file).
+    """
+    if(isinstance(phrases, str)):
+        phrases = phrases.split(',')
     if(phrases is not None):
-        # logging.debug('phrases %s'%(','.join(phrases)))
-        if(match_hashtags):
-            phrase_tags = set([unidecode(x.replace('#','').lower()) for x in phrases])
-            logging.debug('phrase tags %s'%(phrase_tags))
-        else:
-#             phrase_matcher = re.compile('|'.join(phrases).lower())
-            # remove spaces when needed
-            phrases_fixed = phrases + [x.replace(' ', '') for x in phrases if ' ' in x]
-            phrases_fixed_combined = '|'.join(phrases_fixed).lower()
-            # match tokenized words
-            # this might be easier if we just tokenized and rejoined everything with whitespace...awk
-            phrases_fixed_str = '(?<=[,\.! #])(%s)(?=[,\.! #])|(?<=[,\.! #])(%s)$|^(%s)(?=[,\.! #])'%(phrases_fixed_combined, phrases_fixed_combined, phrases_fixed_combined)
-#             phrase_matcher = re.compile('|'.join(phrases_fixed).lower())
-            phrase_matcher = re.compile(phrases_fixed_str)
-#             logging.debug('phrase match pattern %s'%(phrase_matcher.pattern))
+        phrases = [x for x in phrases if x != '']
+        if(len(phrases) == 0):
+            phrases = None
+    if(phrase_file is not None):
+        phrases = sorted(set([l.strip().lower() for l in open(phrase_file, 'r')]) - set(['']))
+    # load locations if they exist
+    if(location_box is not None and len(location_box) > 0 and location_box != ''):
+        location_box = list(map(float, location_box))
+        location_box = [location_box[:2], location_box[2:]]
     else:
-        phrase_matcher = None
-    if(user_loc_phrase is not None):
-        user_loc_phrase_matcher = re.compile(user_loc_phrase.lower())
-    if(location_info is not None):
-        logging.debug('location info %s'%(location_info))
-    if(lang_detect):
-        langid.set_languages(['en', 'es', 'fr'])
-    match_ctr = 0
-    error_ctr = 0
-    non_delete_ctr = 0
+        location_box = None
+    location_info = {}
+    if(location_country is not None):
+        location_info['country_code'] = location_country
+    geo_regions = None
+    if(region_file is not None):
+        geo_regions = load_geo_regions(region_file)
+    if(regions is not None):
+        geo_regions = dict(geo_regions or {}, **regions)
+    if(user_loc_phrase == ''):
+        user_loc_phrase = None
+    query_params = dict(phrases=phrases, location_box=location_box, location_info=location_info, match_hashtags=match_hashtags, user_loc_phrase=user_loc_phrase, lang=lang, lang_detect=lang_detect, geo_regions=geo_regions, split_regions=split_regions)
+    return query_params
+
+def load_query_manifest(query_file):
+    """
+    Load query manifest (YAML or JSON): query name => filters, e.g.
     
-    with open(out_file, 'a') as file_output:
-        with gzip.open(archive_file, 'r') as archive:
-            if(lang_detect_dir is not None):
-                lang_detect_data_file = os.path.join(lang_detect_dir, os.path.basename(archive_file).replace('.gz', '_lang_id.tsv.gz'))
-                lang_detect_data = pd.read_csv(lang_detect_data_file, sep='\t', index_col=False, header=None, compression='gzip', names=['id', 'lang', 'score'])
-                # convert ID to int
-                lang_detect_data = lang_detect_data.assign(**{'id' : lang_detect_data.loc[:, 'id'].apply(lambda x: int(x))})
-                lang_detect_data.drop_duplicates('id', inplace=True)
-                # make dictionary for fast lookup
-                lang_detect_lookup = dict(zip(lang_detect_data.loc[:, 'id'].values, lang_detect_data.loc[:, 'lang'].values))
-                # get set of all valid IDs
-                lang_detect_valid_ids = set(lang_detect_data[lang_detect_data.loc[:, 'lang']==lang_detect].loc[:, 'id'].unique())
-                logging.debug('%d valid posts with lang %s'%(len(lang_detect_valid_ids), lang_detect))
-            for l in archive:
-                try:
-                    if(type(l) is bytes):
-                        l = l.decode('utf-8').strip()
-                    j = json.loads(l.strip())
-                    if('delete' not in j and 'status_withheld' not in j):
-                        non_delete_ctr += 1
-                        # logging.debug(sorted(j.keys()))
-                        # phrase matching for hashtag/text
-                        txt_match = True
-                        phrase_match_j = []
-                        if(phrases is not None):
-                            if(match_hashtags):
-                                if(j.get('entities') is not None and j['entities'].get('hashtags') is not None):
-                                    j_tags = set([unidecode(x['text'].lower()) for x in j['entities']['hashtags']])
-                                    phrase_match_j = j_tags
-                                    txt_match = (len(phrase_tags & j_tags) > 0)
-                            else:
-                                j_text = unidecode(j['text'].lower())
-                                phrase_match_j = phrase_matcher.findall(j_text)
-                                if(len(phrase_match_j) > 0):
-                                    phrase_match_j = list(reduce(lambda a,b: a+b, [[y for y in x if y!=''] for x in phrase_match_j]))
-                                txt_match = (len(phrase_match_j) > 0)
-                        j_coord = j.get('coordinates')
-                        j_place = j.get('place')
-                        # location matching
-                        loc_match = True
-                        if(location_box is not None):
-                            if(j_coord is not None and contains_geo(j_coord, location_box)):
-                                loc_match = True
-                            else:
-                                loc_match = False
-                        if(location_info is not None and len(location_info) > 0):
-                            if(j_place is not None):
-    #                             if(j_place['country_info'] == 'FR'):
-    #                                 logging.debug('should catch place = %s'%(str(j_place)))
-                                loc_match = all([j_place[k] == v for k,v in location_info.items()])
-                            else:
-                                loc_match = False
-                        # user bio location matching
-                        user_loc_match = True
-                        if(user_loc_phrase is not None):
-                            if(j['user'].get('location') is not None):
-                                j_user_loc = unidecode(j['user']['location'].lower())
-                                user_loc_match = user_loc_phrase_matcher.search(j_user_loc) is not None
-                            else:
-                                user_loc_match = False
-                        # language matching
-                        # use tweet-provided lang, use pre-detected lang, or detect lang on the fly
-                        lang_match = True
-                        if(lang is not None):
-                            lang_match = j['lang'] == lang
-                        if(lang_detect_dir is not None):
-                            lang_match = j['id'] in lang_detect_valid_ids
-#                             if(lang_match):
-#                                 logging.debug('ID %d matches lang %s'%(j['id'], lang_detect))
-#                             if(not lang_match):
-#                                 logging.debug('ID %d not found in lang_detect'%(j['id']))
-#                             else:
-#                                 j_lang_detect = lang_detect_lookup[int(j['id'])]
-#                                 lang_match = j_lang_detect == lang_detect
-                        elif(lang_detect is not None):
-#                             j_lang_detect = langid.classify(j['text'])[0]
-                            j_lang_detect = cld2.detect(j['text']).details[0].language_code
-                            lang_match = j_lang_detect == lang_detect
-                        # if(phrase_matcher.search(j_text) is not None):
-    #                     logging.debug('txt match %s, loc match %s, user loc match %s'%(txt_match, loc_match, user_loc_match))
-                        if(txt_match and loc_match and user_loc_match and lang_match):
-                            match_ctr += 1
-    #                         logging.debug(j_text)
-                            # add info on matching phrase/s!
-                            j['phrase_match'] = phrase_match_j
-                            j_dump = json.dumps(j).replace('\n','')
-                            try:
-                                file_output.write('%s\n'%(j_dump))
-                            except Exception as e:
-                                logging.debug('write exception %s'%(e))
-                        # tmp debugging
-#                         elif(lang_match): 
-#                             logging.debug('lang match True: txt_match %s loc_match %s user_loc_match %s'%(txt_match, loc_match, user_loc_match))
-                        if(non_delete_ctr % 100000 == 0):
-                            logging.debug('matched %d/%d non-delete tweets'%(match_ctr, non_delete_ctr))
-                except Exception as e:
-                    logging.debug(e)
-                    # handling broken tweets
-                    # logging.debug(e)
-                    # logging.debug(type(l))
-                    # logging.debug(l)
-                    error_ctr += 1
-                    pass
-                # tmp debugging
-    #             if(non_delete_ctr > 100000):
-    #                 break
-    logging.debug('non-delete %d tweets'%(non_delete_ctr))
-    logging.debug('matched %d tweets'%(match_ctr))
-    logging.debug('errored %d tweets'%(error_ctr))
+    es_loanwords:
+      phrase_file: ../../data/loanword_resources/tweets_loanwords_clean_integrated_verbs.txt
+      lang_detect: es
+    karachi:
+      location_box: [24, 26, 70, 71]
+      lang: ur
+    
+    Filters are the same as the command line arguments: phrases,
+    phrase_file, match_hashtags, location_box, location_country,
+    region_file, split_regions, user_loc_phrase, lang, lang_detect,
+    plus inline regions.
+    
+    :param query_file: .yaml/.yml or .json file
+    :returns query_params:: query name => TweetQuery parameters
+    """
+    with open(query_file, 'r') as query_input:
+        if(query_file.endswith('.yaml') or query_file.endswith('.yml')):
+            if(yaml is None):
+                raise ImportError('YAML query manifest requires pyyaml; use JSON instead')
+            queries = yaml.safe_load(query_input)
+        else:
+            queries = json.load(query_input)
+    query_params = {str(query_name) : build_query_params(**query) for query_name, query in queries.items()}
+    return query_params
+
+def get_query_out_files(out_file, query_params):
+    """
+    Get all files a query writes: main out file and per-region files.
+    """
+    out_files = [out_file]
+    if(query_params.get('split_regions')):
+        geo_regions = build_geo_regions(location_box=query_params.get('location_box'), location_info=query_params.get('location_info'), geo_regions=query_params.get('geo_regions'))
+        out_files += [build_region_out_file(out_file, region_name) for region_name in (geo_regions or {})]
+    return out_files
 
-def build_out_file(out_dir, phrases, phrase_file, location_box, location_info, user_loc_phrase, lang, lang_detect, add_dates_from_files_to_out_file, archive_files):
+def build_shard_file(shard_dir, archive_file, compression='gz', query_name=None):
+    """
+    Build per-archive-file (and per-query) shard to which to write tweets
+    when mining files in parallel.
+    """
+    archive_file_base = os.path.basename(archive_file).replace('.gz', '')
+    if(query_name is not None):
+        archive_file_base = '%s_QUERY=%s'%(archive_file_base, query_name)
+    shard_file = os.path.join(shard_dir, '%s_mined.%s'%(archive_file_base, compression))
+    return shard_file
+
+def merge_shard_files(shard_files, out_file, chunk_size=2**24):
+    """
+    Concatenate gzip/zst shards into the out file.
+    Concatenated gzip members (or zst frames) are a valid file,
+    so we can copy raw bytes in chunks without decompressing
+    or loading the shards into memory.
+    
+    :param shard_files: shard files, in order
+    :param out_file: combined gzip/zst file
+    :param chunk_size: bytes to copy at once
+    """
+    with open(out_file, 'wb') as file_output:
+        for shard_file in shard_files:
+            if(os.path.exists(shard_file)):
+                with open(shard_file, 'rb') as shard_input:
+                    shutil.copyfileobj(shard_input, file_output, chunk_size)
+
+def build_date_range_str(archive_files):
+    archive_files = sorted(archive_files)
+    # hack: find first date in file name
+    # MONTH-day-year
+    date_matcher = re.compile('\w{3}-\d{2}-\d{2}')
+    date_str_1 = date_matcher.search(os.path.basename(archive_files[0])).group(0)
+    date_str_2 = date_matcher.search(os.path.basename(archive_files[-1])).group(0)        
+    return '_DATERANGE=%s-%s'%(date_str_1, date_str_2)
+
+def build_query_out_file(out_dir, query_file, query_name, add_dates_from_files_to_out_file, archive_files):
+    """
+    Build out file for query from manifest, e.g.
+    archive_QUERIES=loanwords_QUERY=es_DATERANGE=...gz
+    """
+    out_file_str = '_QUERIES=%s'%(os.path.basename(query_file).split('.')[0])
+    if(query_name is not None):
+        out_file_str += '_QUERY=%s'%(query_name)
+    if(add_dates_from_files_to_out_file):
+        out_file_str += build_date_range_str(archive_files)
+    out_file = os.path.join(out_dir, 'archive%s.gz'%(out_file_str))
+    return out_file
+
+def build_out_file(out_dir, phrases, phrase_file, location_box, location_info, user_loc_phrase, lang, lang_detect, add_dates_from_files_to_out_file, archive_files, region_file=None):
     """
     Build out file to which to write tweets.
     """
@@ -213,16 +564,12 @@ def build_out_file(out_dir, phrases, phrase_file, location_box, location_info, u
     if(location_info is not None):
         for k, v in sorted(list(location_info.items()), key=lambda x: x[0]):
             out_file_str += '_%s=%s'%(k, v)
+    if(region_file is not None):
+        out_file_str += '_REGIONS=%s'%(os.path.basename(region_file).split('.')[0])
     if(user_loc_phrase is not None):
         out_file_str += "USERLOCPHRASE=_%s"%(user_loc_phrase)
     if(add_dates_from_files_to_out_file):
-        archive_files = sorted(archive_files)
-        # hack: find first date in file name
-        # MONTH-day-year
-        date_matcher = re.compile('\w{3}-\d{2}-\d{2}')
-        date_str_1 = date_matcher.search(os.path.basename(archive_files[0])).group(0)
-        date_str_2 = date_matcher.search(os.path.basename(archive_files[-1])).group(0)        
-        out_file_str += '_DATERANGE=%s-%s'%(date_str_1, date_str_2)
+        out_file_str += build_date_range_str(archive_files)
     if(lang is not None):
         out_file_str += '_LANG=%s'%(lang)
     if(lang_detect is not None):
@@ -230,6 +577,20 @@ def build_out_file(out_dir, phrases, phrase_file, location_box, location_info, u
     out_file = os.path.join(out_dir, 'archive%s.gz'%(out_file_str))
     return out_file
     
+def start_journal(journal_file, query_params, resume=False):
+    """
+    Start progress journal for mining run.
+    Returns True if resuming from previous progress,
+    False if the run starts over (out files should be cleared).
+    """
+    if(not resume and os.path.exists(journal_file)):
+        os.remove(journal_file)
+    journal = ProgressJournal(journal_file, config=query_params)
+    if(len(journal.progress) > 0):
+        logging.debug('resuming from journal %s: %d/%d archive files completed'%(journal_file, len([x for x in journal.progress.values() if x['status'] == 'completed']), len(journal.progress)))
+        return True
+    return False
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('archive_files', nargs='+')
@@ -238,44 +599,38 @@ def main():
     parser.add_argument('--match_hashtags', default=False)
     parser.add_argument('--location_box', nargs='+', default=None)
     parser.add_argument('--location_country', default=None)
+    parser.add_argument('--region_file', default=None) # JSON file of named boxes/polygons/places
+    parser.add_argument('--split_regions', action='store_true') # one out file per region
+    parser.add_argument('--query_file', default=None) # YAML/JSON manifest of named queries => one scan, one out file per query
     parser.add_argument('--user_loc_phrase', default=None)
     parser.add_argument('--lang', default=None)
     parser.add_argument('--lang_detect', default=None)
     parser.add_argument('--lang_detect_dir', default=None)
     parser.add_argument('--out_dir', default='../../data/mined_tweets/')
     parser.add_argument('--add_dates_from_files_to_out_file', type=bool, default=True)
+    parser.add_argument('--workers', type=int, default=1) # >1 => mine archive files in parallel into per-file shards
+    parser.add_argument('--compression', default='gz') # gz, zst
+    parser.add_argument('--compress_level', type=int, default=None)
+    parser.add_argument('--json_backend', default=None) # fast JSON decoding: json, orjson, simdjson, auto
+    parser.add_argument('--lang_id_cache', default=None) # sqlite cache of detected languages by text hash
+    parser.add_argument('--resume', action='store_true') # continue interrupted run from progress journal
+    parser.add_argument('--checkpoint_size', type=int, default=1000000) # archive records between checkpoints
     args = vars(parser.parse_args())
 
-    # extract phrases
-    phrases = args['phrases'].split(',')
-    if(len(phrases) == 1 and phrases[0] == ''):
-        phrases = None
-    if(args.get('phrase_file') is not None and os.path.exists(args['phrase_file'])):
-        phrases = sorted(set([l.strip().lower() for l in open(args['phrase_file'], 'r')]) - set(['']))
-        phrase_file = args['phrase_file']
-    else:
-        phrases = None
-        phrase_file = None
-    # load locations if they exist
-    if(args.get('location_box') is not None and len(args['location_box']) > 0 and args['location_box'] != ''):
-        location_box = list(map(float, args['location_box']))
-        location_box = [location_box[:2], location_box[2:]]
-    else:
-        location_box = None
-    location_info = {}
-    if(args.get('location_country') is not None):
-        location_info['country_code'] = args['location_country']
-#     logging.debug('user loc phrase "%s"'%(user_loc_phrase))
-    if(args['user_loc_phrase'] == ''):
-        user_loc_phrase = None
     archive_files = args.get('archive_files')
     lang = args.get('lang')
     lang_detect = args.get('lang_detect')
     lang_detect_dir = args.get('lang_detect_dir')
     add_dates_from_files_to_out_file = args.get('add_dates_from_files_to_out_file')
     out_dir = args.get('out_dir')
-    user_loc_phrase = args.get('user_loc_phrase')
-    match_hashtags = args.get('match_hashtags')
+    workers = args.get('workers')
+    compression = args.get('compression')
+    compress_level = args.get('compress_level')
+    json_backend = args.get('json_backend')
+    lang_id_cache_file = args.get('lang_id_cache')
+    query_file = args.get('query_file')
+    resume = args.get('resume')
+    checkpoint_size = args.get('checkpoint_size')
         
     # sort archive files by date (month-day-year)
     date_fmt = '%b-%d-%y'
@@ -285,37 +640,86 @@ def main():
     archive_files, archive_file_dates = zip(*sorted(zip(archive_files, archive_file_dates), key=lambda x: x[1]))
     start_date = datetime.strftime(archive_file_dates[0], date_fmt)
     end_date = datetime.strftime(archive_file_dates[-1], date_fmt)
-    # out file
-    out_file = build_out_file(out_dir, phrases, phrase_file, location_box, location_info, user_loc_phrase, lang, lang_detect, add_dates_from_files_to_out_file, archive_files)
-    # logging file
     logging_dir = '../../output'
-    logging_file = build_out_file(logging_dir, phrases, phrase_file, location_box, location_info, user_loc_phrase, lang, lang_detect, add_dates_from_files_to_out_file, archive_files).replace('.gz', '.txt')
-    if(os.path.exists(logging_file)):
+    # queries and out files
+    if(query_file is not None):
+        # many queries, one scan => one out file per query
+        query_params = load_query_manifest(query_file)
+        out_file = build_query_out_file(out_dir, query_file, None, add_dates_from_files_to_out_file, archive_files)
+        query_out_files = {query_name : build_query_out_file(out_dir, query_file, query_name, add_dates_from_files_to_out_file, archive_files) for query_name in query_params}
+        logging_file = build_query_out_file(logging_dir, query_file, None, add_dates_from_files_to_out_file, archive_files).replace('.gz', '.txt')
+    else:
+        query_name = 'query'
+        query_params_i = build_query_params(phrases=args['phrases'], phrase_file=args.get('phrase_file'), match_hashtags=args.get('match_hashtags'), location_box=args.get('location_box'), location_country=args.get('location_country'), region_file=args.get('region_file'), split_regions=args.get('split_regions'), user_loc_phrase=args.get('user_loc_phrase'), lang=lang, lang_detect=lang_detect)
+        query_params = {query_name : query_params_i}
+        # out file
+        out_file_args = [query_params_i['phrases'], args.get('phrase_file'), query_params_i['location_box'], query_params_i['location_info'], query_params_i['user_loc_phrase'], lang, lang_detect, add_dates_from_files_to_out_file, archive_files]
+        out_file = build_out_file(out_dir, *out_file_args, region_file=args.get('region_file'))
+        query_out_files = {query_name : out_file}
+        # logging file
+        logging_file = build_out_file(logging_dir, *out_file_args, region_file=args.get('region_file')).replace('.gz', '.txt')
+    if(compression != 'gz'):
+        out_file = out_file.replace('.gz', '.%s'%(compression))
+        query_out_files = {query_name : query_out_file.replace('.gz', '.%s'%(compression)) for query_name, query_out_file in query_out_files.items()}
+    if(os.path.exists(logging_file) and not resume):
         os.remove(logging_file)
     logging.basicConfig(filename=logging_file, level=logging.DEBUG)
-    logging.debug('going to write to out file %s'%(out_file))
+    for query_name, query_out_file in query_out_files.items():
+        logging.debug('going to write query %s to out file %s'%(query_name, query_out_file))
+    
+    # parallel: mine each archive file into its own gzip shard per query,
+    # then concatenate shards in date order
+    if(workers > 1):
+        shard_dir = out_file.replace('.%s'%(compression), '_shards')
+        if(not os.path.exists(shard_dir)):
+            os.mkdir(shard_dir)
+        shard_out_files = [{query_name : build_shard_file(shard_dir, archive_file, compression=compression, query_name=query_name) for query_name in query_params} for archive_file in archive_files]
+        # shared journal: workers append progress for their own archive files
+        journal_file = os.path.join(shard_dir, 'progress.journal')
+        if(not start_journal(journal_file, query_params, resume)):
+            for shard_out_files_i in shard_out_files:
+                for query_name, shard_file in shard_out_files_i.items():
+                    for shard_file_j in get_query_out_files(shard_file, query_params[query_name]):
+                        if(os.path.exists(shard_file_j)):
+                            os.remove(shard_file_j)
+        mine_args = [[archive_file, query_params, shard_out_files_i, lang_detect_dir, compress_level, json_backend, lang_id_cache_file, 10000, journal_file, checkpoint_size] for archive_file, shard_out_files_i in zip(archive_files, shard_out_files)]
+        logging.debug('mining %d archive files with %d workers'%(len(archive_files), workers))
+        # one file per task => long files don't hold up the rest of the queue
+        with Pool(processes=workers) as pool:
+            pool.starmap(mine_tweets_multi, mine_args, chunksize=1)
+        # merge each query (and region) file separately
+        for query_name, query_out_file in query_out_files.items():
+            query_shard_files = [get_query_out_files(shard_out_files_i[query_name], query_params[query_name]) for shard_out_files_i in shard_out_files]
+            for k, query_out_file_k in enumerate(get_query_out_files(query_out_file, query_params[query_name])):
+                merge_shard_files([query_shard_files_i[k] for query_shard_files_i in query_shard_files], query_out_file_k)
+        shutil.rmtree(shard_dir)
+        return
     
     # find tweets with matching phrase and/or location
     # and write to file
-    # repeatedly append to end of txt file
-    # then compress after mining
-    txt_out_file = out_file.replace('.gz', '.txt')
-    if(os.path.exists(txt_out_file)):
-        os.remove(txt_out_file)
+    # repeatedly append to end of compressed file
+    journal_file = '%s.journal'%(os.path.splitext(out_file)[0])
+    if(not start_journal(journal_file, query_params, resume)):
+        for query_name, query_out_file in query_out_files.items():
+            for query_out_file_j in get_query_out_files(query_out_file, query_params[query_name]):
+                if(os.path.exists(query_out_file_j)):
+                    os.remove(query_out_file_j)
+    lang_detect_queries = any([query_params_i['lang_detect'] for query_params_i in query_params.values()])
     for archive_file in archive_files:
         logging.debug('mining archive file %s'%(archive_file))
         # limit processes for lang detection
         # if not, langid will use multiple cores => TODO: is this actually the problem?
-        if(lang_detect):
+        if(lang_detect_queries):
             with Pool(processes=1) as pool:
-                pool.starmap(mine_tweets, [[archive_file, txt_out_file, phrases, location_box, location_info, match_hashtags, user_loc_phrase, lang, lang_detect, lang_detect_dir]])
+                pool.starmap(mine_tweets_multi, [[archive_file, query_params, query_out_files, lang_detect_dir, compress_level, json_backend, lang_id_cache_file, 10000, journal_file, checkpoint_size]])
                 pool.close()
         else:
-            mine_tweets(archive_file, txt_out_file, phrases=phrases, location_box=location_box, location_info=location_info, match_hashtags=match_hashtags, user_loc_phrase=user_loc_phrase, lang=lang, lang_detect=lang_detect, lang_detect_dir=lang_detect_dir)        
-    # compress gzip file after writing
-    with gzip.open(out_file, 'wt') as file_output:
-        file_output.write(''.join(open(txt_out_file).readlines()))
-    os.remove(txt_out_file)
+            mine_tweets_multi(archive_file, query_params, query_out_files, lang_detect_dir=lang_detect_dir, compress_level=compress_level, json_backend=json_backend, lang_id_cache_file=lang_id_cache_file, journal_file=journal_file, checkpoint_size=checkpoint_size)
+    os.remove(journal_file)
+    # old: compress gzip file after writing => needs memory for full output
+#     with gzip.open(out_file, 'wt') as file_output:
+#         file_output.write(''.join(open(txt_out_file).readlines()))
+#     os.remove(txt_out_file)
 #     with gzip.open(out_file, 'wt') as file_output:
 #         for archive_file in archive_files:
 #             logging.debug('mining archive file %s'%(archive_file))
@@ -24,12 +24,20 @@ PHRASE_FILE=../../data/loanword_resources/tweets_loanwords_clean_integrated_verb
 # PHRASES='""'
 # location: lat1 lat2 lon1 lon2
 # LOCATION_BOX=(24 26 70 71)
+# named regions (JSON: name => {"box" : [lon_min, lat_min, lon_max, lat_max]}, {"polygon" : [[lon, lat], ...]} or {"place" : {"country_code" : "FR"}})
+# REGION_FILE=../../data/loanword_resources/mining_regions.json
+# SPLIT_REGIONS=--split_regions # one output file per region
 # USER_LOC_PHRASE='""'
 # lang
 # TWEET_LANG_DETECT='fr'
 TWEET_LANG_DETECT='es'
 # pre-detected language data
 TWEET_LANG_DETECT_DIR=$ARCHIVE_DIR/lang_id
+# output compression (gz or zst) and level
+# COMPRESSION=zst
+# COMPRESS_LEVEL=3
+# fast JSON decoding (json, orjson, simdjson, auto)
+# JSON_BACKEND=auto
 # output directory
 # OUT_DIR=../../data/mined_tweets/loanword_tweets/FR_archive/
 OUT_DIR=../../data/mined_tweets/loanword_tweets/ES_archive/
@@ -38,5 +46,15 @@ OUT_DIR=../../data/mined_tweets/loanword_tweets/ES_archive/
 # mine safely in parallel
 JOBS=1
 parallel --jobs $JOBS --bar --verbose python mine_twitter_archive.py {} --phrase_file $PHRASE_FILE --lang_detect $TWEET_LANG_DETECT --lang_detect_dir $TWEET_LANG_DETECT_DIR --out_dir $OUT_DIR ::: $(ls $ARCHIVE_FILES)
+## mine all files in one job => per-file shards, merged into one output file
+# WORKERS=32
+# python mine_twitter_archive.py $(ls $ARCHIVE_FILES) --phrase_file $PHRASE_FILE --lang_detect $TWEET_LANG_DETECT --lang_detect_dir $TWEET_LANG_DETECT_DIR --out_dir $OUT_DIR --workers $WORKERS
+## many queries in one scan => one output file per query
+## manifest (YAML or JSON): query name => filters, e.g.
+## es_loanwords: {phrase_file: ../../data/loanword_resources/tweets_loanwords_clean_integrated_verbs.txt, lang_detect: es}
+# QUERY_FILE=../../data/loanword_resources/mining_queries.yaml
+# python mine_twitter_archive.py $(ls $ARCHIVE_FILES) --query_file $QUERY_FILE --lang_detect_dir $TWEET_LANG_DETECT_DIR --out_dir $OUT_DIR --workers $WORKERS
+## interrupted run: rerun same command with --resume => skips finished archive files, continues from last checkpoint
+# python mine_twitter_archive.py $(ls $ARCHIVE_FILES) --query_file $QUERY_FILE --lang_detect_dir $TWEET_LANG_DETECT_DIR --out_dir $OUT_DIR --workers $WORKERS --resume
 ## debugging: see what run actually does
 # ls "${ARCHIVE_FILES[@]}" | parallel --dryrun --jobs $JOBS --bar python "mine_twitter_archive.py --archive_files {} --phrases ${PHRASES[@]} --out_dir $OUT_DIR_TWEETS" ::: "${ARCHIVE_FILES[@]}"
\ No newline at end of file
@@ -6,12 +6,9 @@ from argparse import ArgumentParser
 import logging
 import os
 import gzip
-from bz2 import BZ2File
-from data_helpers import ZstdWrapper
-# import langid
-import cld2 # 10x faster than langid: https://github.com/GregBowyer/cld2-cffi
-import json
-import lzma
+from functools import partial
+from time import time
+from data_helpers import get_file_iter, get_lang_id_store_dir, LangIDStoreWriter, LANG_ID_SCORE_SCALE, init_lang_id_model, detect_lang_post_batch, run_ordered_batches
 
 def main():
     parser = ArgumentParser()
@@ -20,6 +17,12 @@ def main():
     parser.add_argument('--out_dir', default=None)
     parser.add_argument('--text_var', default='text')
     parser.add_argument('--id_var', default='id')
+    parser.add_argument('--no_store', dest='write_store', action='store_false') # skip binary lang ID store
+    # cld2 is 10x faster than langid: https://github.com/GregBowyer/cld2-cffi
+    parser.add_argument('--backend', default='cld2', choices=['cld2', 'langid'])
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--buffer_size', type=int, default=2**24) # bytes of lines per batch
+    parser.add_argument('--lang_id_cache', default=None) # sqlite cache of lang ID by text hash, shared across files
     # old argument for langid to speed up processing
 #     parser.add_argument('--allowed_langs', nargs='+', default=['en', 'es', 'fr', 'ms', 'ja', 'ar', 'ru', 'pt', 'tr', 'ko']) # based on most popular languages in 2013 https://mashable.com/2013/12/17/twitter-popular-languages/
     args = vars(parser.parse_args())
@@ -45,52 +48,42 @@ def main():
 #         langid.set_languages(args['allowed_langs'])
     
     ## iterate over all data and write langid output to file
+    ## batches of lines are tagged in worker processes, written in file order
     post_file_format = post_file.split('.')[-1]
     out_file_name = os.path.join(out_dir, os.path.basename(post_file.replace('.%s'%(post_file_format), '_lang_id.tsv.gz')))
     logging.debug('writing to file %s'%(out_file_name))
+    backend = args['backend']
     line_ctr = 0
-    delete_val = '[deleted]'
+    error_ctr = 0
+    # binary sidecar store for fast ID lookup during mining
+    store_writer = None
+    if(args['write_store']):
+        store_writer = LangIDStoreWriter(get_lang_id_store_dir(out_file_name), score_scale=LANG_ID_SCORE_SCALE[backend])
     if(not os.path.exists(out_file_name)):
         with gzip.open(out_file_name, 'wt') as out_file:
+            # batches of lines
+            post_file_input = get_file_iter(post_file, buffer_size=args['buffer_size'])
             try:
-                if(post_file_format == 'gz'):
-                    post_file_input = gzip.open(post_file)
-                elif(post_file_format == 'bz2'):
-                    post_file_input = BZ2File(post_file)
-                elif(post_file_format == 'xz'):
-                    post_file_input = lzma.open(post_file)
-                elif(post_file_format == 'zst'):
-                    post_file_input = ZstdWrapper(post_file) # WARNING returns list of lines to process
-#                     decomp = ZstdDecompressor()
-#                     post_file_input = decomp.read_to_iter(open(post_file, 'r'))
-                for lines in post_file_input:
-                    # for consistency: convert each line to list of lines
-                    if(type(lines) is str or type(lines) is bytes):
-                        lines = [lines]
-                    for l in lines:
-                        try:
-                            l_data = json.loads(l.strip())
-                            if('delete' not in l_data.keys() and l_data[args['text_var']] != delete_val):
-                                status_id = l_data[args['id_var']]
-                                txt = l_data[args['text_var']]
-        #                         txt_lang, txt_lang_conf_score = langid.classify(txt)
-                                # use most likely language and score
-                                txt_lang_results = cld2.detect(txt).details
-                                txt_lang = txt_lang_results[0].language_code
-                                txt_lang_conf_score = txt_lang_results[0].percent
-                                # writing lang + ID to file
-                                out_file.write('%s\n'%('\t'.join([str(status_id), txt_lang, '%.3f'%(txt_lang_conf_score)])))
-                                # writing full data to file
-                #                 l_data['lang_id'] = {'lang' : txt_lang[0], 'score' : txt_lang[1]}
-                #                 out_file.write('%s\n'%(json.dumps(l_data)))
-                                line_ctr += 1
-                                if(line_ctr % 1000000 == 0):
-                                    logging.debug('processed %d lines'%(line_ctr))
-                        except Exception as e:
-                            logging.debug('error = %s'%(e))
-                            pass
-                post_file_input.close()
+                batch_fn = partial(detect_lang_post_batch, backend=backend, txt_var=args['text_var'], id_var=args['id_var'])
+                start_time = time()
+                for lang_id_results, batch_error_ctr in run_ordered_batches(batch_fn, post_file_input, workers=args['workers'], initializer=init_lang_id_model, initargs=(backend, args['lang_id_cache'])):
+                    for status_id, txt_lang, txt_lang_conf_score in lang_id_results:
+                        # writing lang + ID to file
+                        out_file.write('%s\n'%('\t'.join([str(status_id), txt_lang, '%.3f'%(txt_lang_conf_score)])))
+                        if(store_writer is not None):
+                            store_writer.add(status_id, txt_lang, txt_lang_conf_score)
+                    prev_line_ctr = line_ctr
+                    line_ctr += len(lang_id_results)
+                    error_ctr += batch_error_ctr
+                    if(line_ctr // 1000000 > prev_line_ctr // 1000000):
+                        logging.debug('processed %d lines (%.1f posts/sec)'%(line_ctr, line_ctr / (time() - start_time)))
+                logging.debug('processed %d lines, %d errors (%.1f posts/sec)'%(line_ctr, error_ctr, line_ctr / max(time() - start_time, 1e-6)))
+                if(store_writer is not None):
+                    store_writer.close()
+                    logging.debug('wrote lang ID store %s'%(store_writer.store_dir))
             except Exception as e:
+                logging.debug('error = %s'%(e))
+            finally:
                 logging.debug('closing input file')
                 post_file_input.close()
 
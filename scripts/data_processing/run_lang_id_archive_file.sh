@@ -34,6 +34,14 @@ JOBS=20
 parallel --jobs $JOBS --bar --verbose python run_lang_id_archive_file.py {} --text_var $TXT_VAR --id_var $ID_VAR ::: $(ls $ARCHIVE_FILES)
 # custom list
 # parallel --jobs $JOBS --bar --verbose python run_lang_id_archive_file.py {} --text_var $TXT_VAR --id_var $ID_VAR ::: "${ARCHIVE_FILES[@]}"
+## one file at a time, batches of lines spread over all cores
+# WORKERS=20
+# BACKEND=cld2 # or langid (normalized probabilities)
+# LANG_ID_CACHE=$ARCHIVE_DIR/lang_id/lang_id_cache.db # shared cache of lang ID by text hash
+# for ARCHIVE_FILE in $(ls $ARCHIVE_FILES);
+# do
+#     python run_lang_id_archive_file.py $ARCHIVE_FILE --text_var $TXT_VAR --id_var $ID_VAR --workers $WORKERS --backend $BACKEND --lang_id_cache $LANG_ID_CACHE
+# done
 
 ## combine all files
 ## actually don't do this; we should keep them separate for modularity
@@ -6,51 +6,27 @@ from argparse import ArgumentParser
 import logging
 import os
 import pandas as pd
-from data_helpers import get_file_iter, BasicTokenizer, clean_txt_for_matching, clean_txt_emojis
+from data_helpers import get_file_iter, BasicTokenizer, clean_txt_for_matching, clean_txt_emojis, PhraseMatcher, expand_phrase_pattern, load_lang_id_store, generate_phrase_queries, ESInstanceManager, get_es_instance_name, iter_scroll_results, QueryResultCache
 from nltk.tokenize import sent_tokenize
 import re
 import json
-from elasticsearch import Elasticsearch
-from subprocess import Popen
 import numpy as np
-from time import sleep
 np.random.seed(123)
 
-def collect_scroll_results(es, es_instance_name, es_query, MAX_SCROLL_SIZE=1000):
-    """
-    Collect full query results using Elasticsearch scroll.
-    """
-    res = es.search(index=es_instance_name, body=es_query, size=MAX_SCROLL_SIZE, scroll='2m')
-    scroll_id = res['_scroll_id']
-    scroll_size = len(res['hits']['hits'])
-    full_results = []
-    while(scroll_size > 0):
-#         for i, res_i in enumerate(res['hits']['hits']):
-#             full_results.append(res_i)
-        full_results += res['hits']['hits']
-        res = es.scroll(scroll_id=scroll_id, scroll='2m')
-        scroll_id = res['_scroll_id']
-        scroll_size = len(res['hits']['hits'])
-        # TODO: memory error??
-#         break
-    return full_results
-    
-MONTHS=['jan', 'feb', 'mar', 'apr', 'may', 'june', 'july', 'aug', 'sep', 'oct', 'nov', 'dec']
-ES_SETUP_SLEEP_TIME=150
 MAX_TIMEOUT=300
-def sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lang, word_list_pairs, es_cluster_name='reddit_comments', es_dir='/hg190/elastic_search/es_instances_for_reddit_comments/', word_query_filters=None, sample_size=10, max_subtypes_per_word=5):
+def sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lang, word_list_pairs, es_cluster_name='reddit_comments', es_dir='/hg190/elastic_search/es_instances_for_reddit_comments/', word_query_filters=None, sample_size=10, max_subtypes_per_word=5, shingle_field=None, es_manager=None, query_cache=None):
     """
     Sample post text from ES instance.
     
     :param word_list_pairs: pairs of group words and query words (e.g. "tweet" | ["tuitear", "tuiteo"])
+    :param shingle_field: shingle subfield of text field (e.g. "shingles") => exact phrase queries
+    :param es_manager: ESInstanceManager to reuse running instance
+    (default: start instance here and stop it when done)
+    :param query_cache: QueryResultCache for query results
     """
-    # start ES index
-    es_start_month_str = MONTHS[es_start_month-1]
-    es_end_month_str = MONTHS[es_end_month-1]
-    es_year_str = str(es_year)
-    es_dir_full = os.path.join(es_dir, es_year_str, '%s-%s-%s'%(es_start_month_str, es_end_month_str, es_year_str), 'elasticsearch-2.1.1/bin')
-    es_index = '%s_%d_m_%d_%d'%(es_cluster_name, es_year, es_start_month, es_end_month)
-    es_command = './elasticsearch --cluster.name %s --node.name %s'%(es_cluster_name, es_index)
+    close_manager = es_manager is None
+    if(es_manager is None):
+        es_manager = ESInstanceManager(es_cluster_name=es_cluster_name, es_dir=es_dir, max_instances=1)
     combined_samples = []
     long_lang_lookup = {'en' : 'english', 'es' : 'spanish'}
     lang_long = long_lang_lookup[lang]
@@ -58,39 +34,52 @@ def sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lan
     # restrict to short contexts
 #     MAX_TXT_LEN=100
     try:
-        process = Popen(es_command.split(' '), cwd=es_dir_full)
-        try:
-            sleep(ES_SETUP_SLEEP_TIME)
-        except Exception as e:
-            pass
-        es = Elasticsearch(timeout=MAX_TIMEOUT)
+        es_index = get_es_instance_name(es_year, es_start_month, es_end_month, es_cluster_name)
+        es_clients = []
+        def get_es():
+            # start ES index on first uncached query, or reuse running instance
+            if(len(es_clients) == 0):
+                es_clients.append(es_manager.get_client(es_year, es_start_month, es_end_month, timeout=MAX_TIMEOUT)[0])
+            return es_clients[0]
         for word, word_list in word_list_pairs:
             word_results = []
             for word_i in word_list:
-                es_query = {
-                    "query" : {
-                        "bool" : {
-                            # one-word match
-                            "must" : [
-                                {
-                                    "match" : {
-                                        "body" : word_i,
-                                    }
-                                },
-                                {
-                                    "match" : {
-                                        "lang" : lang,
+                if(shingle_field is not None):
+                    # multi-word phrases ("hacer un tweet") => term lookup on shingles
+                    es_query = generate_phrase_queries([word_i], extra_query_params={'lang' : lang}, search_var=txt_var, shingle_field=shingle_field)[0]
+                else:
+                    es_query = {
+                        "query" : {
+                            "bool" : {
+                                # one-word match
+                                "must" : [
+                                    {
+                                        "match" : {
+                                            "body" : word_i,
+                                        }
+                                    },
+                                    {
+                                        "match" : {
+                                            "lang" : lang,
+                                        }
                                     }
-                                }
-                            ],
+                                ],
+                            }
                         }
                     }
-                }
-                results_i = collect_scroll_results(es, es_index, es_query)
+                # restrict to M+1 results per subtype
+                # prevent us from getting stuck with 
+                # all "acceso" subtypes for "access"
+                # i.e. enforces diversity of subtypes!
+                max_results = max_subtypes_per_word+1
+                fetch_results = lambda: iter_scroll_results(get_es(), es_index, es_query, keys_to_include=[txt_var], max_results=max_results)
+                if(query_cache is not None):
+                    results_i = query_cache.get_results(es_index, es_query, fetch_results, keys_to_include=[txt_var], max_results=max_results)
+                else:
+                    results_i = fetch_results()
                 # get word context, i.e. sentence containing word_i
                 word_i_matcher = re.compile(' %s '%(word_i))
                 clean_results_i = []
-                result_ctr = 0
                 for res_j in results_i:
                     txt_j = res_j['_source'][txt_var]
                     txt_j = clean_txt_for_matching(txt_j, TKNZR=TKNZR)
@@ -105,13 +94,6 @@ def sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lan
                         res_j['_source'][txt_var] = matching_sent
                         res_j['_source']['word_match'] = word_i
                         clean_results_i.append(res_j)
-                    # restrict to M tokens per subtype
-                    # prevent us from getting stuck with 
-                    # all "acceso" subtypes for "access"
-                    # i.e. enforces diversity of subtypes!
-                    result_ctr += 1
-                    if(result_ctr > max_subtypes_per_word):
-                        break
                 word_results += clean_results_i
             # get random sample size N
             if(len(word_results) > sample_size):
@@ -122,15 +104,35 @@ def sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lan
             word_results_data = list(map(lambda x: [word, x['_source']['word_match'], x['_source'][txt_var]], word_results))
 #             word_results_txt = list(map(lambda x: [word, x], word_results_txt))
             combined_samples += word_results_data
-        process.terminate()
     except Exception as e:
         print('exception %s'%(e))
         logging.debug('terminating process early')
-        process.terminate()
+    finally:
+        if(close_manager):
+            es_manager.close()
     combined_samples = pd.DataFrame(combined_samples, columns=['word', 'word_match', 'text'])
     return combined_samples
 
-def sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, word_query_pairs):
+def build_word_phrase_matcher(word_phrase_pattern_pairs):
+    """
+    Build one phrase matcher for all query phrases,
+    and lookup from literal phrase to word.
+    
+    :param word_phrase_pattern_pairs: pairs of word and query phrase pattern (e.g. "tweet" | "(tuitear|tuiteo)")
+    :returns phrase_matcher:: phrase matcher
+    :returns phrase_word_lookup:: phrase/word lookup
+    """
+    phrases = []
+    phrase_word_lookup = {}
+    for word, phrase_pattern in word_phrase_pattern_pairs:
+        for phrase in expand_phrase_pattern(phrase_pattern.strip()):
+            phrases.append(phrase)
+            phrase_word_lookup.setdefault(phrase, []).append(word)
+    # text is tokenized and re-joined with spaces, with buffer spaces at start/end
+    phrase_matcher = PhraseMatcher(phrases, boundary_chars=' ', match_start=False, match_end=False)
+    return phrase_matcher, phrase_word_lookup
+
+def sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, phrase_matcher, phrase_word_lookup):
     """
     Sample post text that matches a query phrase.
     
@@ -139,6 +141,8 @@ def sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, word_query_p
     :param id_var: post ID var
     :param lang: valid post lang from which to sample
     :param lang_id_dir: lang ID directory
+    :param phrase_matcher: matcher for all query phrases
+    :param phrase_word_lookup: phrase/word lookup
     
     :returns post_txt_samples:: post txt sample data
     """
@@ -155,16 +159,14 @@ def sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, word_query_p
     post_file_base = os.path.basename(post_file).split('.')[0]
     post_dir = os.path.dirname(post_file)
     lang_id_file = os.path.join(post_dir, lang_id_dir, '%s_lang_id.tsv.gz'%(post_file_base))
-    lang_id_data = pd.read_csv(lang_id_file, sep='\t', index_col=False, compression='gzip', header=None, names=['id', 'lang', 'score'])
-    valid_lang_ids = lang_id_data[(lang_id_data.loc[:, 'score'] > score_thresh) & (lang_id_data.loc[:, 'lang'] == lang)].loc[:, 'id'].unique()
+    lang_id_store = load_lang_id_store(lang_id_file)
+    valid_lang_ids = lang_id_store.get_id_set(lang=lang, score_thresh=score_thresh)
     logging.info('%d valid lang IDs'%(len(valid_lang_ids)))
     file_iter = get_file_iter(post_file)
 #     logging.info('file iter %s'%(file_iter))
     line_ctr = 0
     try:
         for lines in file_iter:
-            if(type(lines) is not list):
-                lines = [lines]
             for line in lines:
 #                 logging.info('line=%s'%(line))
                 try:
@@ -180,11 +182,13 @@ def sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, word_query_p
                         # try to match text
                         for sent in txt_sents:
 #                             print(sent)
-                            for word, query in word_query_pairs:
-                                query_match = query.search(sent)
-                                if(query_match is not None):
-                                    logging.info('query match word=%s sent="%s"'%(word, sent))
-                                    post_txt_samples.append([word, sent])
+                            # one sample per matching word
+                            sent_words = []
+                            for phrase in phrase_matcher.findall(sent, overlap=True):
+                                sent_words += phrase_word_lookup[phrase]
+                            for word in dict.fromkeys(sent_words):
+                                logging.info('query match word=%s sent="%s"'%(word, sent))
+                                post_txt_samples.append([word, sent])
                         line_ctr += 1
                         if(line_ctr % 100000 == 0):
                             logging.info('processed %d lines, %d matches'%(line_ctr, len(post_txt_samples)))
@@ -216,6 +220,8 @@ def main():
     parser.add_argument('--lang', default='es')
     parser.add_argument('--txt_var', default='body')
     parser.add_argument('--id_var', default='id')
+    parser.add_argument('--shingle_field', default=None) # index built with index_ES_posts.py --shingle_field => "shingles"
+    parser.add_argument('--query_cache_dir', default=None) # cache query results across reruns, e.g. ../../data/es_query_cache/
     args = vars(parser.parse_args())
 #     post_file = args['post_file']
 #     post_file_base = os.path.basename(post_file).split('.')[0]
@@ -241,6 +247,8 @@ def main():
         'query_matcher' : phrase_data.loc[:, 'verb'].apply(re.compile)
     })
     word_query_pairs = list(zip(phrase_data.loc[:, 'loanword'].values, phrase_data.loc[:, 'query_matcher'].values))
+    # all query phrases => one matcher for post-file sampling
+    phrase_matcher, phrase_word_lookup = build_word_phrase_matcher(zip(phrase_data.loc[:, 'loanword'].values, phrase_data.loc[:, 'verb'].values))
     # get word + word list pairs
     # "tweet" / ["tuiteo", "tuitear"]
     paren_matcher = re.compile('(?<=\()[^\)]+(?=\))')
@@ -255,9 +263,12 @@ def main():
     id_var = args['id_var']
     es_dir = args['es_dir']
     lang = args['lang']
-#     post_txt_samples = sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, word_query_pairs)
+#     post_txt_samples = sample_post_text(post_file, txt_var, id_var, lang, lang_id_dir, phrase_matcher, phrase_word_lookup)
 #     post_txt_samples = pd.DataFrame(post_txt_samples, names=['word', 'context'])
-    post_txt_samples = sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lang, word_list_pairs, es_cluster_name=es_cluster_name, es_dir=es_dir, word_query_filters=None, sample_size=10)
+    query_cache = None
+    if(args['query_cache_dir'] is not None):
+        query_cache = QueryResultCache(args['query_cache_dir'])
+    post_txt_samples = sample_post_text_from_ES(es_year, es_start_month, es_end_month, txt_var, lang, word_list_pairs, es_cluster_name=es_cluster_name, es_dir=es_dir, word_query_filters=None, sample_size=10, shingle_field=args['shingle_field'], query_cache=query_cache)
     logging.info('%d post text samples'%(post_txt_samples.shape[0]))
     
     ## write to file
@@ -4,32 +4,30 @@ Tag language ID and score for all prior posts from authors.
 from argparse import ArgumentParser
 import logging
 import os
-from langid.langid import LanguageIdentifier, model
-from data_helpers import load_data_from_dirs, clean_tweet_txt, clean_txt_simple
-from pandarallel import pandarallel
+from data_helpers import load_data_from_dirs, clean_tweet_txt, clean_txt_simple, tag_lang_txt
 import pandas as pd
 import re
 # import resource
 
 # restrict core use
 
-def tag_lang(data, txt_var='text_clean'):
+def tag_lang(data, txt_var='text_clean', lang_id_cache=None):
     """
     Tag language in all text in data, 
     return language, score and post IDs.
     
     :param data: data frame
     :param txt_var: text var
+    :param lang_id_cache: on-disk lang ID cache file
     :returns lang_id_data:: lang, score and post ID
     """
-    lang_id_model = LanguageIdentifier.from_modelstring(model, norm_probs=True)
-    # parallel
+    # parallel: batches of text per worker, one model per worker
     MAX_JOBS=5
-    pandarallel.initialize(nb_workers=MAX_JOBS)
-    lang_score_vals = data.loc[:, txt_var].parallel_apply(lang_id_model.classify)
-    # serial
-    # TODO: why does langid wreck CPU use?
-#     lang_score_vals = data.loc[:, txt_var].apply(lang_id_model.classify)
+    lang_score_vals = tag_lang_txt(data.loc[:, txt_var].tolist(), backend='langid', workers=MAX_JOBS, cache_file=lang_id_cache)
+    # old: per-row pickling with pandarallel
+#     lang_id_model = LanguageIdentifier.from_modelstring(model, norm_probs=True)
+#     pandarallel.initialize(nb_workers=MAX_JOBS)
+#     lang_score_vals = data.loc[:, txt_var].parallel_apply(lang_id_model.classify)
     # separate lang/score
     lang_val, lang_score = zip(*lang_score_vals)
     lang_var = 'lang'
@@ -46,6 +44,7 @@ def main():
     parser = ArgumentParser()
     parser.add_argument('data_dir') # ../../data/mined_tweets/loanword_integrated_verb_author_counts_CLUSTER\=twitter_posts_tweets/
     parser.add_argument('--data_type', default='twitter')
+    parser.add_argument('--lang_id_cache', default=None)
     args = vars(parser.parse_args())
     logging_file = '../../output/tag_language_all_author_posts.txt'
     if(os.path.exists(logging_file)):
@@ -84,7 +83,7 @@ def main():
         combined_data = combined_data[~combined_data.loc[:, 'id'].isin(old_lang_id_post_ids)]
     else:
         old_lang_id_data = []
-    lang_id_data = tag_lang(combined_data, txt_var=clean_txt_var)
+    lang_id_data = tag_lang(combined_data, txt_var=clean_txt_var, lang_id_cache=args['lang_id_cache'])
     
     ## write to file
     if(len(old_lang_id_data) > 0):
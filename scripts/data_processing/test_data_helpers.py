@@ -0,0 +1,40 @@
+"""
+Tests for data helpers.
+"""
+from data_helpers import GeoRegionFilter, get_tweet_point
+
+def test_get_tweet_point_malformed():
+    assert get_tweet_point({'coordinates' : {'type' : 'Point', 'coordinates' : None}}) is None
+    assert get_tweet_point({'geo' : {'type' : 'Point', 'coordinates' : [1.]}}) is None
+    assert get_tweet_point({'place' : {'bounding_box' : {'coordinates' : 'bad'}}}, use_place=True) is None
+    assert get_tweet_point({'coordinates' : {'type' : 'Point', 'coordinates' : [2.35, 48.85]}}) == (2.35, 48.85)
+
+def test_geo_region_filter_bad_tweet_in_batch():
+    geo_regions = {
+        'paris' : {'box' : [2.2, 48.8, 2.5, 48.9]},
+        'france' : {'place' : {'country_code' : 'FR'}},
+    }
+    geo_filter = GeoRegionFilter(geo_regions, use_place=True)
+    good_tweet = {'coordinates' : {'type' : 'Point', 'coordinates' : [2.35, 48.85]}, 'place' : {'country_code' : 'FR'}}
+    bad_tweets = [
+        {'coordinates' : {'type' : 'Point', 'coordinates' : None}},
+        {'geo' : {'type' : 'Point', 'coordinates' : []}},
+        {'place' : {'bounding_box' : {'coordinates' : [[1.]]}, 'country_code' : 'FR'}},
+        {'place' : 'FR'},
+    ]
+    for bad_tweet in bad_tweets:
+        tweets = [good_tweet, bad_tweet, good_tweet]
+        tweet_regions = geo_filter.match_batch(tweets)
+        assert sorted(tweet_regions[0]) == ['france', 'paris']
+        assert 'paris' not in tweet_regions[1]
+        assert sorted(tweet_regions[2]) == ['france', 'paris']
+
+def test_geo_region_filter_box_and_place():
+    geo_filter = GeoRegionFilter({'paris_fr' : {'box' : [2.2, 48.8, 2.5, 48.9], 'place' : {'country_code' : 'FR'}}})
+    point = {'type' : 'Point', 'coordinates' : [2.35, 48.85]}
+    tweets = [
+        {'coordinates' : point, 'place' : {'country_code' : 'FR'}},
+        {'coordinates' : point, 'place' : {'country_code' : 'US'}},
+        {'place' : {'country_code' : 'FR'}},
+    ]
+    assert geo_filter.match_batch(tweets) == [['paris_fr'], [], []]